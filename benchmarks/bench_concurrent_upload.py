@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Measure /api/countdown poll latency while a large, slow upload is in progress.
+
+Runs the server in-process inside a scratch directory, once with the old
+single-threaded socketserver.TCPServer and once with the threaded
+PictureServer, and prints latency percentiles for each.
+
+Usage: python3 benchmarks/bench_concurrent_upload.py [--displays 20] [--upload-mb 20]
+"""
+
+import argparse
+import http.client
+import os
+import socketserver
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import server  # noqa: E402
+
+
+class SingleThreadedServer(socketserver.TCPServer):
+    """The old server, with the request bookkeeping PictureServer does left out"""
+
+    def start_request(self):
+        pass
+
+    def end_request(self):
+        pass
+
+    def keep_alive_allowed(self):
+        # An idle kept-alive connection would hold the only thread
+        return False
+
+
+def start_server(mode, workers):
+    """Start a server on a free port and return it"""
+    if mode == 'single':
+        httpd = SingleThreadedServer(('127.0.0.1', 0), server.PictureHandler)
+    else:
+        httpd = server.PictureServer(('127.0.0.1', 0), server.PictureHandler, max_workers=workers)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def slow_upload(port, size, seconds, done):
+    """Send a multipart upload of the given size spread evenly over the given time"""
+    boundary = 'benchboundary'
+    head = (f'--{boundary}\r\n'
+            'Content-Disposition: form-data; name="file"; filename="bench_upload.png"\r\n'
+            'Content-Type: image/png\r\n\r\n').encode()
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    conn.putrequest('POST', '/api/upload')
+    conn.putheader('Content-Type', f'multipart/form-data; boundary={boundary}')
+    conn.putheader('Content-Length', str(len(head) + size + len(tail)))
+    conn.endheaders()
+    conn.send(head)
+    chunk = b'\0' * 64 * 1024
+    chunks = max(1, size // len(chunk))
+    delay = seconds / chunks
+    for _ in range(chunks):
+        conn.send(chunk)
+        time.sleep(delay)
+    conn.send(b'\0' * (size - chunks * len(chunk)))
+    conn.send(tail)
+    conn.getresponse().read()
+    conn.close()
+    done.set()
+
+
+def poll_countdown(port, stop, latencies):
+    """Poll the countdown endpoint like a display does, recording latencies"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+        conn.request('GET', '/api/countdown')
+        conn.getresponse().read()
+        conn.close()
+        latencies.append(time.perf_counter() - started)
+        time.sleep(0.25)
+
+
+def run(mode, args):
+    httpd = start_server(mode, args.workers)
+    port = httpd.server_address[1]
+    stop = threading.Event()
+    done = threading.Event()
+    latencies = []
+    pollers = [threading.Thread(target=poll_countdown, args=(port, stop, latencies), daemon=True)
+               for _ in range(args.displays)]
+    for poller in pollers:
+        poller.start()
+    threading.Thread(target=slow_upload,
+                     args=(port, args.upload_mb * 1024 * 1024, args.upload_seconds, done),
+                     daemon=True).start()
+    done.wait()
+    stop.set()
+    for poller in pollers:
+        poller.join()
+    httpd.shutdown()
+    httpd.server_close()
+
+    latencies.sort()
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+    print(f"{mode:>9}: {len(latencies):5d} polls  "
+          f"p50 {pct(0.50):8.1f} ms  p95 {pct(0.95):8.1f} ms  "
+          f"p99 {pct(0.99):8.1f} ms  max {latencies[-1] * 1000:8.1f} ms  "
+          f"mean {statistics.mean(latencies) * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--displays', type=int, default=20, help="number of polling displays")
+    parser.add_argument('--upload-mb', type=int, default=20, help="size of the slow upload")
+    parser.add_argument('--upload-seconds', type=float, default=5.0, help="how long the upload takes to send")
+    parser.add_argument('--workers', type=int, default=server.DEFAULT_MAX_WORKERS,
+                        help="worker limit for the threaded server")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        print(f"{args.displays} displays polling every 250 ms during a "
+              f"{args.upload_mb} MB upload sent over {args.upload_seconds:.0f} s")
+        for mode in ('single', 'threaded'):
+            run(mode, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+Simulate a venue full of displays plus an admin, and measure the server.
+
+The server runs in a subprocess inside a scratch directory with some pictures
+in it. N simulated displays and one admin client run against it for a fixed
+time. The script then prints request throughput, latency percentiles per
+endpoint, and the server's CPU time and memory. With --max-p99-ms or
+--max-errors it exits with status 1 when a limit is exceeded, so it can be
+used as a regression gate.
+
+Display profiles:
+  legacy   the polling schedule of the original index.html: the countdown
+           every 1 s and every 2 s, pictures and custom slide every 15 s
+  polling  index.html without an event stream: bootstrap, then
+           /api/changes every 2 s, reloading the bootstrap when it changed
+  events   index.html: bootstrap, then the /api/events stream
+
+With --keep-alive each simulated client keeps one persistent connection, as
+browsers do; without it every request opens a new connection.
+
+The admin uploads a picture, deletes an old one, saves the custom slide and
+updates the countdown at regular intervals. With the events profile the time
+from a countdown update to its arrival on each display is reported as well.
+
+Usage: python3 benchmarks/bench_fleet.py [--displays 50] [--duration 60] [--profile events] [--keep-alive]
+"""
+
+import argparse
+import heapq
+import http.client
+import json
+import os
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+BOUNDARY = 'fleetboundary'
+
+
+def make_png(width, height):
+    """A valid PNG of random pixels, built with the standard library only"""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    rows = b''.join(b'\0' + os.urandom(width * 3) for _ in range(height))
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(rows, 1)) +
+            chunk(b'IEND', b''))
+
+
+def child(workers):
+    """Run the server in this directory; report its CPU time and memory when told to stop"""
+    import resource
+    import server
+
+    server.get_room(server.DEFAULT_ROOM)
+    httpd = server.PictureServer(('127.0.0.1', 0), server.PictureHandler, max_workers=workers)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print(httpd.server_address[1], flush=True)
+
+    sys.stdin.readline()
+    before = os.times()
+    sys.stdin.readline()
+    after = os.times()
+    rss_kb = None
+    try:
+        with open('/proc/self/statm') as f:
+            rss_kb = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024  # Reported in bytes rather than kilobytes
+    print(json.dumps({'user': after.user - before.user, 'system': after.system - before.system,
+                      'rss_kb': rss_kb, 'peak_rss_kb': peak}), flush=True)
+
+    # Ends the event streams so the displays notice the run is over
+    server.close_rooms()
+    httpd.shutdown()
+    server.rendition_pipeline.close()
+
+
+class Stats:
+    """Latencies and errors per endpoint, shared by all simulated clients"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.event_delays = []
+
+    def record(self, endpoint, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def summary(self):
+        def pct(values, p):
+            return values[min(len(values) - 1, int(len(values) * p))] * 1000
+        endpoints = {}
+        with self.lock:
+            for endpoint, values in sorted(self.latencies.items()):
+                values = sorted(values)
+                endpoints[endpoint] = {'requests': len(values), 'errors': self.errors.get(endpoint, 0),
+                                       'p50_ms': pct(values, 0.50), 'p95_ms': pct(values, 0.95),
+                                       'p99_ms': pct(values, 0.99), 'max_ms': values[-1] * 1000}
+            delays = sorted(self.event_delays)
+        events = None
+        if delays:
+            events = {'received': len(delays), 'p50_ms': pct(delays, 0.50),
+                      'p95_ms': pct(delays, 0.95), 'p99_ms': pct(delays, 0.99)}
+        return endpoints, events
+
+
+class Client:
+    def __init__(self, port, stats, keep_alive=False):
+        self.port = port
+        self.stats = stats
+        self.keep_alive = keep_alive
+        self.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        """Make one request and record its latency; returns the parsed JSON body or None"""
+        path_only = path.split('?')[0]
+        if path_only.startswith('/api/delete/'):
+            path_only = '/api/delete/<name>'
+        endpoint = f"{method} {path_only}"
+        started = time.perf_counter()
+        ok = False
+        data = None
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+            self.conn.request(method, path, body=body, headers=headers or {})
+            response = self.conn.getresponse()
+            raw = response.read()
+            if not self.keep_alive or response.will_close:
+                self.conn.close()
+                self.conn = None
+            ok = response.status < 400
+            if ok and response.getheader('Content-Type', '').startswith('application/json'):
+                data = json.loads(raw)
+        except (OSError, http.client.HTTPException, ValueError):
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+        self.stats.record(endpoint, time.perf_counter() - started, ok)
+        return data
+
+
+def run_schedule(stop, tasks):
+    """Run each (interval, action) repeatedly until stop is set, starting at a random
+    phase; like setInterval, a late run does not cause a burst of catch-up runs"""
+    now = time.monotonic()
+    due = [(now + random.uniform(0, interval), n) for n, (interval, _) in enumerate(tasks)]
+    heapq.heapify(due)
+    while due:
+        when, n = heapq.heappop(due)
+        if stop.wait(max(0.0, when - time.monotonic())):
+            return
+        interval, action = tasks[n]
+        action()
+        heapq.heappush(due, (max(when + interval, time.monotonic()), n))
+
+
+def legacy_display(client, stop):
+    def countdown():
+        client.request('GET', '/api/countdown')
+
+    def slides():
+        client.request('GET', '/api/pictures')
+        client.request('GET', '/api/custom-slide')
+
+    countdown()
+    slides()
+    run_schedule(stop, [(1.0, countdown), (2.0, countdown), (15.0, slides)])
+
+
+def polling_display(client, stop):
+    state = client.request('GET', '/api/bootstrap') or {}
+
+    def check():
+        nonlocal state
+        changes = client.request('GET', f"/api/changes?since={state.get('version')}&boot={state.get('boot_id')}")
+        if changes and changes['changed']:
+            state = client.request('GET', '/api/bootstrap') or state
+
+    run_schedule(stop, [(2.0, check)])
+
+
+def events_display(client, stop):
+    client.request('GET', '/api/bootstrap')
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', client.port, timeout=120)
+        conn.request('GET', '/api/events')
+        response = conn.getresponse()
+        if response.status != 200:
+            client.stats.record('GET /api/events', 0, False)
+            return
+        event = None
+        while line := response.fp.readline():
+            line = line.decode().rstrip('\n')
+            if line.startswith('event: '):
+                event = line[7:]
+            elif line.startswith('data: ') and event == 'countdown':
+                # The admin puts the time of the update in the countdown text
+                text = json.loads(line[6:]).get('text', '')
+                if text.startswith('bench '):
+                    with client.stats.lock:
+                        client.stats.event_delays.append(time.time() - float(text[6:]))
+        conn.close()
+    except (OSError, http.client.HTTPException):
+        if not stop.is_set():
+            client.stats.record('GET /api/events', 0, False)
+
+
+def admin(client, stop, args, picture):
+    uploaded = []
+
+    def upload():
+        name = f'fleet-{time.time_ns()}.png'
+        body = (f'--{BOUNDARY}\r\n'
+                f'Content-Disposition: form-data; name="file"; filename="{name}"\r\n'
+                'Content-Type: image/png\r\n\r\n').encode() + picture + f'\r\n--{BOUNDARY}--\r\n'.encode()
+        if client.request('POST', '/api/upload', body,
+                          {'Content-Type': f'multipart/form-data; boundary={BOUNDARY}'}):
+            uploaded.append(name)
+
+    def delete():
+        if len(uploaded) > 2:
+            client.request('DELETE', f'/api/delete/{uploaded.pop(0)}')
+
+    def save_slide():
+        slide = {'elements': [{'type': 'text', 'content': f'Update {time.time():.0f}'}],
+                 'backgroundColor': '#202020'}
+        client.request('POST', '/api/custom-slide', json.dumps(slide))
+
+    def update_countdown():
+        client.request('POST', '/api/countdown',
+                       json.dumps({'text': f'bench {time.time():.6f}', 'duration': 300}))
+
+    run_schedule(stop, [(args.upload_interval, upload), (args.upload_interval, delete),
+                        (args.save_interval, save_slide), (args.save_interval, update_countdown)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--displays', type=int, default=50, help="number of simulated displays")
+    parser.add_argument('--duration', type=float, default=60, help="seconds to run for")
+    parser.add_argument('--profile', choices=['legacy', 'polling', 'events'], default='events',
+                        help="how the displays talk to the server")
+    parser.add_argument('--pictures', type=int, default=20, help="pictures in the folder at the start")
+    parser.add_argument('--upload-kb', type=int, default=500, help="approximate size of uploaded pictures")
+    parser.add_argument('--upload-interval', type=float, default=10, help="seconds between admin uploads")
+    parser.add_argument('--save-interval', type=float, default=5,
+                        help="seconds between custom slide saves and countdown updates")
+    parser.add_argument('--workers', type=int, default=32, help="server worker limit")
+    parser.add_argument('--keep-alive', action='store_true',
+                        help="reuse one connection per display instead of one per request")
+    parser.add_argument('--max-p99-ms', type=float, help="fail if a display endpoint's p99 is slower")
+    parser.add_argument('--max-errors', type=int, help="fail if more requests than this fail")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.workers)
+        return
+
+    side = max(8, int((args.upload_kb * 1024 / 3) ** 0.5))
+    picture = make_png(side, side)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        Path('pictures').mkdir()
+        for n in range(args.pictures):
+            Path(f'pictures/picture{n + 1}.png').write_bytes(make_png(64, 48))
+
+        proc = subprocess.Popen([sys.executable, __file__, '--child', '--workers', str(args.workers)],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        port = int(proc.stdout.readline())
+        stats = Stats()
+        stop = threading.Event()
+        display = {'legacy': legacy_display, 'polling': polling_display, 'events': events_display}[args.profile]
+        threads = [threading.Thread(target=display, args=(Client(port, stats, args.keep_alive), stop),
+                                    daemon=True)
+                   for _ in range(args.displays)]
+        threads.append(threading.Thread(target=admin,
+                                        args=(Client(port, stats, args.keep_alive), stop, args, picture),
+                                        daemon=True))
+
+        proc.stdin.write('start\n')
+        proc.stdin.flush()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        elapsed = time.perf_counter() - started
+
+        proc.stdin.write('stop\n')
+        proc.stdin.flush()
+        server_stats = json.loads(proc.stdout.readline())
+        for thread in threads:
+            thread.join(timeout=30)
+        proc.stdin.close()
+        proc.wait()
+
+    endpoints, events = stats.summary()
+    total = sum(e['requests'] for e in endpoints.values())
+    errors = sum(e['errors'] for e in endpoints.values())
+    cpu = server_stats['user'] + server_stats['system']
+    results = {'profile': args.profile, 'keep_alive': args.keep_alive, 'displays': args.displays, 'seconds': elapsed,
+               'requests': total, 'errors': errors, 'requests_per_second': total / elapsed,
+               'server_cpu_seconds': cpu, 'server_cpu_percent': cpu / elapsed * 100,
+               'server_rss_kb': server_stats['rss_kb'], 'server_peak_rss_kb': server_stats['peak_rss_kb'],
+               'endpoints': endpoints, 'events': events}
+
+    failures = []
+    if args.max_errors is not None and errors > args.max_errors:
+        failures.append(f"{errors} failed requests (limit {args.max_errors})")
+    if args.max_p99_ms is not None:
+        for endpoint, result in endpoints.items():
+            # Admin requests move whole pictures around, so only display traffic is gated
+            if endpoint.startswith('GET') and result['p99_ms'] > args.max_p99_ms:
+                failures.append(f"{endpoint} p99 {result['p99_ms']:.1f} ms (limit {args.max_p99_ms:.0f} ms)")
+    results['failures'] = failures
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        connections = "keep-alive" if args.keep_alive else "a connection per request"
+        print(f"{args.displays} displays ({args.profile}, {connections}) for {elapsed:.0f} s: "
+              f"{total} requests, {total / elapsed:.1f} req/s, {errors} errors")
+        rss = server_stats['rss_kb']
+        print(f"server: CPU {cpu:.2f} s ({results['server_cpu_percent']:.1f}% of one core), "
+              f"RSS {rss / 1024 if rss else float('nan'):.1f} MB, "
+              f"peak {server_stats['peak_rss_kb'] / 1024:.1f} MB")
+        print(f"{'endpoint':<26} {'requests':>8} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} "
+              f"{'p99 ms':>8} {'max ms':>8}")
+        for endpoint, r in endpoints.items():
+            print(f"{endpoint:<26} {r['requests']:8d} {r['errors']:6d} {r['p50_ms']:8.1f} {r['p95_ms']:8.1f} "
+                  f"{r['p99_ms']:8.1f} {r['max_ms']:8.1f}")
+        if events:
+            print(f"countdown update to display: {events['received']} deliveries, p50 {events['p50_ms']:.1f} ms  "
+                  f"p95 {events['p95_ms']:.1f} ms  p99 {events['p99_ms']:.1f} ms")
+        for failure in failures:
+            print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
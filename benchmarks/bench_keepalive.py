@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Compare a connection per request with persistent (keep-alive) connections.
+
+Runs bench_fleet.py twice with the same simulated display fleet: once with
+every request on a new connection, as before the server spoke HTTP/1.1, and
+once with each display keeping one connection open, as browsers do. The
+default profile is the original slideshow's polling schedule (the countdown
+every 1 s and every 2 s), where connection setup is most of the work. Prints
+the per-poll latency of the display endpoints and the server's CPU time.
+
+Usage: python3 benchmarks/bench_keepalive.py [--displays 50] [--duration 30] [--profile legacy]
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+FLEET = Path(__file__).resolve().parent / 'bench_fleet.py'
+
+
+def run(args, keep_alive):
+    command = [sys.executable, str(FLEET), '--json', '--displays', str(args.displays),
+               '--duration', str(args.duration), '--profile', args.profile]
+    if keep_alive:
+        command.append('--keep-alive')
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0 and not result.stdout:
+        raise SystemExit(result.stderr)
+    return json.loads(result.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--displays', type=int, default=50, help="number of simulated displays")
+    parser.add_argument('--duration', type=float, default=30, help="seconds per run")
+    parser.add_argument('--profile', choices=['legacy', 'polling'], default='legacy',
+                        help="how the displays poll the server (see bench_fleet.py)")
+    args = parser.parse_args()
+
+    runs = {'new connections': run(args, False), 'keep-alive': run(args, True)}
+    print(f"{args.displays} displays ({args.profile}), {args.duration:g} s per run")
+    for label, results in runs.items():
+        cpu_per_request = results['server_cpu_seconds'] / max(1, results['requests']) * 1e6
+        print(f"{label}: {results['requests_per_second']:.0f} req/s, {results['errors']} errors, "
+              f"server CPU {results['server_cpu_percent']:.1f}% of one core "
+              f"({cpu_per_request:.0f} us per request)")
+        for endpoint, r in results['endpoints'].items():
+            if endpoint.startswith('GET'):
+                print(f"  {endpoint:<24} p50 {r['p50_ms']:6.2f} ms  p95 {r['p95_ms']:6.2f} ms  "
+                      f"p99 {r['p99_ms']:6.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Compare peak memory and throughput of upload parsing.
+
+"legacy" is the parser the upload handlers used to have: read the whole body,
+split it on the boundary, split each part into lines and join them back.
+"streaming" is multipart_upload.parse_multipart. Each run happens in its own
+subprocess so its peak RSS can be measured on its own.
+
+Usage: python3 benchmarks/bench_multipart.py [--size-mb 30] [--files 1]
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+BOUNDARY = 'benchboundary'
+
+
+class GeneratedBody:
+    """File-like multipart body produced on the fly, so the input costs no memory"""
+
+    def __init__(self, files, size):
+        self.pieces = []
+        for n in range(files):
+            self.pieces.append((f'--{BOUNDARY}\r\n'
+                                f'Content-Disposition: form-data; name="file"; filename="bench{n}.png"\r\n'
+                                'Content-Type: image/png\r\n\r\n').encode())
+            self.pieces.append(size)
+            self.pieces.append(b'\r\n')
+        self.pieces.append(f'--{BOUNDARY}--\r\n'.encode())
+        self.length = sum(p if isinstance(p, int) else len(p) for p in self.pieces)
+        self.filler = bytes(range(256)) * 256
+
+    def read(self, n=-1):
+        out = bytearray()
+        while self.pieces and (n < 0 or len(out) < n):
+            piece = self.pieces[0]
+            want = (n - len(out)) if n >= 0 else None
+            if isinstance(piece, int):
+                take = piece if want is None else min(piece, want)
+                while take:
+                    step = min(take, len(self.filler))
+                    out += self.filler[:step]
+                    take -= step
+                    piece -= step
+                if piece:
+                    self.pieces[0] = piece
+                else:
+                    self.pieces.pop(0)
+            else:
+                take = piece if want is None else piece[:want]
+                out += take
+                if len(take) < len(piece):
+                    self.pieces[0] = piece[len(take):]
+                else:
+                    self.pieces.pop(0)
+        return bytes(out)
+
+
+def legacy_parse(stream, content_length, target_dir):
+    """The original handle_file_upload parsing, kept for comparison"""
+    data = stream.read(content_length)
+    parts = data.split(f'--{BOUNDARY}'.encode())
+    saved = 0
+    for part in parts:
+        if b'filename=' in part and b'Content-Type: image/' in part:
+            lines = part.split(b'\r\n')
+            filename = None
+            file_data = None
+            for i, line in enumerate(lines):
+                if b'filename=' in line:
+                    line_str = line.decode('utf-8')
+                    filename_start = line_str.find('filename="') + 10
+                    filename_end = line_str.find('"', filename_start)
+                    filename = line_str[filename_start:filename_end]
+                    for j in range(i + 1, len(lines)):
+                        if lines[j] == b'':
+                            file_data = b'\r\n'.join(lines[j + 1:])
+                            if file_data.endswith(b'\r\n'):
+                                file_data = file_data[:-2]
+                            break
+                    break
+            if filename and file_data:
+                with open(Path(target_dir) / filename, 'wb') as f:
+                    f.write(file_data)
+                saved += 1
+    return saved
+
+
+def streaming_parse(stream, content_length, target_dir):
+    from multipart_upload import parse_multipart
+    files, _ = parse_multipart(stream, f'multipart/form-data; boundary={BOUNDARY}',
+                               content_length, target_dir, max_bytes=content_length)
+    for upload in files:
+        upload.save_as(Path(target_dir) / upload.filename)
+    return len(files)
+
+
+def child(mode, size, files):
+    """Run one parse and print its timing and peak RSS as JSON"""
+    body = GeneratedBody(files, size)
+    parse = legacy_parse if mode == 'legacy' else streaming_parse
+    with tempfile.TemporaryDirectory() as target:
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.perf_counter()
+        saved = parse(body, body.length, target)
+        elapsed = time.perf_counter() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'saved': saved, 'seconds': elapsed, 'bytes': body.length,
+                      'baseline_kb': baseline, 'peak_kb': peak}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=30, help="size of each uploaded file")
+    parser.add_argument('--files', type=int, default=1, help="number of files in the request")
+    parser.add_argument('--child', choices=['legacy', 'streaming'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    size = args.size_mb * 1024 * 1024
+
+    if args.child:
+        child(args.child, size, args.files)
+        return
+
+    print(f"{args.files} file(s) of {args.size_mb} MB in one request")
+    for mode in ('legacy', 'streaming'):
+        output = subprocess.run([sys.executable, __file__, '--child', mode,
+                                 '--size-mb', str(args.size_mb), '--files', str(args.files)],
+                                check=True, capture_output=True, text=True).stdout
+        result = json.loads(output)
+        extra_mb = (result['peak_kb'] - result['baseline_kb']) / 1024
+        throughput = result['bytes'] / result['seconds'] / (1024 * 1024)
+        print(f"{mode:>10}: {result['saved']} saved  {result['seconds']:6.2f} s  "
+              f"{throughput:7.1f} MB/s  peak RSS {result['peak_kb'] / 1024:7.1f} MB "
+              f"(+{extra_mb:.1f} MB while parsing)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Compare the pictures folder with a picture pack at different archive sizes.
+
+For each picture count a folder of small PNG files is generated and imported
+into a pack with picture_pack.py. A fresh server process then loads the room
+from each, and the script measures:
+
+- startup: loading the room and building the first picture listing, which for
+  the folder includes hashing every picture for its fingerprinted URL
+- listing: building the picture listing again, as every display refresh does
+- serve: fetching pictures over HTTP, one request at a time
+
+The files were just written, so they are in the page cache; on a slow SD card
+or network mount the folder's startup cost grows with the per-file latency,
+while the pack's is a single file.
+
+Usage: python3 benchmarks/bench_pack.py [--counts 10 1000 50000] [--size-kb 4]
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+LISTINGS = 20
+FETCHES = 500
+
+
+def child(mode, fetches):
+    """Load the default room from the folder or the pack and print timings as JSON"""
+    import server
+    from picture_pack import PicturePack
+
+    # Only the store is measured, not rendition jobs
+    server.rendition_pipeline.enabled = False
+    if mode == 'pack':
+        server.picture_pack = PicturePack('pictures.db')
+
+    started = time.perf_counter()
+    room = server.get_room(server.DEFAULT_ROOM)
+    listing = room.list_pictures()
+    startup = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(LISTINGS):
+        room.list_pictures()
+    listing_time = (time.perf_counter() - started) / LISTINGS
+
+    httpd = server.PictureServer(('127.0.0.1', 0), server.PictureHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    urls = [url.lstrip('.') for url in listing['pictures']]
+    random.seed(1)
+    conn = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1], timeout=30)
+    latencies = []
+    for url in random.choices(urls, k=fetches):
+        started = time.perf_counter()
+        conn.request('GET', url)
+        response = conn.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - started)
+        if response.status != 200:
+            raise SystemExit(f"GET {url}: HTTP {response.status}")
+    httpd.shutdown()
+    server.close_rooms()
+
+    latencies.sort()
+    print(json.dumps({
+        'count': listing['count'],
+        'startup': startup,
+        'listing': listing_time,
+        'serve_p50': latencies[len(latencies) // 2],
+        'serve_p95': latencies[int(len(latencies) * 0.95)],
+    }), flush=True)
+
+
+def make_png(index, size):
+    """A valid PNG header followed by filler, so every picture has its own content and size"""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    header = b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', 640 + index % 100, 480, 8, 2, 0, 0, 0))
+    filler = index.to_bytes(8, 'big') * max(1, (size - len(header)) // 8)
+    return header + chunk(b'tEXt', filler) + chunk(b'IEND', b'')
+
+
+def run(mode, fetches):
+    result = subprocess.run([sys.executable, __file__, '--child', mode, '--fetches', str(fetches)],
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def bench(count, args):
+    from picture_pack import PicturePack
+
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        pictures = Path('pictures')
+        pictures.mkdir()
+        for index in range(count):
+            (pictures / f'picture{index:06d}.png').write_bytes(make_png(index, args.size_kb * 1024))
+
+        started = time.perf_counter()
+        pack = PicturePack('pictures.db')
+        room = pack.room('default')
+        for path in sorted(pictures.iterdir()):
+            room.add_file(path, path.name)
+        pack.close()
+        imported = time.perf_counter() - started
+
+        print(f"{count} pictures of {args.size_kb} KB (import into the pack: {imported:.1f} s)")
+        for mode in ('folder', 'pack'):
+            timings = run(mode, args.fetches)
+            assert timings['count'] == count, timings
+            print(f"  {mode:>6}: startup {timings['startup'] * 1000:9.1f} ms  "
+                  f"listing {timings['listing'] * 1000:8.2f} ms  "
+                  f"serve p50 {timings['serve_p50'] * 1000:6.2f} ms  p95 {timings['serve_p95'] * 1000:6.2f} ms")
+        os.chdir('/')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--counts', type=int, nargs='+', default=[10, 1000, 50000],
+                        help="numbers of pictures to try (default: 10 1000 50000)")
+    parser.add_argument('--size-kb', type=int, default=4, help="size of each picture (default: 4)")
+    parser.add_argument('--fetches', type=int, default=FETCHES, help="pictures fetched over HTTP per run")
+    parser.add_argument('--child', choices=['folder', 'pack'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.fetches)
+        return
+
+    for count in args.counts:
+        bench(count, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Measure startup time and request throughput with 1, 2 and 4 server processes.
+
+For each process count the server is started with --processes in a scratch
+directory holding some pictures. The script reports how long it takes until
+the first request is answered and how long a SIGTERM shutdown takes. Load is
+then generated by several client processes, each running a few threads that
+fetch the display endpoints (/api/changes, /api/countdown, /api/pictures and
+/api/bootstrap) as fast as they can.
+
+The clients need CPU too: for throughput to scale with the server processes,
+run this on a machine with more cores than --processes plus --clients, or
+point --clients at 0 and load the server from elsewhere.
+
+Usage: python3 benchmarks/bench_prefork.py [--processes 1 2 4] [--duration 10] [--clients 4]
+"""
+
+import argparse
+import http.client
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from bench_fleet import make_png  # noqa: E402
+
+ENDPOINTS = ['/api/changes', '/api/countdown', '/api/pictures', '/api/bootstrap']
+THREADS_PER_CLIENT = 8
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def client(port, duration):
+    """Send requests from several threads for duration seconds; print the count as JSON"""
+    deadline = time.monotonic() + duration
+    counts = [0] * THREADS_PER_CLIENT
+    errors = [0] * THREADS_PER_CLIENT
+
+    def run(thread):
+        index = thread
+        while time.monotonic() < deadline:
+            path = ENDPOINTS[index % len(ENDPOINTS)]
+            index += 1
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+                conn.request('GET', path)
+                response = conn.getresponse()
+                response.read()
+                conn.close()
+                if response.status == 200:
+                    counts[thread] += 1
+                else:
+                    errors[thread] += 1
+            except OSError:
+                errors[thread] += 1
+
+    threads = [threading.Thread(target=run, args=(thread,)) for thread in range(THREADS_PER_CLIENT)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(json.dumps({'requests': sum(counts), 'errors': sum(errors)}), flush=True)
+
+
+def wait_until_up(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/api/countdown')
+            if conn.getresponse().status == 200:
+                conn.close()
+                return True
+        except OSError:
+            time.sleep(0.01)
+    return False
+
+
+def bench(processes, args):
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, str(ROOT / 'server.py'), '--port', str(port),
+                               '--bind', '127.0.0.1', '--processes', str(processes)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_until_up(port):
+            raise SystemExit(f"Server with {processes} processes did not start")
+        startup = time.perf_counter() - started
+
+        requests = errors = 0
+        if args.clients:
+            clients = [subprocess.Popen([sys.executable, __file__, '--client', str(port),
+                                         '--duration', str(args.duration)],
+                                        stdout=subprocess.PIPE, text=True)
+                       for _ in range(args.clients)]
+            for proc in clients:
+                result = json.loads(proc.communicate()[0])
+                requests += result['requests']
+                errors += result['errors']
+    finally:
+        stopping = time.perf_counter()
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+        shutdown = time.perf_counter() - stopping
+    return {'startup': startup, 'shutdown': shutdown, 'throughput': requests / args.duration, 'errors': errors}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4],
+                        help="server process counts to try (default: 1 2 4)")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of load per process count")
+    parser.add_argument('--clients', type=int, default=4, help="client processes generating load")
+    parser.add_argument('--pictures', type=int, default=100, help="pictures in the scratch directory")
+    parser.add_argument('--client', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.client:
+        client(args.client, args.duration)
+        return
+
+    scratch = tempfile.mkdtemp()
+    try:
+        os.chdir(scratch)
+        Path('pictures').mkdir()
+        for index in range(args.pictures):
+            Path(f'pictures/picture{index:04d}.png').write_bytes(make_png(64, 48))
+
+        print(f"{os.cpu_count()} CPU cores, {args.clients} client processes, {args.duration:g} s per run")
+        baseline = None
+        for processes in args.processes:
+            result = bench(processes, args)
+            baseline = baseline or result['throughput']
+            scaling = result['throughput'] / baseline if baseline else 0
+            print(f"{processes:>2} processes: startup {result['startup'] * 1000:6.0f} ms  "
+                  f"shutdown {result['shutdown'] * 1000:6.0f} ms  "
+                  f"{result['throughput']:8.0f} req/s ({scaling:.2f}x)  {result['errors']} errors")
+    finally:
+        os.chdir('/')
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Compare throughput and server CPU time when downloading a large picture.
+
+"copy" is the old path: SimpleHTTPRequestHandler reading the file and copying
+it to the socket with shutil.copyfileobj. "sendfile" is PictureHandler, which
+hands the file to the kernel with socket.sendfile. The server runs in its own
+subprocess so only its CPU time is counted, not the client's.
+
+Usage: python3 benchmarks/bench_sendfile.py [--size-mb 50] [--downloads 20]
+"""
+
+import argparse
+import http.client
+import http.server
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+def child(mode):
+    """Serve the current directory; print CPU time used between two lines on stdin"""
+    import server
+
+    if mode == 'copy':
+        class Handler(server.PictureHandler):
+            send_head = http.server.SimpleHTTPRequestHandler.send_head
+            copyfile = http.server.SimpleHTTPRequestHandler.copyfile
+    else:
+        Handler = server.PictureHandler
+    httpd = server.PictureServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print(httpd.server_address[1], flush=True)
+
+    sys.stdin.readline()
+    before = os.times()
+    sys.stdin.readline()
+    after = os.times()
+    print(json.dumps({'user': after.user - before.user, 'system': after.system - before.system}), flush=True)
+    httpd.shutdown()
+
+
+def download(port, path):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    conn.request('GET', path)
+    response = conn.getresponse()
+    received = 0
+    while chunk := response.read(1024 * 1024):
+        received += len(chunk)
+    conn.close()
+    return received
+
+
+def run(mode, args):
+    proc = subprocess.Popen([sys.executable, __file__, '--child', mode],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    port = int(proc.stdout.readline())
+    proc.stdin.write('start\n')
+    proc.stdin.flush()
+
+    started = time.perf_counter()
+    received = sum(download(port, '/pictures/bench.jpg') for _ in range(args.downloads))
+    elapsed = time.perf_counter() - started
+
+    proc.stdin.write('stop\n')
+    proc.stdin.flush()
+    cpu = json.loads(proc.stdout.readline())
+    proc.stdin.close()
+    proc.wait()
+
+    cpu_ms = (cpu['user'] + cpu['system']) * 1000 / args.downloads
+    print(f"{mode:>9}: {received / elapsed / (1024 * 1024):8.1f} MB/s  "
+          f"server CPU {cpu_ms:7.1f} ms per transfer "
+          f"(user {cpu['user']:.2f} s, system {cpu['system']:.2f} s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=50, help="size of the picture")
+    parser.add_argument('--downloads', type=int, default=20, help="number of times it is downloaded")
+    parser.add_argument('--child', choices=['copy', 'sendfile'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        return
+
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        Path('pictures').mkdir()
+        with open('pictures/bench.jpg', 'wb') as f:
+            f.write(os.urandom(args.size_mb * 1024 * 1024))
+        print(f"{args.downloads} downloads of a {args.size_mb} MB picture")
+        for mode in ('copy', 'sendfile'):
+            run(mode, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Command line client for the slideshow server's countdown.
+
+Uses only the standard library, so it starts in a few milliseconds even on a
+Raspberry Pi:
+
+  python3 countdown_cli.py show
+  python3 countdown_cli.py set "Round 2 finishes in" 10m
+  python3 countdown_cli.py at 12:05 "Round 1 finishes at"
+  python3 countdown_cli.py --room hall-2 set "Final round ends in" 300
+  python3 countdown_cli.py batch day.txt        # or - to read stdin
+
+Without --url the server is found by trying ports 8000-8009 on --host. Every
+command in a run goes over one reused connection.
+
+A batch file has one command per line, written as on the command line. Blank
+lines and lines starting with # are skipped, and "room NAME" switches the
+room for the lines that follow it.
+"""
+
+import argparse
+import http.client
+import json
+import re
+import shlex
+import sys
+import urllib.parse
+
+DISCOVERY_PORTS = range(8000, 8010)
+# A local server answers well within this; a closed port is refused at once
+DISCOVERY_TIMEOUT = 0.5
+DEFAULT_TIMEOUT = 5
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600}
+
+
+class CommandError(Exception):
+    """A command that could not be parsed, sent or carried out"""
+
+
+class CountdownClient:
+    """Sends API requests to one server over a single keep-alive connection"""
+
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT, room=None):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme != 'http' or not parts.hostname:
+            raise CommandError(f"Not an http:// URL: {url}")
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+        self.prefix = parts.path.rstrip('/')
+        self.room = room
+
+    def request(self, method, path, payload=None):
+        """Send a request and return its JSON response; raises CommandError on failure"""
+        if self.room:
+            path += ('&' if '?' in path else '?') + 'room=' + urllib.parse.quote(self.room)
+        body = json.dumps(payload).encode() if payload is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        try:
+            try:
+                response, data = self._send(method, path, body, headers)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # The server dropped the idle connection; countdown updates are
+                # safe to repeat, so send it again on a fresh one
+                self.connection.close()
+                response, data = self._send(method, path, body, headers)
+        except (OSError, http.client.HTTPException) as e:
+            self.connection.close()
+            raise CommandError(f"Could not reach the server: {e}") from None
+
+        try:
+            result = json.loads(data)
+        except ValueError:
+            raise CommandError(f"HTTP {response.status}: {data[:200].decode(errors='replace')}") from None
+        if response.status != 200 or (isinstance(result, dict) and result.get('success') is False):
+            raise CommandError(result.get('error') if isinstance(result, dict) and result.get('error')
+                               else f"HTTP {response.status}")
+        return result
+
+    def _send(self, method, path, body, headers):
+        # HTTPConnection reconnects by itself if the server closed the connection
+        self.connection.request(method, self.prefix + path, body, headers)
+        response = self.connection.getresponse()
+        return response, response.read()
+
+    def close(self):
+        self.connection.close()
+
+
+def discover(host, ports=DISCOVERY_PORTS):
+    """Return the URL of the first port on host where the slideshow server answers, or None"""
+    for port in ports:
+        connection = http.client.HTTPConnection(host, port, timeout=DISCOVERY_TIMEOUT)
+        try:
+            connection.request('GET', '/api/countdown')
+            response = connection.getresponse()
+            data = response.read()
+            if response.status == 200 and 'text' in json.loads(data):
+                return f'http://{host}:{port}'
+        except (OSError, ValueError, TypeError, http.client.HTTPException):
+            pass
+        finally:
+            connection.close()
+    return None
+
+
+def parse_duration(value):
+    """Parse a duration such as 600, 90s, 10m or 1h into seconds"""
+    match = re.match(r'^(\d+)([smh]?)$', value.strip().lower())
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid duration {value!r}, use e.g. 600, 10m or 1h")
+    return int(match.group(1)) * DURATION_UNITS[match.group(2) or 's']
+
+
+def format_countdown(state):
+    minutes, seconds = divmod(state['duration'], 60)
+    hours, minutes = divmod(minutes, 60)
+    remaining = f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+    line = f"{state['text']} {remaining}"
+    if state.get('target_time'):
+        line += f" (until {state['target_time']})"
+    return line
+
+
+class _Parser(argparse.ArgumentParser):
+    """Reports bad arguments as a CommandError, so one bad batch line does not end the run"""
+
+    def error(self, message):
+        raise CommandError(message)
+
+
+def build_parser():
+    parser = _Parser(description="Show or change the slideshow countdown",
+                     epilog=__doc__.split('\n\n', 2)[2], formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help="server URL, e.g. http://192.168.1.20:8000 (default: look for it)")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="host searched for the server on ports 8000-8009 (default: %(default)s)")
+    parser.add_argument('--room', help="room to change (default: the default room)")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help="seconds to wait for the server (default: %(default)s)")
+    parser.add_argument('-q', '--quiet', action='store_true', help="only report errors")
+    commands = parser.add_subparsers(dest='command', metavar='command')
+
+    commands.add_parser('show', help="print the current countdown")
+
+    set_parser = commands.add_parser('set', help="set the text and/or duration")
+    set_parser.add_argument('text', help="countdown text; \"\" keeps the current one")
+    set_parser.add_argument('duration', nargs='?', type=parse_duration,
+                            help="seconds, or with a unit: 90s, 10m, 1h")
+
+    at_parser = commands.add_parser('at', help="count down to a time of day")
+    at_parser.add_argument('time', help="HH:MM, 24-hour")
+    at_parser.add_argument('text', nargs='?', default="Round finishes at", help="countdown text")
+
+    room_parser = commands.add_parser('room', help="switch room (useful in batch files)")
+    room_parser.add_argument('name', help="room name; \"\" for the default room")
+
+    batch_parser = commands.add_parser('batch', help="run one command per line from a file")
+    batch_parser.add_argument('file', nargs='?', default='-', help="file to read, or - for stdin (default)")
+    return parser
+
+
+def run_command(client, args, quiet=False):
+    """Carry out one parsed command; raises CommandError on failure"""
+    if args.command in (None, 'show'):
+        print(format_countdown(client.request('GET', '/api/countdown')))
+        return
+    if args.command == 'room':
+        client.room = args.name or None
+        return
+    if args.command == 'set':
+        payload = {}
+        if args.text:
+            payload['text'] = args.text
+        if args.duration is not None:
+            payload['duration'] = args.duration
+        if not payload:
+            raise CommandError("nothing to change")
+    elif args.command == 'at':
+        payload = {'target_time': args.time, 'text': args.text}
+    else:
+        raise CommandError(f"{args.command} cannot be used here")
+
+    result = client.request('POST', '/api/countdown', payload)
+    if not quiet:
+        print(f"✅ {format_countdown(result)}")
+
+
+def run_batch(client, parser, lines, quiet=False):
+    """Run every command in lines; returns the number of commands that failed"""
+    failures = 0
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            args = parser.parse_args(shlex.split(line))
+            if args.command == 'batch':
+                raise CommandError("batch files cannot run other batch files")
+            # --room on a line only applies to that line
+            room = client.room
+            if args.room:
+                client.room = args.room
+            try:
+                run_command(client, args, quiet or args.quiet)
+            finally:
+                if args.room:
+                    client.room = room
+        except (CommandError, ValueError) as e:
+            print(f"❌ line {number}: {e}", file=sys.stderr)
+            failures += 1
+    return failures
+
+
+def main(argv=None):
+    parser = build_parser()
+    try:
+        args = parser.parse_args(argv)
+    except CommandError as e:
+        parser.print_usage(sys.stderr)
+        print(f"{parser.prog}: error: {e}", file=sys.stderr)
+        return 2
+
+    url = args.url or discover(args.host)
+    if not url:
+        print(f"❌ No slideshow server found on {args.host} ports 8000-8009. "
+              f"Start it with python3 server.py, or pass --url", file=sys.stderr)
+        return 1
+
+    try:
+        client = CountdownClient(url, args.timeout, args.room)
+        try:
+            if args.command == 'batch':
+                if args.file == '-':
+                    return 1 if run_batch(client, parser, sys.stdin, args.quiet) else 0
+                with open(args.file) as f:
+                    return 1 if run_batch(client, parser, f, args.quiet) else 0
+            run_command(client, args, args.quiet)
+        finally:
+            client.close()
+    except (CommandError, OSError) as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""
+Server-Sent Events support for the slideshow server.
+
+State-changing handlers publish an event here; every display connected to
+/api/events gets it pushed straight away instead of polling for it.
+"""
+
+import json
+import threading
+
+# How many recent events are kept so a reconnecting display can catch up
+EVENT_HISTORY = 100
+# Seconds between keep-alive comments on an idle stream
+HEARTBEAT_SECONDS = 15
+# Upper bound on simultaneously open event streams
+MAX_EVENT_STREAMS = 200
+
+
+class EventBroadcaster:
+    """Fans out named JSON events to every open event stream.
+
+    Broadcasters can be given one stream_slots semaphore to share, so several
+    of them together stay within a single limit on open streams.
+    """
+
+    def __init__(self, history=EVENT_HISTORY, max_streams=MAX_EVENT_STREAMS, stream_slots=None):
+        self._changed = threading.Condition()
+        self._events = []
+        self._history = history
+        self._last_id = 0
+        self._closed = False
+        self._stream_slots = stream_slots or threading.BoundedSemaphore(max_streams)
+        self._open_streams = 0
+
+    @property
+    def last_id(self):
+        with self._changed:
+            return self._last_id
+
+    def publish(self, name, data):
+        """Record an event and wake up every waiting stream"""
+        payload = json.dumps(data)
+        with self._changed:
+            self._last_id += 1
+            self._events.append((self._last_id, name, payload))
+            del self._events[:-self._history]
+            self._changed.notify_all()
+
+    def events_after(self, event_id, timeout):
+        """Wait up to timeout seconds for events newer than event_id.
+
+        Returns the new events, or None once the broadcaster has been closed.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self._closed or self._last_id > event_id, timeout)
+            if self._closed:
+                return None
+            return [event for event in self._events if event[0] > event_id]
+
+    @property
+    def open_streams(self):
+        with self._changed:
+            return self._open_streams
+
+    def open_stream(self):
+        """Reserve a stream slot; returns False when too many streams are open"""
+        if not self._stream_slots.acquire(blocking=False):
+            return False
+        with self._changed:
+            self._open_streams += 1
+        return True
+
+    def close_stream(self):
+        with self._changed:
+            self._open_streams -= 1
+        self._stream_slots.release()
+
+    def close(self):
+        """End every open stream, used on server shutdown"""
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+
+
+def format_event(event_id, name, payload):
+    """Encode one event in text/event-stream format"""
+    return f"id: {event_id}\nevent: {name}\ndata: {payload}\n\n".encode()
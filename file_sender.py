@@ -0,0 +1,67 @@
+"""
+Sending pictures from disk: byte ranges and zero-copy transfers.
+
+Pictures are sent with socket.sendfile, which hands the copy to the kernel
+(os.sendfile) where the platform supports it instead of pushing every byte
+through Python. Single byte ranges are supported so a display whose Wi-Fi
+drops in the middle of a large picture can resume where it stopped.
+"""
+
+import re
+
+_RANGE_RE = re.compile(r'^bytes=\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+class RangeNotSatisfiable(ValueError):
+    """The requested range lies entirely outside the file"""
+
+
+def parse_range(header, size):
+    """Return (start, end) with end inclusive for a single-range Range header.
+
+    Returns None when the whole file should be sent instead: no header, a
+    header that cannot be parsed, or several ranges, which are not supported.
+    Raises RangeNotSatisfiable when the range does not overlap the file.
+    """
+    if not header:
+        return None
+    match = _RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # A suffix range: the last N bytes of the file
+        length = int(last)
+        if length == 0 or size == 0:
+            raise RangeNotSatisfiable(header)
+        return max(0, size - length), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable(header)
+    end = int(last) if last else size - 1
+    return start, min(end, size - 1)
+
+
+class FileSlice:
+    """An open file and the part of it that makes up the response body"""
+
+    def __init__(self, file, offset, length):
+        self.file = file
+        self.offset = offset
+        self.length = length
+
+    def send_to(self, connection):
+        """Write the slice to a socket, using the kernel's sendfile when possible.
+
+        Returns the number of bytes sent.
+        """
+        if not self.length:
+            return 0
+        return connection.sendfile(self.file, self.offset, self.length)
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,150 @@
+"""
+Picture dimensions read straight from file headers.
+
+Only the headers are read and nothing is decoded, so this is cheap enough to
+do for every picture in the listing. PNG, JPEG, GIF, WebP and BMP are
+understood; other files just report their size. Results are cached until a
+file's mtime or size changes.
+"""
+
+import os
+import struct
+
+# Enough for every format except JPEG, which is walked segment by segment
+HEADER_BYTES = 32
+# EXIF orientations that rotate the picture by 90 degrees
+_ROTATED_ORIENTATIONS = {5, 6, 7, 8}
+# JPEG start-of-frame markers; C4, C8 and CC share the range but are not frames
+_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def read_image_info(path):
+    """Return {'format', 'width', 'height'} for a picture, or None if unrecognised.
+
+    Width and height are as displayed, so JPEGs rotated by EXIF are swapped.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(HEADER_BYTES)
+        try:
+            if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+                width, height = struct.unpack('>II', head[16:24])
+                return _info('png', width, height)
+            if head[:6] in (b'GIF87a', b'GIF89a'):
+                width, height = struct.unpack('<HH', head[6:10])
+                return _info('gif', width, height)
+            if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+                return _webp_info(head)
+            if head.startswith(b'BM'):
+                return _bmp_info(head)
+            if head.startswith(b'\xff\xd8'):
+                f.seek(2)
+                return _jpeg_info(f)
+        except struct.error:
+            pass  # Truncated header
+    return None
+
+
+def _info(image_format, width, height):
+    return {'format': image_format, 'width': width, 'height': height}
+
+
+def _webp_info(head):
+    chunk = head[12:16]
+    if chunk == b'VP8 ':
+        width, height = struct.unpack('<HH', head[26:30])
+        return _info('webp', width & 0x3FFF, height & 0x3FFF)
+    if chunk == b'VP8L':
+        bits, = struct.unpack('<I', head[21:25])
+        return _info('webp', (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1)
+    if chunk == b'VP8X':
+        width = int.from_bytes(head[24:27], 'little') + 1
+        height = int.from_bytes(head[27:30], 'little') + 1
+        return _info('webp', width, height)
+    return None
+
+
+def _bmp_info(head):
+    header_size, = struct.unpack('<I', head[14:18])
+    if header_size == 12:
+        width, height = struct.unpack('<HH', head[18:22])
+    else:
+        width, height = struct.unpack('<ii', head[18:26])
+    # A negative height means the rows are stored top-down
+    return _info('bmp', abs(width), abs(height))
+
+
+def _jpeg_info(f):
+    orientation = 1
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b'\xff':
+            continue
+        marker = f.read(1)
+        while marker == b'\xff':  # Fill bytes
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker == 0xD8 or marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            continue  # Markers without a length
+        if marker == 0xD9:
+            return None
+        length, = struct.unpack('>H', f.read(2))
+        if length < 2:
+            return None
+        if marker in _SOF_MARKERS:
+            _, height, width = struct.unpack('>BHH', f.read(5))
+            if orientation in _ROTATED_ORIENTATIONS:
+                width, height = height, width
+            return _info('jpeg', width, height)
+        segment_start = f.tell()
+        if marker == 0xE1:
+            orientation = _exif_orientation(f.read(length - 2)) or orientation
+        f.seek(segment_start + length - 2)
+
+
+def _exif_orientation(segment):
+    """Return the orientation tag from an APP1 EXIF segment, or None"""
+    if not segment.startswith(b'Exif\0\0'):
+        return None
+    tiff = segment[6:]
+    endian = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if not endian:
+        return None
+    ifd_offset, = struct.unpack(endian + 'I', tiff[4:8])
+    entries, = struct.unpack(endian + 'H', tiff[ifd_offset:ifd_offset + 2])
+    for n in range(entries):
+        entry = ifd_offset + 2 + n * 12
+        tag, _, _, value = struct.unpack(endian + 'HHIH', tiff[entry:entry + 10])
+        if tag == 0x0112:
+            return value
+    return None
+
+
+class ImageInfoCache:
+    """Header information of pictures, reused until a file's mtime or size changes"""
+
+    def __init__(self):
+        # absolute path -> (mtime_ns, size, info)
+        self._entries = {}
+
+    def info(self, path):
+        """Return {'bytes', 'format', 'width', 'height'} for a picture; only
+        'bytes' is present for formats that are not recognised"""
+        path = os.path.abspath(path)
+        file_stat = os.stat(path)
+        cached = self._entries.get(path)
+        if cached and cached[:2] == (file_stat.st_mtime_ns, file_stat.st_size):
+            return cached[2]
+        try:
+            info = read_image_info(path) or {}
+        except OSError:
+            info = {}
+        info = {'bytes': file_stat.st_size, **info}
+        self._entries[path] = (file_stat.st_mtime_ns, file_stat.st_size, info)
+        return info
+
+    def forget(self, path):
+        self._entries.pop(os.path.abspath(path), None)
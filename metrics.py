@@ -0,0 +1,158 @@
+"""
+Request metrics for the slideshow server, in the Prometheus text format.
+
+Counters and histograms are plain numbers updated under a single lock, so
+recording a request costs a few dictionary lookups. Gauges such as the number
+of requests in progress are passed in by the caller when /api/metrics is
+scraped.
+"""
+
+import bisect
+import threading
+import time
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+UPLOAD_SIZE_BUCKETS = tuple(2 ** n * 64 * 1024 for n in range(0, 13, 2))  # 64 KiB .. 256 MiB
+# A display that made a request, or was sent an event or heartbeat, this
+# recently counts as connected
+DISPLAY_SEEN_SECONDS = 60
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    """Counts of observations per bucket, plus their sum"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        # Buckets are inclusive upper bounds, as Prometheus expects
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{_labels(labels, le=bound)} {cumulative}'
+        yield f'{name}_sum{_labels(labels)} {self.sum:.6f}'
+        yield f'{name}_count{_labels(labels)} {cumulative}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in items) + '}'
+
+
+class Metrics:
+    """Counters for every request the server handles"""
+
+    def __init__(self, prefix='slideshow'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._bytes = {}
+        self._latency = {}
+        self._upload_bytes = Histogram(UPLOAD_SIZE_BUCKETS)
+        self._upload_seconds = Histogram(LATENCY_BUCKETS)
+        self._upload_errors = 0
+        self._displays = {}
+        self._started = time.time()
+
+    def observe_request(self, method, route, status, seconds, bytes_sent):
+        """Record one finished request"""
+        with self._lock:
+            key = (method, route, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            key = (method, route)
+            self._bytes[key] = self._bytes.get(key, 0) + bytes_sent
+            histogram = self._latency.get(key)
+            if histogram is None:
+                histogram = self._latency[key] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(seconds)
+
+    def observe_upload(self, size, seconds, ok=True):
+        """Record the size of an upload request and how long parsing it took"""
+        with self._lock:
+            self._upload_bytes.observe(size)
+            self._upload_seconds.observe(seconds)
+            if not ok:
+                self._upload_errors += 1
+
+    def display_seen(self, address):
+        """Note that a display at this address asked for slideshow state or is listening for it"""
+        now = time.monotonic()
+        with self._lock:
+            self._displays[address] = now
+
+    def render(self, gauges=()):
+        """Return every metric in the Prometheus text format.
+
+        gauges is a list of (name, help, value) for values the caller tracks.
+        """
+        p = self.prefix
+        with self._lock:
+            cutoff = time.monotonic() - DISPLAY_SEEN_SECONDS
+            for address in [a for a, seen in self._displays.items() if seen < cutoff]:
+                del self._displays[address]
+
+            lines = [f'# HELP {p}_http_requests_total Requests handled, by route and status',
+                     f'# TYPE {p}_http_requests_total counter']
+            for (method, route, status), count in sorted(self._requests.items()):
+                lines.append(f'{p}_http_requests_total'
+                             f'{_labels((("method", method), ("route", route), ("status", status)))} {count}')
+
+            lines += [f'# HELP {p}_http_response_bytes_total Response bytes sent, by route',
+                      f'# TYPE {p}_http_response_bytes_total counter']
+            for (method, route), count in sorted(self._bytes.items()):
+                lines.append(f'{p}_http_response_bytes_total{_labels((("method", method), ("route", route)))} {count}')
+
+            lines += [f'# HELP {p}_http_request_duration_seconds Time to handle a request, by route',
+                      f'# TYPE {p}_http_request_duration_seconds histogram']
+            for (method, route), histogram in sorted(self._latency.items()):
+                lines.extend(histogram.lines(f'{p}_http_request_duration_seconds',
+                                             (('method', method), ('route', route))))
+
+            lines += [f'# HELP {p}_upload_request_bytes Size of upload requests',
+                      f'# TYPE {p}_upload_request_bytes histogram']
+            lines.extend(self._upload_bytes.lines(f'{p}_upload_request_bytes', ()))
+            lines += [f'# HELP {p}_upload_parse_seconds Time to stream an upload request to disk',
+                      f'# TYPE {p}_upload_parse_seconds histogram']
+            lines.extend(self._upload_seconds.lines(f'{p}_upload_parse_seconds', ()))
+            lines += [f'# HELP {p}_upload_errors_total Upload requests that could not be parsed',
+                      f'# TYPE {p}_upload_errors_total counter',
+                      f'{p}_upload_errors_total {self._upload_errors}']
+
+            gauges = [('displays', f'Displays that asked for slideshow state, or had an event stream '
+                                   f'open, in the last {DISPLAY_SEEN_SECONDS} s', len(self._displays)),
+                      ('start_time_seconds', 'When the server started, as a Unix timestamp', self._started),
+                      *gauges]
+        for name, help_text, value in gauges:
+            lines += [f'# HELP {p}_{name} {help_text}',
+                      f'# TYPE {p}_{name} gauge',
+                      f'{p}_{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+class CountingWriter:
+    """Wraps a handler's wfile and counts the bytes written through it"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_written = 0
+
+    def write(self, data):
+        written = self.raw.write(data)
+        self.bytes_written += len(data) if written is None else written
+        return written
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
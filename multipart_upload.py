@@ -0,0 +1,251 @@
+"""
+Streaming multipart/form-data parser for the upload endpoints.
+
+The request body is read in fixed-size chunks and every file part is written
+straight to a temporary file next to its destination, so memory use stays
+flat no matter how large the upload is. Each file is hashed as it streams in,
+so duplicates can be spotted without reading it again. Callers move the
+temporary files into place with UploadedFile.save_as, which is an atomic rename.
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+import urllib.parse
+from pathlib import Path
+
+CHUNK_SIZE = 64 * 1024
+# Default cap on the size of one upload request
+DEFAULT_MAX_UPLOAD_BYTES = 100 * 1024 * 1024
+# Part headers and plain form fields are small; anything bigger is malformed
+MAX_HEADER_BYTES = 16 * 1024
+MAX_FIELD_BYTES = 64 * 1024
+
+# A header parameter: name=token or name="quoted string", where a quoted
+# string may hold ; and backslash-escaped quotes
+_PARAM_RE = re.compile(r';\s*([\w*-]+)\s*=\s*(?:"((?:[^"\\]|\\.)*)"|([^;\s]*))')
+
+# Temporary files are private; saved files get the usual permissions
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+class UploadError(ValueError):
+    """The upload request could not be parsed"""
+
+
+class UploadTooLarge(UploadError):
+    """The upload request is bigger than the configured maximum"""
+
+
+class UploadedFile:
+    """A file part that has been streamed to a temporary file"""
+
+    def __init__(self, field_name, filename, content_type, temp_path, size, sha256):
+        self.field_name = field_name
+        self.filename = filename
+        self.content_type = content_type
+        self.temp_path = temp_path
+        self.size = size
+        # Hex SHA-256 of the file's content
+        self.sha256 = sha256
+
+    def save_as(self, path):
+        """Atomically move the uploaded data to its final location"""
+        os.chmod(self.temp_path, 0o666 & ~_UMASK)
+        os.replace(self.temp_path, path)
+        self.temp_path = None
+
+    def discard(self):
+        """Remove the temporary file if it was not saved"""
+        if self.temp_path:
+            try:
+                os.unlink(self.temp_path)
+            except FileNotFoundError:
+                pass
+            self.temp_path = None
+
+
+def safe_filename(filename):
+    """Strip any directory components a client put in an upload filename"""
+    name = Path(filename.replace('\\', '/')).name
+    if name in ('', '.', '..'):
+        raise UploadError("Invalid filename")
+    return name
+
+
+def _parse_params(header):
+    """Return a header's parameters by lower-cased name.
+
+    An extended name*=charset'language'value (RFC 5987), as sent for
+    filenames that are not ASCII, is decoded and replaces the plain one.
+    """
+    params = {}
+    extended = {}
+    for key, quoted, token in _PARAM_RE.findall(header):
+        key = key.lower()
+        if key.endswith('*'):
+            charset, _, rest = token.partition("'")
+            _, _, value = rest.partition("'")
+            try:
+                extended[key[:-1]] = urllib.parse.unquote(value, encoding=charset or 'utf-8', errors='strict')
+            except (LookupError, UnicodeDecodeError):
+                continue
+        elif quoted or not token:
+            # Only \\ and \" are undone: old browsers send Windows paths unescaped
+            params[key] = re.sub(r'\\([\\"])', r'\1', quoted)
+        else:
+            params[key] = token
+    params.update(extended)
+    return params
+
+
+def parse_boundary(content_type):
+    """Return the multipart boundary from a Content-Type header"""
+    if not content_type.startswith('multipart/form-data'):
+        raise UploadError("Expected multipart/form-data")
+    params = _parse_params(content_type)
+    boundary = params.get('boundary')
+    if not boundary:
+        raise UploadError("Missing multipart boundary")
+    return boundary.encode('latin-1')
+
+
+def _parse_part_headers(raw):
+    headers = {}
+    for line in raw.decode('utf-8', 'replace').split('\r\n'):
+        key, _, value = line.partition(':')
+        headers[key.strip().lower()] = value.strip()
+    disposition = headers.get('content-disposition', '')
+    params = _parse_params(disposition)
+    return params.get('name'), params.get('filename'), headers.get('content-type', '')
+
+
+class _BodyReader:
+    """Reads at most content_length bytes from the request stream in chunks"""
+
+    def __init__(self, stream, content_length):
+        self.stream = stream
+        self.remaining = content_length
+        self.bytes_read = 0
+
+    def read_chunk(self):
+        if self.remaining <= 0:
+            return b''
+        chunk = self.stream.read(min(CHUNK_SIZE, self.remaining))
+        if not chunk:
+            raise UploadError("Upload ended early")
+        self.remaining -= len(chunk)
+        self.bytes_read += len(chunk)
+        return chunk
+
+
+def parse_multipart(stream, content_type, content_length, temp_dir,
+                    max_bytes=DEFAULT_MAX_UPLOAD_BYTES):
+    """Stream a multipart/form-data body into temporary files.
+
+    Returns (files, fields): a list of UploadedFile for every non-empty file
+    part, and a dict of the plain form fields. Temporary files are created in
+    temp_dir so that saving them is a rename on the same filesystem.
+    """
+    boundary = parse_boundary(content_type)
+    if content_length <= 0:
+        raise UploadError("Missing request body")
+    if content_length > max_bytes:
+        raise UploadTooLarge(f"Upload is larger than the {max_bytes // (1024 * 1024)} MB limit")
+
+    reader = _BodyReader(stream, content_length)
+    delimiter = b'\r\n--' + boundary
+    # The first boundary has no leading CRLF, so pretend one was read
+    buffer = b'\r\n'
+    files = []
+    fields = {}
+
+    try:
+        # Skip the preamble up to the first boundary
+        while True:
+            position = buffer.find(delimiter)
+            if position >= 0:
+                buffer = buffer[position + len(delimiter):]
+                break
+            buffer = buffer[-len(delimiter):] + reader.read_chunk()
+            if reader.remaining <= 0 and buffer.find(delimiter) < 0:
+                raise UploadError("No multipart boundary found")
+
+        while True:
+            # After a boundary comes either "--" (the end) or CRLF and part headers
+            while len(buffer) < 2 and reader.remaining > 0:
+                buffer += reader.read_chunk()
+            if buffer.startswith(b'--'):
+                # Drain the epilogue so the connection is left at the next request
+                while reader.read_chunk():
+                    pass
+                break
+            while (header_end := buffer.find(b'\r\n\r\n')) < 0:
+                if len(buffer) > MAX_HEADER_BYTES:
+                    raise UploadError("Multipart headers too large")
+                chunk = reader.read_chunk()
+                if not chunk:
+                    raise UploadError("Malformed multipart headers")
+                buffer += chunk
+            name, filename, part_type = _parse_part_headers(buffer[2:header_end])
+            buffer = buffer[header_end + 4:]
+            if filename:
+                filename = safe_filename(filename)
+
+            if filename is not None:
+                sink = tempfile.NamedTemporaryFile(dir=temp_dir, prefix='.upload-',
+                                                   suffix='.part', delete=False)
+                digest = hashlib.sha256()
+            else:
+                sink = None
+                value = bytearray()
+            size = 0
+
+            try:
+                # Copy data until the next boundary, holding back enough bytes
+                # to recognise a boundary split across two chunks
+                while True:
+                    position = buffer.find(delimiter)
+                    if position >= 0:
+                        data, buffer = buffer[:position], buffer[position + len(delimiter):]
+                    else:
+                        keep = len(delimiter) - 1
+                        data, buffer = buffer[:-keep], buffer[-keep:]
+                    if data:
+                        size += len(data)
+                        if sink:
+                            sink.write(data)
+                            digest.update(data)
+                        else:
+                            value += data
+                            if len(value) > MAX_FIELD_BYTES:
+                                raise UploadError(f"Form field {name!r} too large")
+                    if position >= 0:
+                        break
+                    chunk = reader.read_chunk()
+                    if not chunk:
+                        raise UploadError("Upload ended before the closing boundary")
+                    buffer += chunk
+            except BaseException:
+                if sink:
+                    sink.close()
+                    os.unlink(sink.name)
+                raise
+
+            if sink:
+                sink.close()
+                if filename and size:
+                    files.append(UploadedFile(name, filename, part_type, sink.name, size,
+                                              digest.hexdigest()))
+                else:
+                    os.unlink(sink.name)
+            elif name is not None:
+                fields[name] = value.decode('utf-8', 'replace')
+    except BaseException:
+        for upload in files:
+            upload.discard()
+        raise
+
+    return files, fields
@@ -0,0 +1,331 @@
+"""
+In-memory index of the pictures shown in the slideshow.
+
+The folder is scanned once; after that the upload and delete handlers keep the
+index up to date themselves. Files copied into the folder by hand are picked
+up by comparing the directory's modification time, which costs a single stat
+per listing instead of a stat per file.
+
+Content digests are computed on demand and cached until a file changes. They
+give every picture a fingerprinted URL and spot the same picture being
+uploaded twice. They are also kept in the folder's .digests.json, so a restart
+does not have to read every picture again.
+
+PictureFolder puts the index, the digests and the picture headers behind the
+same methods as the packed store in picture_pack.py, so the server can keep a
+room's pictures in either.
+"""
+
+import bisect
+import hashlib
+import os
+import threading
+import time
+from pathlib import Path
+
+from image_info import ImageInfoCache
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp'}
+
+# The custom slide's background image lives in a subfolder of the pictures,
+# named background_main_slide with any of these extensions
+BACKGROUND_DIR = 'main_slide_bg'
+BACKGROUND_NAME = 'background_main_slide'
+BACKGROUND_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp']
+BACKGROUND_NAMES = [f'{BACKGROUND_DIR}/{BACKGROUND_NAME}{ext}' for ext in BACKGROUND_EXTENSIONS]
+
+# Filesystems like FAT only record modification times to the nearest couple of
+# seconds, so a change made that soon after a scan might not move the mtime
+MTIME_GRANULARITY_SECONDS = 2
+
+# The content digests of a folder's pictures, with the mtime and size they were
+# taken at, saved for the next run
+DIGESTS_NAME = '.digests.json'
+
+
+def file_digest(path):
+    """Return the hex SHA-256 of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DigestCache:
+    """Content digests of files, reused until a file's mtime or size changes"""
+
+    def __init__(self):
+        # absolute path -> (mtime_ns, size, digest)
+        self._digests = {}
+
+    def digest(self, path, file_stat=None):
+        """Return the file's digest, reading the file only if it changed"""
+        path = os.path.abspath(path)
+        if file_stat is None:
+            file_stat = os.stat(path)
+        known = self.known(path, file_stat)
+        if known:
+            return known
+        digest = file_digest(path)
+        # Only cache the digest if the file did not change while it was read
+        after = os.stat(path)
+        if (after.st_mtime_ns, after.st_size) == (file_stat.st_mtime_ns, file_stat.st_size):
+            self._digests[path] = (file_stat.st_mtime_ns, file_stat.st_size, digest)
+        return digest
+
+    def known(self, path, file_stat):
+        """Return the digest if it is cached for the file as it is now, without reading it"""
+        cached = self._digests.get(os.path.abspath(path))
+        if cached and cached[:2] == (file_stat.st_mtime_ns, file_stat.st_size):
+            return cached[2]
+        return None
+
+    def entry(self, path):
+        """Return (mtime_ns, size, digest) as cached for a file, or None"""
+        return self._digests.get(os.path.abspath(path))
+
+    def remember(self, path, mtime_ns, size, digest):
+        """Take a digest saved by an earlier run; it is only used while the file still has that mtime and size"""
+        self._digests.setdefault(os.path.abspath(path), (mtime_ns, size, digest))
+
+    def record(self, path, digest):
+        """Remember the digest of a file the server has just written"""
+        file_stat = os.stat(path)
+        self._digests[os.path.abspath(path)] = (file_stat.st_mtime_ns, file_stat.st_size, digest)
+
+    def forget(self, path):
+        self._digests.pop(os.path.abspath(path), None)
+
+
+def is_slide_picture(name):
+    """Whether a file in the pictures folder should be shown as a slide"""
+    return (Path(name).suffix.lower() in IMAGE_EXTENSIONS and
+            not name.startswith('background_main_slide'))
+
+
+class PictureIndex:
+    """Sorted list of slide pictures in a directory, rescanned only when it changes"""
+
+    def __init__(self, directory, digests=None):
+        self.directory = Path(directory)
+        self.version = 0
+        self._lock = threading.RLock()
+        self._names = None
+        self._snapshot = ()
+        self._scanned_mtime = None
+        # Content digests of the pictures, shared with the server for fingerprinted URLs;
+        # keyed by absolute path, so several indexes can share one cache
+        self.digests = digests if digests is not None else DigestCache()
+
+    def pictures(self):
+        """Return the sorted picture filenames as a tuple"""
+        with self._lock:
+            mtime = self._directory_mtime()
+            if self._names is None or mtime != self._scanned_mtime or self._mtime_is_recent(mtime):
+                self._rescan(mtime)
+            return self._snapshot
+
+    def snapshot(self):
+        """Return the version and sorted picture filenames, read together"""
+        with self._lock:
+            pictures = self.pictures()
+            return self.version, pictures
+
+    def find_content(self, size, sha256):
+        """Return the name of a picture with exactly this content, or None.
+
+        Only pictures of the same size are hashed, and a digest is reused until
+        its file changes, so this is cheap even for a large folder.
+        """
+        for name in self.pictures():
+            try:
+                file_stat = os.stat(self.directory / name)
+            except FileNotFoundError:
+                continue
+            if file_stat.st_size != size:
+                continue
+            # Hashed outside the lock; at worst two threads hash the same file
+            if self.digests.digest(self.directory / name, file_stat) == sha256:
+                return name
+        return None
+
+    def add(self, name):
+        """Record a picture the server has just written, new or replaced"""
+        if not is_slide_picture(name):
+            return
+        with self._lock:
+            if self._names is None:
+                self._rescan(self._directory_mtime())
+                return
+            position = bisect.bisect_left(self._names, name)
+            if position == len(self._names) or self._names[position] != name:
+                self._names.insert(position, name)
+            # Even a replaced picture changes the listing, since its URL changes
+            self._changed()
+            self._scanned_mtime = self._directory_mtime()
+
+    def remove(self, name):
+        """Record a picture the server has just deleted"""
+        with self._lock:
+            if self._names is None:
+                return
+            position = bisect.bisect_left(self._names, name)
+            if position < len(self._names) and self._names[position] == name:
+                del self._names[position]
+                self._changed()
+            self.digests.forget(self.directory / name)
+            self._scanned_mtime = self._directory_mtime()
+
+    def _directory_mtime(self):
+        try:
+            return self.directory.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _mtime_is_recent(mtime):
+        return mtime is not None and time.time_ns() - mtime < MTIME_GRANULARITY_SECONDS * 1_000_000_000
+
+    def _rescan(self, mtime):
+        # A missing folder is left alone; it is created when a picture is saved
+        if mtime is None:
+            names = []
+        else:
+            names = sorted(entry.name for entry in os.scandir(self.directory)
+                           if entry.is_file() and is_slide_picture(entry.name))
+        if names != self._names:
+            self._names = names
+            self._changed()
+        self._scanned_mtime = mtime
+
+    def _changed(self):
+        self._snapshot = tuple(self._names)
+        self.version += 1
+
+
+class PictureFolder:
+    """A room's pictures and custom slide background, kept as files in a folder.
+
+    Names are relative to the folder: 'photo.jpg' for a slide, or
+    'main_slide_bg/background_main_slide.png' for the background.
+    """
+
+    def __init__(self, directory, digests=None, image_info=None, digest_store=None):
+        self.directory = Path(directory)
+        self.index = PictureIndex(directory, digests)
+        self.digests = self.index.digests
+        self.image_info = image_info if image_info is not None else ImageInfoCache()
+        # A state_store.WriteBehindStore for the digests, read once here and
+        # written by save_digests()
+        self.digest_store = digest_store
+        if digest_store is not None:
+            self._load_digests(digest_store.load())
+
+    def _load_digests(self, saved):
+        if not isinstance(saved, dict):
+            return
+        for name, entry in saved.items():
+            try:
+                mtime_ns, size, digest = entry
+            except (TypeError, ValueError):
+                continue
+            self.digests.remember(self.directory / name, mtime_ns, size, digest)
+
+    def save_digests(self):
+        """Queue the digests known for the pictures and the background to be saved"""
+        if self.digest_store is None:
+            return
+        names = list(self.pictures())
+        background = self.background()
+        if background:
+            names.append(background)
+        saved = {}
+        for name in names:
+            entry = self.digests.entry(self.directory / name)
+            if entry:
+                saved[name] = list(entry)
+        if saved != (self.digest_store.get() or {}):
+            self.digest_store.set(saved or None)
+
+    @property
+    def version(self):
+        return self.index.version
+
+    def pictures(self):
+        return self.index.pictures()
+
+    def snapshot(self):
+        return self.index.snapshot()
+
+    def find_content(self, size, sha256):
+        return self.index.find_content(size, sha256)
+
+    @property
+    def upload_dir(self):
+        """Where uploads are streamed to; on the same filesystem, so saving them is a rename"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        return self.directory
+
+    def digest(self, name):
+        """Return the content digest of a picture, or None if it does not exist"""
+        try:
+            return self.digests.digest(self.directory / name)
+        except OSError:
+            return None
+
+    def info(self, name):
+        """Return the size, format and dimensions of a picture"""
+        try:
+            return self.image_info.info(self.directory / name)
+        except OSError:
+            return {}
+
+    def refresh(self, names=None):
+        """Pick up pictures another process added, replaced or deleted; None means any"""
+        for name in names or ():
+            self.digests.forget(self.directory / name)
+            self.image_info.forget(self.directory / name)
+        self.index.pictures()
+
+    def save(self, upload, name):
+        """Move an uploaded file into place, replacing any picture of the same name"""
+        path = self.directory / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        upload.save_as(path)
+        # The digest is already known, so listing it needs no extra read
+        self.digests.record(path, upload.sha256)
+        if '/' not in name:
+            self.index.add(name)
+
+    def remove(self, name):
+        """Delete a picture; raises ValueError if there is no such file"""
+        path = self.directory / name
+        if not path.exists():
+            raise ValueError("File not found")
+        if not path.is_file():
+            raise ValueError("Not a file")
+        path.unlink()
+        if '/' in name:
+            self.digests.forget(path)
+        else:
+            self.index.remove(name)
+        self.image_info.forget(path)
+
+    def background(self):
+        """Return the name of the custom slide's background image, or None"""
+        if (self.directory / BACKGROUND_DIR).exists():
+            for name in BACKGROUND_NAMES:
+                if (self.directory / name).exists():
+                    return name
+        return None
+
+    def delete_background(self):
+        """Delete the background image and, if it is then empty, its folder"""
+        name = self.background()
+        if name:
+            self.remove(name)
+        try:
+            (self.directory / BACKGROUND_DIR).rmdir()
+        except OSError:
+            pass  # Directory not empty or doesn't exist
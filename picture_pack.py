@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+"""
+Pictures of every room packed into one SQLite database.
+
+On SD cards and network mounts every stat and open of a small file costs a
+round trip. A pack holds the pictures, the custom slide backgrounds and their
+metadata (size, digest, format and dimensions) in a single file. The metadata
+of a room is read once into memory, so listing pictures touches the disk not
+at all. Picture data is read through SQLite's memory-mapped I/O.
+
+Start the server with --pack FILE to use one. This module is also the tool
+that moves pictures between a pack and the plain folder layout:
+
+  python3 picture_pack.py import pictures.db pictures
+  python3 picture_pack.py import pictures.db rooms/hall-2/pictures --room hall-2
+  python3 picture_pack.py export pictures.db exported --room hall-2
+  python3 picture_pack.py list pictures.db
+
+Run it while the server is stopped; the server only reads a pack's metadata
+when it starts.
+"""
+
+import argparse
+import bisect
+import contextlib
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+
+from image_info import read_image_info
+from picture_index import BACKGROUND_DIR, BACKGROUND_NAME, BACKGROUND_NAMES, IMAGE_EXTENSIONS, file_digest, is_slide_picture
+
+# Upper bound on the part of the database SQLite maps into memory; SQLite
+# lowers it to its own compile-time limit if that is smaller
+MMAP_SIZE = 1 << 40
+CHUNK_SIZE = 1024 * 1024
+# Name of the room used when none is given; the server's default room
+DEFAULT_ROOM = 'default'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL
+);
+-- Kept apart from the data so listing a room never reads picture content
+CREATE TABLE IF NOT EXISTS pictures (
+    room TEXT NOT NULL,
+    name TEXT NOT NULL,
+    blob_id INTEGER NOT NULL REFERENCES blobs (id),
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    format TEXT,
+    width INTEGER,
+    height INTEGER,
+    PRIMARY KEY (room, name)
+);
+"""
+
+
+class PackedEntry:
+    """Metadata of one picture in a pack"""
+
+    __slots__ = ('blob_id', 'size', 'sha256', 'mtime', 'info')
+
+    def __init__(self, blob_id, size, sha256, mtime, image_format=None, width=None, height=None):
+        self.blob_id = blob_id
+        self.size = size
+        self.sha256 = sha256
+        self.mtime = mtime
+        self.info = {'bytes': size}
+        if image_format:
+            self.info.update(format=image_format, width=width, height=height)
+
+
+class PicturePack:
+    """A SQLite database holding the pictures of any number of rooms"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        # Connections not in use; each request thread borrows one
+        self._idle = queue.SimpleQueue()
+        # SQLite allows one writer at a time anyway; waiting here is cheaper
+        self._write_lock = threading.Lock()
+        self._rooms = {}
+        self._rooms_lock = threading.Lock()
+        with self.connection() as db:
+            db.executescript(SCHEMA)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        # With WAL this still never corrupts the pack; a power cut can only
+        # lose the last few changes
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+        return db
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a database connection for the length of a with block"""
+        try:
+            db = self._idle.get_nowait()
+        except queue.Empty:
+            db = self._connect()
+        try:
+            yield db
+        finally:
+            self._idle.put(db)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """A connection with a write transaction, committed at the end of the with block"""
+        with self._write_lock, self.connection() as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    def room(self, name):
+        """Return the PackedPictures of a room, loading its metadata the first time"""
+        with self._rooms_lock:
+            pictures = self._rooms.get(name)
+            if pictures is None:
+                pictures = self._rooms[name] = PackedPictures(self, name)
+            return pictures
+
+    def rooms(self):
+        with self.connection() as db:
+            return [row[0] for row in db.execute('SELECT DISTINCT room FROM pictures ORDER BY room')]
+
+    def has_room(self, name):
+        """Whether the pack holds any pictures of a room"""
+        with self.connection() as db:
+            return db.execute('SELECT 1 FROM pictures WHERE room = ? LIMIT 1', (name,)).fetchone() is not None
+
+    def read(self, blob_id, offset, length):
+        """Yield length bytes of a blob, starting at offset, in chunks"""
+        with self.connection() as db:
+            if hasattr(db, 'blobopen'):
+                # Reads straight from the blob's pages, without copying the whole blob
+                with db.blobopen('blobs', 'data', blob_id, readonly=True) as blob:
+                    blob.seek(offset)
+                    while length > 0:
+                        chunk = blob.read(min(CHUNK_SIZE, length))
+                        if not chunk:
+                            break
+                        length -= len(chunk)
+                        yield chunk
+            else:
+                row = db.execute('SELECT substr(data, ?, ?) FROM blobs WHERE id = ?',
+                                 (offset + 1, length, blob_id)).fetchone()
+                if row and row[0]:
+                    yield row[0]
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class BlobSlice:
+    """Part of a packed picture that makes up a response body, like file_sender.FileSlice"""
+
+    def __init__(self, pack, blob_id, offset, length):
+        self.pack = pack
+        self.blob_id = blob_id
+        self.offset = offset
+        self.length = length
+
+    def send_to(self, connection):
+        """Write the slice to a socket; returns the number of bytes sent"""
+        sent = 0
+        for chunk in self.pack.read(self.blob_id, self.offset, self.length):
+            connection.sendall(chunk)
+            sent += len(chunk)
+        return sent
+
+    def close(self):
+        pass
+
+
+class PackedSource:
+    """A packed picture that another process, such as a rendition worker, can read"""
+
+    def __init__(self, path, blob_id):
+        self.path = str(path)
+        self.blob_id = blob_id
+
+    def read(self):
+        db = sqlite3.connect(f'{Path(self.path).resolve().as_uri()}?mode=ro', uri=True)
+        try:
+            row = db.execute('SELECT data FROM blobs WHERE id = ?', (self.blob_id,)).fetchone()
+        finally:
+            db.close()
+        if row is None:
+            raise FileNotFoundError(f"{self.path}: no blob {self.blob_id}")
+        return row[0]
+
+
+class PackedPictures:
+    """One room's pictures in a PicturePack, with the same methods as picture_index.PictureFolder"""
+
+    def __init__(self, pack, room):
+        self.pack = pack
+        self.room = room
+        self.version = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._names = []  # Slide pictures, kept sorted
+        self._snapshot = ()
+        self.refresh()
+
+    @staticmethod
+    def _is_slide(name):
+        return '/' not in name and is_slide_picture(name)
+
+    def _changed(self):
+        self._snapshot = tuple(self._names)
+        self.version += 1
+
+    def refresh(self, names=None):
+        """Read pictures from the pack again, after another process changed them; None means all"""
+        query = 'SELECT name, blob_id, size, sha256, mtime, format, width, height FROM pictures WHERE room = ?'
+        with self.pack.connection() as db:
+            if names is None:
+                rows = db.execute(query, (self.room,)).fetchall()
+            else:
+                rows = [row for name in names
+                        for row in db.execute(query + ' AND name = ?', (self.room, name)).fetchall()]
+        with self._lock:
+            found = {row[0]: PackedEntry(*row[1:]) for row in rows}
+            if names is None:
+                self._entries = found
+                self._names = sorted(name for name in found if self._is_slide(name))
+            else:
+                for name in names:
+                    if name in found:
+                        self._entries[name] = found[name]
+                    else:
+                        self._entries.pop(name, None)
+                self._names = sorted(name for name in self._entries if self._is_slide(name))
+            self._changed()
+
+    def pictures(self):
+        return self._snapshot
+
+    def snapshot(self):
+        with self._lock:
+            return self.version, self._snapshot
+
+    def entry(self, name):
+        """Return the PackedEntry of a picture, or None"""
+        return self._entries.get(name)
+
+    def find_content(self, size, sha256):
+        for name in self._snapshot:
+            entry = self._entries.get(name)
+            if entry and entry.size == size and entry.sha256 == sha256:
+                return name
+        return None
+
+    @property
+    def upload_dir(self):
+        """Where uploads are streamed to before they are copied into the pack"""
+        return self.pack.path.resolve().parent
+
+    def digest(self, name):
+        entry = self._entries.get(name)
+        return entry.sha256 if entry else None
+
+    def info(self, name):
+        entry = self._entries.get(name)
+        return entry.info if entry else {}
+
+    def open(self, name, offset, length):
+        entry = self._entries[name]
+        return BlobSlice(self.pack, entry.blob_id, offset, length)
+
+    def source(self, name):
+        """Return a PackedSource for a picture, or None"""
+        entry = self._entries.get(name)
+        return PackedSource(self.pack.path, entry.blob_id) if entry else None
+
+    def save(self, upload, name):
+        """Copy an uploaded file into the pack, replacing any picture of the same name"""
+        self.add_file(upload.temp_path, name, upload.sha256)
+
+    def add_file(self, path, name, sha256=None, mtime=None):
+        """Copy a file into the pack, replacing any picture of the same name"""
+        file_stat = os.stat(path)
+        size = file_stat.st_size
+        if sha256 is None:
+            sha256 = file_digest(path)
+        try:
+            info = read_image_info(path) or {}
+        except OSError:
+            info = {}
+        mtime = time.time() if mtime is None else mtime
+
+        with self.pack.transaction() as db:
+            self._delete_row(db, name)
+            if hasattr(db, 'blobopen'):
+                # Written in chunks, so a large picture is never held in memory
+                blob_id = db.execute('INSERT INTO blobs (data) VALUES (zeroblob(?))', (size,)).lastrowid
+                with open(path, 'rb') as f, db.blobopen('blobs', 'data', blob_id) as blob:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                        blob.write(chunk)
+            else:
+                with open(path, 'rb') as f:
+                    blob_id = db.execute('INSERT INTO blobs (data) VALUES (?)', (f.read(),)).lastrowid
+            db.execute('INSERT INTO pictures (room, name, blob_id, size, sha256, mtime, format, width, height) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (self.room, name, blob_id, size, sha256, mtime,
+                        info.get('format'), info.get('width'), info.get('height')))
+
+        with self._lock:
+            self._entries[name] = PackedEntry(blob_id, size, sha256, mtime, info.get('format'),
+                                              info.get('width'), info.get('height'))
+            if self._is_slide(name):
+                position = bisect.bisect_left(self._names, name)
+                if position == len(self._names) or self._names[position] != name:
+                    self._names.insert(position, name)
+            # Even a replaced picture changes the listing, since its URL changes
+            self._changed()
+
+    def remove(self, name):
+        """Delete a picture; raises ValueError if there is no such picture"""
+        if name not in self._entries:
+            raise ValueError("File not found")
+        with self.pack.transaction() as db:
+            self._delete_row(db, name)
+        with self._lock:
+            self._entries.pop(name, None)
+            position = bisect.bisect_left(self._names, name)
+            if position < len(self._names) and self._names[position] == name:
+                del self._names[position]
+            self._changed()
+
+    def _delete_row(self, db, name):
+        row = db.execute('SELECT blob_id FROM pictures WHERE room = ? AND name = ?', (self.room, name)).fetchone()
+        if row:
+            db.execute('DELETE FROM pictures WHERE room = ? AND name = ?', (self.room, name))
+            db.execute('DELETE FROM blobs WHERE id = ?', (row[0],))
+
+    def background(self):
+        for name in BACKGROUND_NAMES:
+            if name in self._entries:
+                return name
+        return None
+
+    def delete_background(self):
+        name = self.background()
+        if name:
+            self.remove(name)
+
+    def export(self, directory):
+        """Write every picture to directory in the plain folder layout; returns how many"""
+        directory = Path(directory)
+        for name, entry in sorted(self._entries.items()):
+            target = directory / name
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with open(target, 'wb') as f:
+                for chunk in self.pack.read(entry.blob_id, 0, entry.size):
+                    f.write(chunk)
+            os.utime(target, (entry.mtime, entry.mtime))
+        return len(self._entries)
+
+
+def folder_pictures(directory):
+    """Yield the names of the pictures in a folder laid out like pictures/"""
+    directory = Path(directory)
+    for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+        if entry.is_file() and Path(entry.name).suffix.lower() in IMAGE_EXTENSIONS:
+            yield entry.name
+    background_dir = directory / BACKGROUND_DIR
+    if background_dir.is_dir():
+        for entry in sorted(os.scandir(background_dir), key=lambda entry: entry.name):
+            if entry.is_file() and entry.name.startswith(BACKGROUND_NAME):
+                yield f'{BACKGROUND_DIR}/{entry.name}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move slideshow pictures between a pack and folders",
+                                     epilog=__doc__.split('\n\n', 2)[2],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['import', 'export', 'list'])
+    parser.add_argument('pack', help="pack file, created on import if it does not exist")
+    parser.add_argument('folder', nargs='?', default='pictures',
+                        help="folder to import from or export to (default: %(default)s)")
+    parser.add_argument('--room', default=DEFAULT_ROOM, help="room the pictures belong to (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.command != 'import' and not os.path.exists(args.pack):
+        parser.error(f"{args.pack} does not exist")
+    pack = PicturePack(args.pack)
+    try:
+        pictures = pack.room(args.room)
+        started = time.perf_counter()
+        if args.command == 'import':
+            count = 0
+            for name in folder_pictures(args.folder):
+                path = Path(args.folder) / name
+                pictures.add_file(path, name, mtime=os.stat(path).st_mtime)
+                count += 1
+            print(f"Imported {count} pictures from {args.folder} into room {args.room} "
+                  f"in {time.perf_counter() - started:.1f} s")
+        elif args.command == 'export':
+            count = pictures.export(args.folder)
+            print(f"Exported {count} pictures of room {args.room} to {args.folder} "
+                  f"in {time.perf_counter() - started:.1f} s")
+        else:
+            for room in pack.rooms():
+                room_pictures = pack.room(room)
+                size = sum(room_pictures.entry(name).size for name in room_pictures.pictures())
+                print(f"{room}: {len(room_pictures.pictures())} pictures, {size / (1024 * 1024):.1f} MB"
+                      + (", with a background" if room_pictures.background() else ""))
+    finally:
+        pack.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,279 @@
+"""
+Running the server as several processes on one port.
+
+CPython runs Python code on one core per process, so JSON encoding, upload
+parsing and directory scans of a single server process share one core however
+many threads it has. With --processes N the server forks N worker processes
+that each open their own listening socket on the same port with SO_REUSEPORT,
+and the kernel spreads incoming connections across them.
+
+Each worker keeps the rooms' state in memory as before. A change made through
+one worker is sent as a one-line JSON message over a Unix socket to the
+supervising parent process, which passes it straight on to every other worker.
+Versions come from one counter in shared memory, so every worker gives the same
+state the same version and ETag, whichever worker a display happens to ask.
+"""
+
+import json
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import sys
+import threading
+import time
+
+# How long the supervisor waits for workers to finish shutting down
+SHUTDOWN_TIMEOUT_SECONDS = 10
+# A worker that dies this soon after starting is not replaced, so a broken
+# setup does not turn into a fork loop
+MIN_WORKER_LIFETIME_SECONDS = 5
+# Changes waiting to be sent to one worker; a worker this far behind is not
+# reading its socket (stopped or stuck) and is killed, to be replaced
+MAX_PENDING_BYTES = 16 * 1024 * 1024
+
+
+def supported():
+    """Whether several processes can share a port here with the kernel balancing them"""
+    # macOS and the BSDs accept SO_REUSEPORT but hand every connection to one socket
+    return hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT') and sys.platform.startswith('linux')
+
+
+def reserve_port(host, port):
+    """Bind, without listening, a socket that holds the port for the workers.
+
+    Raises OSError (EADDRINUSE) if another program is using the port.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        # Like the workers' listeners, so connections left in TIME_WAIT by the
+        # last run do not block a restart
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+class SharedCounter:
+    """A counter shared by every process forked after it was created.
+
+    next() never returns the same number twice, in any of the processes.
+    """
+
+    def __init__(self):
+        self._value = multiprocessing.Value('Q', 0)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._value.get_lock():
+            self._value.value += 1
+            return self._value.value
+
+
+class ChangeBus:
+    """A worker's connection to the other workers, through the supervisor"""
+
+    def __init__(self, sock, index):
+        self.index = index
+        self._sock = sock
+        self._send_lock = threading.Lock()
+
+    def publish(self, message):
+        """Send a JSON-serialisable dict to every other worker"""
+        data = json.dumps(message, separators=(',', ':')).encode() + b'\n'
+        try:
+            with self._send_lock:
+                self._sock.sendall(data)
+        except OSError:
+            pass  # The supervisor is gone; the worker is being shut down anyway
+
+    def start(self, handler, on_close):
+        """Call handler with every message from the other workers, on a background thread.
+
+        on_close is called if the supervisor goes away.
+        """
+        def run():
+            with self._sock.makefile('rb') as stream:
+                for line in stream:
+                    try:
+                        handler(json.loads(line))
+                    except Exception as e:
+                        print(f"Error applying a change from another worker: {e}")
+            on_close()
+
+        threading.Thread(target=run, name='change-bus', daemon=True).start()
+
+    def close(self):
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class _Worker:
+    def __init__(self, index, sock):
+        self.index = index
+        self.sock = sock
+        self.started = time.monotonic()
+        self.buffer = b''
+        # Messages from the other workers not yet sent to this one
+        self.outbox = bytearray()
+
+
+class _Supervisor:
+    """Forks the workers, relays their messages and replaces any that die"""
+
+    def __init__(self, count):
+        self.count = count
+        self.workers = {}  # pid -> _Worker
+        self.selector = selectors.DefaultSelector()
+
+    def spawn(self, index):
+        """Fork worker index; returns its ChangeBus in the child and None in the parent"""
+        parent_end, child_end = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            # The child only needs its own end of its own socket
+            self.selector.close()
+            parent_end.close()
+            for worker in self.workers.values():
+                worker.sock.close()
+            return ChangeBus(child_end, index)
+        child_end.close()
+        # Never blocks, so one slow worker cannot hold up the changes for the others
+        parent_end.setblocking(False)
+        self.workers[pid] = _Worker(index, parent_end)
+        self.selector.register(parent_end, selectors.EVENT_READ, pid)
+        return None
+
+    def relay(self, pid):
+        worker = self.workers.get(pid)
+        try:
+            data = worker.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            # The worker is exiting; it is reaped below
+            self.selector.unregister(worker.sock)
+            return
+        worker.buffer += data
+        *lines, worker.buffer = worker.buffer.split(b'\n')
+        if not lines:
+            return
+        message = b''.join(line + b'\n' for line in lines)
+        for other_pid, other in self.workers.items():
+            if other_pid != pid:
+                other.outbox += message
+                self.send(other_pid)
+
+    def send(self, pid):
+        """Send as much of a worker's outbox as its socket takes without blocking"""
+        worker = self.workers[pid]
+        if worker.outbox:
+            try:
+                sent = worker.sock.send(worker.outbox)
+                del worker.outbox[:sent]
+            except BlockingIOError:
+                pass
+            except OSError:
+                worker.outbox.clear()  # The worker is exiting; it is reaped below
+        if len(worker.outbox) > MAX_PENDING_BYTES:
+            print(f"Worker {worker.index} (pid {pid}) is not taking changes, killing it")
+            worker.outbox.clear()
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        # Told when the socket has room again for whatever is left
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if worker.outbox else 0)
+        try:
+            self.selector.modify(worker.sock, events, pid)
+        except (KeyError, ValueError):
+            pass  # No longer watched, as the worker is exiting
+
+    def reap(self):
+        """Collect exited workers; returns a ChangeBus if this is a replacement worker"""
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return None
+            if pid == 0:
+                return None
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            try:
+                self.selector.unregister(worker.sock)
+            except (KeyError, ValueError):
+                pass
+            worker.sock.close()
+            lifetime = time.monotonic() - worker.started
+            print(f"Worker {worker.index} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}")
+            if lifetime < MIN_WORKER_LIFETIME_SECONDS:
+                print(f"Worker {worker.index} died {lifetime:.1f} s after starting, not replacing it")
+                continue
+            bus = self.spawn(worker.index)
+            if bus is not None:
+                return bus
+        return None
+
+    def stop(self):
+        """Ask every worker to shut down and wait for them"""
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT_SECONDS
+        while self.workers and time.monotonic() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid:
+                self.workers.pop(pid, None)
+            else:
+                time.sleep(0.05)
+        for pid in self.workers:
+            print(f"Worker pid {pid} did not stop, killing it")
+            os.kill(pid, signal.SIGKILL)
+
+    def run(self):
+        for index in range(self.count):
+            bus = self.spawn(index)
+            if bus is not None:
+                return bus
+        try:
+            while self.workers:
+                for key, events in self.selector.select(timeout=1.0):
+                    if events & selectors.EVENT_WRITE and key.data in self.workers:
+                        self.send(key.data)
+                    if events & selectors.EVENT_READ and key.data in self.workers:
+                        self.relay(key.data)
+                bus = self.reap()
+                if bus is not None:
+                    return bus
+        except KeyboardInterrupt:
+            self.stop()
+            sys.exit(0)
+        print("Every worker has exited")
+        sys.exit(1)
+
+
+def fork_workers(count):
+    """Fork count worker processes and supervise them.
+
+    Returns a ChangeBus, whose index says which worker this is, in each worker
+    process. In the parent it never returns: the parent relays messages and
+    replaces workers that die until it is interrupted, then exits.
+    """
+    return _Supervisor(count).run()
@@ -0,0 +1,188 @@
+"""
+Opt-in profiling of the server's own requests, to see where the time and
+memory go when it falls behind.
+
+Off by default. The only cost when it is off is checking one attribute per
+request. Switched on at runtime, it runs every Nth request under cProfile
+and adds up each route's hot spots. It can also take tracemalloc snapshots
+before and after the routes that parse uploads, and add up where their
+memory was allocated.
+
+cProfile only sees the thread that enabled it, so each sampled request is
+profiled on its own, and requests running at the same time do not appear in
+each other's profile. tracemalloc is process-wide, so an upload's allocation
+sites include anything other threads allocated while it ran.
+"""
+
+import cProfile
+import itertools
+import os
+import pstats
+import threading
+import tracemalloc
+
+DEFAULT_SAMPLE_EVERY = 10
+# Frames kept per allocation site; one is enough to name the line
+TRACEMALLOC_FRAMES = 1
+# Allocation sites kept per route between reports
+MAX_ALLOCATION_SITES = 500
+# Leaves out what taking the snapshots allocates
+_OWN_ALLOCATIONS = [tracemalloc.Filter(False, tracemalloc.__file__)]
+
+
+class _Sample:
+    """One request being profiled"""
+
+    def __init__(self, key, profiler, snapshot):
+        self.key = key
+        self.profiler = profiler
+        self.snapshot = snapshot
+
+
+class _RouteAllocations:
+    def __init__(self):
+        self.traced = 0
+        self.peak_bytes = 0
+        self.sites = {}  # 'file:line' -> [bytes, blocks]
+
+
+class RequestProfiler:
+    """Samples requests under cProfile and tracemalloc, keyed by 'METHOD /route'"""
+
+    def __init__(self, memory_routes=()):
+        # Read without the lock on every request; only ever set under it
+        self.enabled = False
+        self.sample_every = DEFAULT_SAMPLE_EVERY
+        self.trace_memory = False
+        self.memory_routes = frozenset(memory_routes)
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        self._stats = {}  # key -> (requests profiled, pstats.Stats)
+        self._allocations = {}  # key -> _RouteAllocations
+        # Whether tracemalloc was started here, so it is only stopped here
+        self._started_tracemalloc = False
+
+    def settings(self):
+        with self._lock:
+            return {'enabled': self.enabled, 'sample_every': self.sample_every,
+                    'trace_memory': self.trace_memory}
+
+    def configure(self, enabled=None, sample_every=None, trace_memory=None, reset=False):
+        """Change what is profiled; returns the new settings.
+
+        Raises ValueError for a sample_every below 1.
+        """
+        if sample_every is not None and (not isinstance(sample_every, int) or sample_every < 1):
+            raise ValueError("sample_every must be a whole number of at least 1")
+        with self._lock:
+            if enabled is not None:
+                self.enabled = bool(enabled)
+            if sample_every is not None:
+                self.sample_every = sample_every
+            if trace_memory is not None:
+                self.trace_memory = bool(trace_memory)
+            if reset:
+                self._stats = {}
+                self._allocations = {}
+
+            tracing = self.enabled and self.trace_memory
+            if tracing and not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+                self._started_tracemalloc = True
+            elif not tracing and self._started_tracemalloc:
+                tracemalloc.stop()
+                self._started_tracemalloc = False
+        return self.settings()
+
+    def start(self, key):
+        """Begin profiling the current request if it is sampled; returns a sample for finish, or None"""
+        if next(self._counter) % self.sample_every:
+            return None
+        snapshot = None
+        if self.trace_memory and key in self.memory_routes and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            snapshot = tracemalloc.take_snapshot()
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+ allows one profiler at a time; this request goes without
+            profiler = None
+        if profiler is None and snapshot is None:
+            return None
+        return _Sample(key, profiler, snapshot)
+
+    def finish(self, sample):
+        """Stop profiling a request and add its numbers to its route's"""
+        if sample.profiler is not None:
+            sample.profiler.disable()
+        # Before the profile is turned into stats, which allocates too
+        sites = peak = None
+        if sample.snapshot is not None and tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            after = tracemalloc.take_snapshot().filter_traces(_OWN_ALLOCATIONS)
+            sites = after.compare_to(sample.snapshot.filter_traces(_OWN_ALLOCATIONS), 'lineno')
+        stats = None
+        if sample.profiler is not None:
+            try:
+                stats = pstats.Stats(sample.profiler)
+            except TypeError:
+                pass  # Nothing was recorded
+
+        with self._lock:
+            if stats is not None:
+                count, total = self._stats.get(sample.key, (0, None))
+                if total is None:
+                    total = stats
+                else:
+                    total.add(stats)
+                self._stats[sample.key] = (count + 1, total)
+            if sites is not None:
+                route = self._allocations.setdefault(sample.key, _RouteAllocations())
+                route.traced += 1
+                route.peak_bytes = max(route.peak_bytes, peak)
+                for site in sites:
+                    if site.size_diff <= 0:
+                        continue
+                    frame = site.traceback[0]
+                    totals = route.sites.setdefault(f'{frame.filename}:{frame.lineno}', [0, 0])
+                    totals[0] += site.size_diff
+                    totals[1] += site.count_diff
+                if len(route.sites) > MAX_ALLOCATION_SITES:
+                    kept = sorted(route.sites.items(), key=lambda item: item[1][0], reverse=True)
+                    route.sites = dict(kept[:MAX_ALLOCATION_SITES])
+
+    def report(self, limit=20):
+        """Return the hot spots and allocation sites of each route, biggest first"""
+        # finish() adds to the stats and sites in place, so they are copied
+        # under the lock and only sorted and formatted outside it
+        with self._lock:
+            stats = {key: (count, total.total_tt, list(total.stats.items()))
+                     for key, (count, total) in self._stats.items()}
+            allocations = {key: (route.traced, route.peak_bytes,
+                                 [(site, tuple(totals)) for site, totals in route.sites.items()])
+                           for key, route in self._allocations.items()}
+
+        routes = {}
+        for key, (count, seconds, functions) in sorted(stats.items()):
+            functions.sort(key=lambda item: item[1][2], reverse=True)
+            routes[key] = {
+                'requests_profiled': count,
+                'seconds': seconds,
+                # Time spent in each function itself, and including what it called
+                'hot_spots': [{'function': pstats.func_std_string(function), 'calls': calls,
+                               'own_seconds': own, 'total_seconds': cumulative}
+                              for function, (_, calls, own, cumulative, _) in functions[:limit]]
+            }
+
+        memory = {}
+        for key, (traced, peak, sites) in sorted(allocations.items()):
+            sites.sort(key=lambda item: item[1][0], reverse=True)
+            memory[key] = {
+                'requests_traced': traced,
+                'peak_bytes': peak,
+                'allocations': [{'site': site, 'bytes': size, 'blocks': blocks}
+                                for site, (size, blocks) in sites[:limit]]
+            }
+
+        return {**self.settings(), 'pid': os.getpid(), 'routes': routes, 'memory': memory}
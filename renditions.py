@@ -0,0 +1,219 @@
+"""
+Pre-scaled renditions of slideshow pictures.
+
+Each picture gets a screen-sized version, a small thumbnail for the admin page
+and optionally a WebP copy, generated in a background process pool. Rendition
+files are named after a hash of the source content and the target size, so a
+picture is only ever rendered once for a given size, even across restarts.
+
+Pillow is optional; without it the pipeline is disabled and clients simply
+use the original files.
+"""
+
+import hashlib
+import io
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from pathlib import Path
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+RENDITIONS_DIR_NAME = '.renditions'
+DEFAULT_SCREEN_SIZE = (1920, 1080)
+THUMBNAIL_SIZE = (320, 320)
+JPEG_QUALITY = 85
+WEBP_QUALITY = 80
+# Hex digits of the picture's SHA-256 that rendition filenames start with
+SOURCE_KEY_LENGTH = 20
+
+
+def source_key(path):
+    """Hash a picture's content, given as a path or as bytes; renditions are cached under this key"""
+    if isinstance(path, bytes):
+        return hashlib.sha256(path).hexdigest()[:SOURCE_KEY_LENGTH]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:SOURCE_KEY_LENGTH]
+
+
+def render_variants(source_path, output_dir, screen_size, thumb_size, webp, key=None):
+    """Create any missing renditions of one picture; runs in a worker process.
+
+    source_path is the picture's path, or an object whose read() returns its
+    content, such as a picture_pack.PackedSource. key is the picture's
+    source_key if the caller already knows it, which saves hashing the picture.
+    Returns a dict mapping variant name to rendition filename.
+    """
+    if not isinstance(source_path, str):
+        source_path = source_path.read()
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if key is None:
+        key = source_key(source_path)
+    variants = {}
+
+    with Image.open(io.BytesIO(source_path) if isinstance(source_path, bytes) else source_path) as image:
+        # Scaling would drop the animation, so animated images only get a thumbnail
+        animated = getattr(image, 'is_animated', False)
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        fits_screen = image.width <= screen_size[0] and image.height <= screen_size[1]
+        ext = '.png' if has_alpha else '.jpg'
+
+        wanted = [('thumb', thumb_size, ext)]
+        if not animated:
+            # No point re-encoding a picture that is already small enough
+            if not fits_screen:
+                wanted.append(('screen', screen_size, ext))
+            if webp:
+                wanted.append(('webp', screen_size, '.webp'))
+
+        for variant, size, variant_ext in wanted:
+            filename = f'{key}-{variant}-{size[0]}x{size[1]}{variant_ext}'
+            target = output_dir / filename
+            if not target.exists():
+                _save_scaled(image, target, size, has_alpha)
+            variants[variant] = filename
+
+    return variants
+
+
+def _save_scaled(image, target, size, has_alpha):
+    frame = image.copy()
+    frame = frame.convert('RGBA' if has_alpha else 'RGB')
+    frame.thumbnail(size, Image.LANCZOS)  # Keeps aspect ratio and never upscales
+
+    # Write under a temporary name so a half-written file is never served
+    temp = target.with_name(f'.{target.name}.tmp')
+    if target.suffix == '.webp':
+        frame.save(temp, 'WEBP', quality=WEBP_QUALITY, method=4)
+    elif target.suffix == '.jpg':
+        frame.save(temp, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    else:
+        frame.save(temp, 'PNG', optimize=True)
+    os.replace(temp, target)
+
+
+class RenditionPipeline:
+    """Schedules rendition jobs and remembers which renditions are ready.
+
+    Pictures are identified by their path relative to the server's folder, so
+    one pipeline, and one cache of rendition files, serves pictures from any
+    number of folders. For pictures that are not files, source_for(path)
+    returns what the worker reads the content from, or None if there is no
+    such picture. digest_for(path), if given, returns the picture's SHA-256
+    when it is already known, so the worker does not have to read the whole
+    picture twice.
+
+    With render=False the pipeline never creates renditions itself and only
+    knows of those another process made and passed to adopt().
+    """
+
+    def __init__(self, output_dir, screen_size=DEFAULT_SCREEN_SIZE, thumb_size=THUMBNAIL_SIZE,
+                 webp=False, workers=None, on_change=None, source_for=None, digest_for=None, render=True):
+        self.output_dir = Path(output_dir)
+        self.screen_size = tuple(screen_size)
+        self.thumb_size = tuple(thumb_size)
+        self.webp = webp
+        self.workers = workers or max(1, (os.cpu_count() or 2) // 2)
+        self.on_change = on_change
+        self.source_for = source_for
+        self.digest_for = digest_for
+        self.render = render
+        self.enabled = Image is not None
+        # Bumped whenever a rendition becomes ready
+        self.version = 0
+        # Reentrant because a job that is already done runs its callback inside _submit
+        self._lock = threading.RLock()
+        self._variants = {}
+        self._jobs = {}
+        self._executor = None
+        self._closed = False
+
+    def variants_for(self, names):
+        """Return {path: {variant: rendition path}} for pictures whose renditions are ready.
+
+        Pictures that have not been seen before are queued for rendering.
+        """
+        if not self.enabled:
+            return {}
+        ready = {}
+        with self._lock:
+            for name in names:
+                variants = self._variants.get(name)
+                if variants is not None:
+                    if variants:
+                        ready[name] = variants
+                elif name not in self._jobs and self.render:
+                    self._submit(name)
+        return ready
+
+    def refresh(self, name):
+        """Re-render a picture whose content has just been replaced"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._variants.pop(name, None)
+            if self.render:
+                self._submit(name)
+
+    def adopt(self, name, variants):
+        """Take renditions of a picture that another process created"""
+        with self._lock:
+            self._variants[name] = variants
+            self.version += 1
+
+    def forget(self, name):
+        """Drop a deleted picture; its cached files are kept in case it comes back"""
+        with self._lock:
+            self._variants.pop(name, None)
+            self._jobs.pop(name, None)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, name):
+        if self._closed:
+            return
+        if self._executor is None:
+            # Forking a threaded server is unsafe, so workers are spawned fresh
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        source = self.source_for(name) if self.source_for else name
+        if source is None:
+            self._variants[name] = {}
+            return
+        digest = self.digest_for(name) if self.digest_for else None
+        future = self._executor.submit(render_variants, source, str(self.output_dir),
+                                       self.screen_size, self.thumb_size, self.webp,
+                                       digest[:SOURCE_KEY_LENGTH] if digest else None)
+        self._jobs[name] = future
+        future.add_done_callback(lambda done: self._finished(name, done))
+
+    def _finished(self, name, future):
+        if future.cancelled():
+            return
+        try:
+            variants = future.result()
+        except Exception as e:
+            print(f"Could not create renditions for {name}: {e}")
+            variants = {}
+        prefix = f'{self.output_dir.as_posix()}/'
+        with self._lock:
+            # A newer upload of the same name supersedes this job
+            if self._jobs.get(name) is not future:
+                return
+            del self._jobs[name]
+            self._variants[name] = {variant: prefix + filename for variant, filename in variants.items()}
+            self.version += 1
+        if variants and self.on_change:
+            self.on_change(name)
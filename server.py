@@ -6,6 +6,8 @@ This allows the HTML page to dynamically discover available images.
 
 import http.server
 import socketserver
+import errno
+import itertools
 import json
 import os
 from pathlib import Path
@@ -14,58 +16,868 @@ from datetime import datetime, timedelta
 import re
 import shutil
 import tempfile
+import threading
+import argparse
+import signal
+import socket
+import stat
+import time
+import io
+import collections
+import ipaddress
 
-# Global variables to store countdown settings
-countdown_text = "Round 1 finishes in"
-countdown_duration = 5 * 60  # 5 minutes in seconds
-countdown_target_time = None  # Will store target time as datetime object
+from events import MAX_EVENT_STREAMS, EventBroadcaster, HEARTBEAT_SECONDS, format_event
+from picture_index import BACKGROUND_DIR, BACKGROUND_NAME, BACKGROUND_NAMES, DIGESTS_NAME, DigestCache, PictureFolder, is_slide_picture
+from renditions import DEFAULT_SCREEN_SIZE, RENDITIONS_DIR_NAME, RenditionPipeline
+from static_cache import COMPRESSIBLE_TYPES, EncodedBody, StaticCache, choose_encoding
+from file_sender import FileSlice, RangeNotSatisfiable, parse_range
+from picture_pack import BlobSlice, PicturePack
+from image_info import ImageInfoCache
+from metrics import METRICS_CONTENT_TYPE, CountingWriter, Metrics
+from multipart_upload import DEFAULT_MAX_UPLOAD_BYTES, UploadTooLarge, parse_multipart
+from profiling import RequestProfiler
+import prefork
+from state_store import WriteBehindStore
+from timetable import Scheduler, parse_timetable, slot_at
 
-def load_countdown_settings():
-    """Load countdown settings from the times file"""
-    global countdown_text, countdown_duration, countdown_target_time
+# Upper bound on requests handled at the same time in threaded mode
+DEFAULT_MAX_WORKERS = 32
+# Upper bound on open client connections, idle keep-alive ones and event
+# streams included; connections beyond it are answered once and closed
+DEFAULT_MAX_CONNECTIONS = 512
+# How long a connection may sit idle waiting for its next request
+KEEP_ALIVE_TIMEOUT_SECONDS = 30
+# A request body a handler left unread is read and dropped, so the connection
+# can carry the next request; a bigger remainder closes the connection instead
+MAX_DISCARD_BYTES = 64 * 1024
+# Largest upload request accepted, set from --max-upload-mb
+max_upload_bytes = DEFAULT_MAX_UPLOAD_BYTES
+# How long shutdown waits for in-flight requests before giving up
+SHUTDOWN_GRACE_SECONDS = 5
+
+# Each hall of a tournament is a room with its own countdown, pictures and
+# custom slide. The default room keeps its files where a single-hall server
+# always had them; any other room lives in rooms/<name>/ and is created the
+# first time something changes it.
+DEFAULT_ROOM = 'default'
+ROOMS_DIR = 'rooms'
+ROOM_NAME_PATTERN = re.compile(r'^[a-z0-9][a-z0-9_-]{0,63}$')
+# /rooms/<name>/ followed by a page or an /api/ route is for that room
+ROOM_PATH_PATTERN = re.compile(r'^/rooms/([^/]+)(/.*)?$')
+ROOM_PAGES = {'/', '/index.html', '/admin'}
+# Keeps a mistyped script from creating rooms without end
+MAX_ROOMS = 100
+# A loaded room with nothing of its own and no displays listening may be
+# dropped to make way for another once it has not been used for this long
+ROOM_IDLE_SECONDS = 10
+
+DEFAULT_COUNTDOWN_TEXT = "Round 1 finishes in"
+DEFAULT_COUNTDOWN_DURATION = 5 * 60  # 5 minutes in seconds
+
+# Bumped on every change so ETags change with the state they describe.
+# BOOT_ID keeps ETags from an earlier run of the server from matching.
+BOOT_ID = format(time.time_ns(), 'x')
+# Every change to a room's state takes the next number from here as its
+# version; with --processes it is a prefork.SharedCounter, so all workers
+# number the same state the same way
+versions = itertools.count(1)
+# With --processes, the prefork.ChangeBus that tells the other workers about changes
+change_bus = None
+# Runs the timetables and creates renditions; with --processes only worker 0 does
+primary_worker = True
+
+# Event streams of every room together stay within one limit
+event_stream_slots = threading.BoundedSemaphore(MAX_EVENT_STREAMS)
+
+# index.html, admin.html and other text files, held in memory and precompressed
+static_cache = StaticCache()
+# Last encoded body of each JSON endpoint, keyed by room and route, so a large
+# payload is only serialised and compressed once per change
+json_body_cache = {}
+json_body_cache_lock = threading.Lock()
+# JSON bodies being built, by key, as (etag, event); requests that miss the
+# cache while one is being built wait for it instead of building it again
+json_body_builds = {}
+
+# Request counts, latencies and upload sizes, exposed on /api/metrics
+request_metrics = Metrics()
+# Routes counted under their own name; anything else is grouped to keep the
+# number of metric series bounded
+METRIC_ROUTES = {
+    '/', '/index.html', '/admin', '/favicon.ico', '/api/countdown', '/api/pictures',
+    '/api/custom-slide', '/api/bootstrap', '/api/changes', '/api/events', '/api/metrics',
+    '/api/upload', '/api/upload-background', '/api/delete', '/api/rooms', '/api/timetable',
+    '/api/profile',
+}
+# Samples requests under cProfile when switched on through /api/profile, and
+# traces the memory used by upload parsing
+request_profiler = RequestProfiler(memory_routes={'POST /api/upload', 'POST /api/upload-background'})
+# Only displays ask for these, so their clients are counted as connected displays
+DISPLAY_ROUTES = {'/api/bootstrap', '/api/changes', '/api/events'}
+
+# Hex digits of a picture's content digest put in its URL
+FINGERPRINT_LENGTH = 16
+# For URLs whose content can never change
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# The picture listing, kept in each pictures folder for displays that open
+# index.html without the server
+MANIFEST_NAME = 'manifest.json'
+# Changes to a room's picture listing remembered for /api/pictures?since=;
+# a display further behind than this reloads the whole listing
+PICTURE_LOG_LENGTH = 200
+
+# Content digests of every room's pictures, for fingerprinted URLs
+picture_digests = DigestCache()
+# Dimensions and sizes of the pictures, read from their headers
+image_info_cache = ImageInfoCache()
+# With --pack, the picture_pack.PicturePack holding every room's pictures
+# instead of the pictures folders
+picture_pack = None
+
+def renditions_ready(path):
+    """Tell the displays of a picture's room that smaller versions of it are available"""
+    with rooms_lock:
+        loaded = list(rooms.values())
+    for room in loaded:
+        if Path(path).parent == room.pictures_dir:
+            room.pictures_changed(variants=rendition_pipeline.variants_for([path]))
+
+def packed_source(path):
+    """Find a packed picture for the rendition pipeline, given its path as the pipeline knows it"""
+    path = Path(path)
+    for room in loaded_rooms():
+        if path.parent == room.pictures_dir:
+            return room.store.source(path.name)
+    return None
+
+def picture_digest(path):
+    """Content digest of a picture for the rendition pipeline, so its workers need not hash it again"""
+    path = Path(path)
+    for room in loaded_rooms():
+        if path.parent == room.pictures_dir:
+            return room.store.digest(path.name)
+    return None
+
+# Advances every room's countdown at the boundaries of its timetable
+timetable_scheduler = Scheduler()
+
+# Screen-sized versions and thumbnails of every room's pictures, replaced in
+# __main__ with one configured from the command line
+rendition_pipeline = RenditionPipeline(Path('pictures') / RENDITIONS_DIR_NAME, on_change=renditions_ready,
+                                       digest_for=picture_digest)
+
+def room_directory(name):
+    """Folder holding a room's files"""
+    return Path('.') if name == DEFAULT_ROOM else Path(ROOMS_DIR) / name
+
+class Room:
+    """The countdown, pictures and custom slide shown on one room's displays"""
     
-    times_file = Path('times')
-    if times_file.exists():
-        try:
-            with open(times_file, 'r') as f:
-                data = json.load(f)
-                countdown_text = data.get('text', countdown_text)
-                countdown_duration = data.get('duration', countdown_duration)
-                
-                # Load target time if it exists
-                if 'target_time' in data and data['target_time']:
-                    countdown_target_time = datetime.fromisoformat(data['target_time'])
-                    # Recalculate duration if target time is set
-                    now = datetime.now()
-                    remaining_seconds = int((countdown_target_time - now).total_seconds())
-                    if remaining_seconds > 0:
-                        countdown_duration = remaining_seconds
-                    else:
-                        countdown_duration = 0
-                        
-            print(f"Loaded countdown settings: {countdown_text}, duration: {countdown_duration}s")
-        except Exception as e:
-            print(f"Error loading countdown settings: {e}, using defaults")
+    def __init__(self, name):
+        self.name = name
+        self.directory = room_directory(name)
+        self.pictures_dir = self.directory / 'pictures'
+        # When get_room last handed the room out
+        self.last_used = time.monotonic()
+        
+        self.countdown_text = DEFAULT_COUNTDOWN_TEXT
+        self.countdown_duration = DEFAULT_COUNTDOWN_DURATION
+        self.countdown_target_time = None  # Will store target time as datetime object
+        # The JSON around the remaining seconds, as ((text, target_time), before, after)
+        self.countdown_template = None
+        # Guards the countdown now that requests run on worker threads
+        self.countdown_lock = threading.RLock()
+        # Serialises changes to the custom slide and its version
+        self.custom_slide_lock = threading.Lock()
+        
+        # The times file and custom_slide.json, read once and then served from
+        # memory; changes are written back in the background
+        self.countdown_store = WriteBehindStore(self.directory / 'times')
+        self.custom_slide_store = WriteBehindStore(self.directory / 'custom_slide.json')
+        # Versions of the countdown, custom slide and picture listing, taken from versions
+        self.countdown_version = 0
+        self.custom_slide_version = 0
+        self.pictures_version = 0
+        # Rounds and breaks that set the countdown automatically, and the timer
+        # waiting for the next boundary between them
+        self.timetable_store = WriteBehindStore(self.directory / 'timetable.json')
+        self.timetable_timer = None
+        
+        # Pushes state changes to the room's displays listening on /api/events
+        self.events = EventBroadcaster(stream_slots=event_stream_slots)
+        # Slide pictures and the custom slide background, in the pictures folder
+        # or in the pack; kept up to date by upload and delete
+        if picture_pack is not None:
+            self.store = picture_pack.room(name)
+            self.manifest_store = None
+        else:
+            self.store = PictureFolder(self.pictures_dir, picture_digests, image_info_cache,
+                                       WriteBehindStore(self.pictures_dir / DIGESTS_NAME))
+            self.manifest_store = WriteBehindStore(self.pictures_dir / MANIFEST_NAME)
+        # The picture entries of the listing last recorded and its version, and
+        # the names that changed at each version after picture_log_start, so a
+        # display can be sent only what changed since the listing it has
+        self.listed = {}
+        self.listed_version = -1
+        self.picture_log = collections.deque()
+        self.picture_log_start = None
+        self.listing_lock = threading.Lock()
+        # Listing version the last pictures event brought the displays up to
+        self.published_pictures_version = None
+        self.picture_events_lock = threading.Lock()
+        # The store's own version when pictures_version was last taken, so a
+        # change to the folder made by hand is noticed
+        self.pictures_lock = threading.Lock()
+        self.store.pictures()
+        self.store_version = self.store.version
+    
+    def has_state(self):
+        """Whether the room has anything of its own: settings, a timetable or pictures"""
+        stores = (self.countdown_store, self.custom_slide_store, self.timetable_store)
+        return (any(store.get() is not None for store in stores) or
+                bool(self.store.pictures()) or self.store.background() is not None)
+    
+    def url(self, path):
+        """Return the URL of a file, given its path relative to the server's folder"""
+        # The default room's pages are at /, so its URLs stay relative and still
+        # work when index.html is opened straight from disk
+        return f'./{path}' if self.name == DEFAULT_ROOM else f'/{path}'
+    
+    def picture_path(self, name):
+        """Path of a picture relative to the server's folder, as the rendition pipeline knows it"""
+        return (self.pictures_dir / name).as_posix()
+    
+    def load(self):
+        """Load the countdown settings and the custom slide from disk"""
+        data = self.countdown_store.load()
+        if data is not None:
+            try:
+                self.apply_countdown_settings(data)
+                print(f"Loaded countdown settings for room {self.name}: {self.countdown_text}, "
+                      f"duration: {self.countdown_duration}s")
+            except Exception as e:
+                print(f"Error loading countdown settings for room {self.name}: {e}, using defaults")
+        self.custom_slide_store.load()
+        
+        self.timetable_store.load(validate=parse_timetable)
+        # Works out the current slot from the clock, so a restart resumes the timetable
+        self.apply_timetable()
+        
+        # Pictures may have been added while the server was stopped; listing a
+        # large folder takes a while, so the room does not wait for it
+        if self.manifest_store is not None and primary_worker and self.pictures_dir.is_dir():
+            threading.Thread(target=lambda: self.listing_changed(self.picture_snapshot()[0]),
+                             name='manifest', daemon=True).start()
+    
+    def close(self):
+        """End the room's event streams and write out any change still waiting"""
+        self.events.close()
+        self.countdown_store.close()
+        self.custom_slide_store.close()
+        self.timetable_store.close()
+        if self.manifest_store is not None:
+            self.manifest_store.close()
+            self.store.digest_store.close()
+    
+    def apply_countdown_settings(self, data):
+        """Take the countdown settings from a dict as saved in the times file"""
+        with self.countdown_lock:
+            self.countdown_text = data.get('text', self.countdown_text)
+            self.countdown_duration = data.get('duration', self.countdown_duration)
+            self.countdown_target_time = None
+            
+            # Load target time if it exists
+            if 'target_time' in data and data['target_time']:
+                self.countdown_target_time = datetime.fromisoformat(data['target_time'])
+                # Recalculate duration if target time is set
+                now = datetime.now()
+                remaining_seconds = int((self.countdown_target_time - now).total_seconds())
+                if remaining_seconds > 0:
+                    self.countdown_duration = remaining_seconds
+                else:
+                    self.countdown_duration = 0
+    
+    def save_countdown_settings(self):
+        """Queue the countdown settings to be written to the times file"""
+        self.countdown_store.set(self.countdown_settings())
+    
+    def countdown_settings(self):
+        return {
+            'text': self.countdown_text,
+            'duration': self.countdown_duration,
+            'target_time': self.countdown_target_time.isoformat() if self.countdown_target_time else None
+        }
+    
+    def countdown_changed(self):
+        """Save the countdown and tell the displays and the other workers; call with countdown_lock held"""
+        self.save_countdown_settings()
+        self.countdown_version = next(versions)
+        self.broadcast('countdown', version=self.countdown_version, settings=self.countdown_settings())
+        state = self.countdown_state()
+        self.events.publish('countdown', state)
+        return state
+    
+    def broadcast(self, kind, **change):
+        """Send a change to the other worker processes, if there are any"""
+        if change_bus:
+            change_bus.publish({'kind': kind, 'room': self.name, **change})
+    
+    def apply_timetable(self):
+        """Set the countdown to the timetable's current slot and wait for the next boundary.
 
-def save_countdown_settings():
-    """Save countdown settings to the times file"""
-    global countdown_text, countdown_duration, countdown_target_time
+        Runs on the scheduler's thread at every boundary; displays get one
+        countdown event per change.
+        """
+        with self.countdown_lock:
+            if self.timetable_timer:
+                self.timetable_timer.cancel()
+                self.timetable_timer = None
+            timetable = self.timetable_store.get()
+            if timetable is None:
+                return
+            
+            index, ends = slot_at(timetable, datetime.now())
+            if 0 <= index < len(timetable['slots']):
+                text = timetable['slots'][index]['text']
+                if (text, ends) != (self.countdown_text, self.countdown_target_time):
+                    self.countdown_text = text
+                    self.countdown_target_time = ends
+                    self.countdown_changed()
+            # The other workers hear about the change from the primary
+            if ends and primary_worker:
+                self.timetable_timer = timetable_scheduler.call_at(ends, self.apply_timetable)
     
-    data = {
-        'text': countdown_text,
-        'duration': countdown_duration,
-        'target_time': countdown_target_time.isoformat() if countdown_target_time else None
+    def timetable_state(self):
+        """Return the timetable and which of its slots is running"""
+        timetable = self.timetable_store.get()
+        if timetable is None:
+            return {'timetable': None, 'current': None, 'ends': None}
+        index, ends = slot_at(timetable, datetime.now())
+        return {
+            'timetable': timetable,
+            # -1 before the start, len(slots) once the timetable is over
+            'current': index,
+            'ends': ends.isoformat() if ends else None
+        }
+    
+    def countdown_state(self):
+        """Return the current countdown settings as sent to displays"""
+        with self.countdown_lock:
+            # If we have a target time, calculate remaining duration
+            if self.countdown_target_time:
+                now = datetime.now()
+                remaining_seconds = int((self.countdown_target_time - now).total_seconds())
+                
+                # If target time has passed, show 0 instead of setting for next day
+                if remaining_seconds <= 0:
+                    self.countdown_duration = 0
+                else:
+                    self.countdown_duration = remaining_seconds
+            
+            return {
+                'text': self.countdown_text,
+                'duration': self.countdown_duration,
+                'target_time': self.countdown_target_time.strftime('%H:%M') if self.countdown_target_time else None
+            }
+    
+    def countdown_json(self, state):
+        """Encode a countdown_state() as JSON bytes.
+        
+        Only the remaining seconds change from second to second, so the text
+        and target time are encoded once and the seconds are spliced in.
+        """
+        key = (state['text'], state['target_time'])
+        template = self.countdown_template
+        if template is None or template[0] != key:
+            # The same bytes json.dumps(state) gives, split around the duration
+            before = b'{"text": %s, "duration": ' % json.dumps(state['text']).encode()
+            after = b', "target_time": %s}' % json.dumps(state['target_time']).encode()
+            template = self.countdown_template = (key, before, after)
+        return template[1] + json.dumps(state['duration']).encode() + template[2]
+    
+    def state_version(self, refresh=True):
+        """A number that grows whenever anything shown on the room's displays changes.
+        
+        It is the newest of the per-resource versions, which all come from versions.
+        refresh=False skips looking for pictures changed by hand, for a caller
+        that has just done so itself.
+        """
+        if refresh:
+            self.picture_snapshot()  # Picks up files dropped into the folder by hand
+        return max(self.countdown_version, self.custom_slide_version, self.pictures_version)
+    
+    def picture_snapshot(self):
+        """Return the version of the picture listing and the pictures, read together"""
+        with self.pictures_lock:
+            store_version, pictures = self.store.snapshot()
+            if store_version == self.store_version:
+                return self.pictures_version, pictures
+        # Changed behind the server's back, e.g. a file copied into the folder;
+        # the other workers are told to look for themselves
+        return self.pictures_changed(names=None, publish=False), pictures
+    
+    def pictures_changed(self, names=(), variants=None, publish=True):
+        """Record a change to the room's pictures and tell the displays and the other workers.
+        
+        names are the pictures added, replaced or deleted, None if that is not
+        known, and variants renditions that became ready. Returns the new
+        version of the listing.
+        """
+        with self.pictures_lock:
+            self.store_version = self.store.version
+            self.pictures_version = version = next(versions)
+        self.broadcast('pictures', version=version, names=None if names is None else list(names),
+                       variants=variants or {})
+        if publish:
+            self.listing_changed(version, self.list_pictures())
+            self.publish_picture_changes()
+        else:
+            self.listing_changed(version)
+        return version
+    
+    def listing_changed(self, version, listing=None):
+        """Record the picture listing at a version: log which pictures changed and
+        write it to pictures/manifest.json, for index.html opened without the server.
+        
+        A listing older than the one already recorded is ignored.
+        """
+        with self.listing_lock:
+            if version <= self.listed_version:
+                return
+            if listing is None:
+                listing = self.list_pictures()
+            entries = picture_entries(listing)
+            if self.picture_log_start is None:
+                # Displays that loaded an earlier listing cannot be brought up to date
+                self.picture_log_start = version
+            else:
+                changed = {name for name, entry in entries.items() if self.listed.get(name) != entry}
+                changed.update(name for name in self.listed if name not in entries)
+                if changed:
+                    self.picture_log.append((version, changed))
+                    if len(self.picture_log) > PICTURE_LOG_LENGTH:
+                        self.picture_log_start = self.picture_log.popleft()[0]
+            self.listed = entries
+            self.listed_version = version
+            
+            # Only the primary worker writes the manifest; it is replaced
+            # atomically a moment later, so a burst of uploads costs one write.
+            # The digests listing just took are saved with it for the next run.
+            # A room that never had pictures gets no folder just for a manifest
+            if self.manifest_store is not None and primary_worker and self.pictures_dir.is_dir():
+                self.manifest_store.set(listing)
+                self.store.save_digests()
+    
+    def picture_changes(self, since):
+        """Return what changed in the picture listing after version since.
+        
+        The result is (version, entries of the pictures added or changed, names
+        removed, number of pictures), or None if the log does not go back that far.
+        """
+        self.listing_changed(self.picture_snapshot()[0])
+        with self.listing_lock:
+            if since < self.picture_log_start:
+                return None
+            names = set()
+            for version, changed in self.picture_log:
+                if version > since:
+                    names |= changed
+            entries = {name: self.listed[name] for name in names if name in self.listed}
+            removed = sorted(name for name in names if name not in self.listed)
+            return self.listed_version, entries, removed, len(self.listed)
+    
+    def publish_picture_changes(self):
+        """Push the pictures changed since the last pictures event to the displays.
+        
+        The event carries the version it starts from as since, so a display
+        whose listing is older fetches what it missed first. If the log no
+        longer goes back to the last event, displays are told to reset.
+        """
+        with self.picture_events_lock:
+            with self.listing_lock:
+                since = self.published_pictures_version
+                if since is None:
+                    since = self.picture_log_start
+            changes = self.picture_changes(since)
+            if changes is None:
+                with self.listing_lock:
+                    version = self.listed_version
+                payload = {'reset': True, 'boot_id': BOOT_ID}
+            else:
+                version = changes[0]
+                if version == since:
+                    return  # Already sent with an earlier event
+                payload = {**picture_changes_payload(changes), 'since': since}
+            self.published_pictures_version = version
+            self.events.publish('pictures', payload)
+    
+    def fingerprinted_url(self, name):
+        """Return the URL of a picture with its content digest in the query string.
+        
+        The URL changes whenever the content does, so clients can cache it forever.
+        """
+        url = self.url(self.picture_path(name))
+        digest = self.store.digest(name)
+        if digest is None:
+            return url
+        return f'{url}?v={digest[:FINGERPRINT_LENGTH]}'
+    
+    def picture_info(self, name):
+        return self.store.info(name)
+    
+    def list_pictures(self, pictures=None):
+        """Return the pictures shown in the room's slideshow"""
+        if pictures is None:
+            pictures = self.store.pictures()
+        paths = {pic: self.picture_path(pic) for pic in pictures}
+        # Digests first, so new rendition jobs can be given them
+        urls = {pic: self.fingerprinted_url(pic) for pic in pictures}
+        variants = rendition_pipeline.variants_for(paths.values())
+        
+        return {
+            'pictures': [urls[pic] for pic in pictures],
+            'count': len(pictures),
+            # Filename of each picture -> its URL
+            'files': urls,
+            # Byte size, format and dimensions of each picture, so displays can decode
+            # the next slide ahead of time and reserve its layout
+            'manifest': {urls[pic]: self.picture_info(pic) for pic in pictures},
+            # Smaller versions of each picture, for pictures whose renditions are ready
+            'variants': {urls[pic]: {variant: self.url(rendition)
+                                     for variant, rendition in variants[paths[pic]].items()}
+                         for pic in pictures if paths[pic] in variants},
+            'screen_size': list(rendition_pipeline.screen_size)
+        }
+    
+    def remove_picture(self, filename):
+        """Delete a picture from the room; raises ValueError if it cannot be"""
+        # Security check: ensure filename doesn't contain path traversal
+        if '..' in filename or '/' in filename or '\\' in filename:
+            raise ValueError("Invalid filename")
+        
+        self.store.remove(filename)
+        rendition_pipeline.forget(self.picture_path(filename))
+    
+    def custom_slide_changed(self):
+        """Record that the custom slide or its background changed and tell the displays"""
+        with self.custom_slide_lock:
+            self.custom_slide_version = version = next(versions)
+            self.broadcast('custom-slide', version=version, slide=self.custom_slide_store.get())
+        self.events.publish('custom-slide', self.custom_slide_state())
+    
+    def timetable_changed(self, timetable):
+        """Replace the timetable and set the countdown to its current slot"""
+        # Written to timetable.json in the background
+        self.timetable_store.set(timetable)
+        self.broadcast('timetable', timetable=timetable)
+        self.apply_timetable()
+    
+    def apply_change(self, change):
+        """Take a change made through another worker process and tell this worker's displays"""
+        kind = change['kind']
+        if kind == 'countdown':
+            with self.countdown_lock:
+                # Two workers changing it at once: the later version wins everywhere
+                if change['version'] <= self.countdown_version:
+                    return
+                self.apply_countdown_settings(change['settings'])
+                self.save_countdown_settings()
+                self.countdown_version = change['version']
+                state = self.countdown_state()
+            self.events.publish('countdown', state)
+        elif kind == 'custom-slide':
+            with self.custom_slide_lock:
+                if change['version'] <= self.custom_slide_version:
+                    return
+                self.custom_slide_store.set(change['slide'])
+                self.store.refresh(BACKGROUND_NAMES)
+                self.custom_slide_version = change['version']
+            self.events.publish('custom-slide', self.custom_slide_state())
+        elif kind == 'pictures':
+            names = change['names']
+            if names is None or names:
+                self.store.refresh(names)
+            for name in names or ():
+                if self.store.digest(name) is None:
+                    rendition_pipeline.forget(self.picture_path(name))
+                elif is_slide_picture(name):
+                    rendition_pipeline.refresh(self.picture_path(name))
+            for path, variants in change['variants'].items():
+                rendition_pipeline.adopt(path, variants)
+            with self.pictures_lock:
+                self.store_version = self.store.version
+                if change['version'] <= self.pictures_version:
+                    return
+                self.pictures_version = change['version']
+            self.listing_changed(change['version'], self.list_pictures())
+            self.publish_picture_changes()
+        elif kind == 'timetable':
+            if change['timetable'] == self.timetable_store.get():
+                return
+            self.timetable_store.set(change['timetable'])
+            # The countdown itself comes in its own change; the primary only
+            # needs to wait for the new timetable's next boundary
+            if primary_worker:
+                self.apply_timetable()
+    
+    def send_state(self):
+        """Send the room's whole state to the other workers, for one that just started"""
+        with self.countdown_lock:
+            self.broadcast('countdown', version=self.countdown_version, settings=self.countdown_settings())
+        with self.custom_slide_lock:
+            self.broadcast('custom-slide', version=self.custom_slide_version, slide=self.custom_slide_store.get())
+        self.broadcast('timetable', timetable=self.timetable_store.get())
+        pictures = self.store.pictures()
+        variants = rendition_pipeline.variants_for(self.picture_path(name) for name in pictures)
+        self.broadcast('pictures', version=self.pictures_version, names=[], variants=variants)
+    
+    def custom_slide_state(self):
+        """Return the custom slide, including its background image if one is uploaded"""
+        background = self.store.background()
+        background_image = self.fingerprinted_url(background) if background else None
+        
+        slide_data = self.custom_slide_store.get()
+        if isinstance(slide_data, dict):
+            # The stored dict is shared, so the background goes on a copy
+            return {**slide_data, 'backgroundImage': background_image}
+        
+        # Return empty slide data if none has been saved
+        return {
+            'elements': [],
+            'backgroundColor': '#f9f9f9',
+            'backgroundImage': background_image
+        }
+
+def picture_changes_payload(changes):
+    """The JSON sent to displays for what Room.picture_changes returned"""
+    version, entries, removed, count = changes
+    return {
+        'reset': False,
+        'version': version,
+        'boot_id': BOOT_ID,
+        'count': count,
+        # The same fields as the full listing, for the pictures added or changed
+        'files': {name: url for name, (url, info, variants) in entries.items()},
+        'manifest': {url: info for url, info, variants in entries.values()},
+        'variants': {url: variants for url, info, variants in entries.values() if variants},
+        'removed': removed
     }
+
+def picture_entries(listing):
+    """Each picture's URL, header info and renditions in a listing, by filename"""
+    return {name: (url, listing['manifest'].get(url), listing['variants'].get(url))
+            for name, url in listing['files'].items()}
+
+# Rooms loaded so far, by name
+rooms = {}
+rooms_lock = threading.Lock()
+
+def get_room(name, create=False):
+    """Return a room, loading it from disk the first time it is used.
     
+    A room without settings, a timetable or pictures is only created with
+    create=True, for requests that change it or listen for its changes, so
+    reading a mistyped room name does not load it. Returns None for such a
+    room, for a name that is not allowed, or when there are already
+    MAX_ROOMS rooms and none of them can be dropped.
+    """
+    with rooms_lock:
+        room = rooms.get(name)
+        if room is None:
+            if not ROOM_NAME_PATTERN.match(name) or not (create or room_exists(name)):
+                return None
+            if len(rooms) >= MAX_ROOMS and not drop_idle_room():
+                return None
+            room = rooms[name] = Room(name)
+            room.load()
+        room.last_used = time.monotonic()
+        return room
+
+def room_exists(name):
+    """Whether a room has settings, a timetable or pictures of its own"""
+    if name == DEFAULT_ROOM or room_has_files(name):
+        return True
+    return picture_pack is not None and picture_pack.has_room(name)
+
+def drop_idle_room():
+    """Unload a room that has nothing of its own and no displays listening; call with rooms_lock held.
+    
+    Returns whether a room was dropped.
+    """
+    idle_since = time.monotonic() - ROOM_IDLE_SECONDS
+    for name, room in rooms.items():
+        if (name != DEFAULT_ROOM and room.last_used < idle_since and
+                not room.events.open_streams and not room.has_state()):
+            del rooms[name]
+            room.close()
+            return True
+    return False
+
+def loaded_rooms():
+    with rooms_lock:
+        return list(rooms.values())
+
+def room_has_files(name):
+    """Whether a room's folder holds settings, a timetable or pictures.
+    
+    The server's own manifest and digests do not count, so a room someone
+    only looked at does not stay listed.
+    """
+    directory = room_directory(name)
+    if any((directory / filename).exists() for filename in ('times', 'custom_slide.json', 'timetable.json')):
+        return True
     try:
-        with open('times', 'w') as f:
-            json.dump(data, f, indent=2)
-        print(f"Saved countdown settings to times file")
-    except Exception as e:
-        print(f"Error saving countdown settings: {e}")
+        with os.scandir(directory / 'pictures') as entries:
+            return any(entry.name not in (MANIFEST_NAME, DIGESTS_NAME) for entry in entries)
+    except OSError:
+        return False
+
+def room_names():
+    """Names of the rooms with settings, a timetable or pictures, in memory or on disk"""
+    names = {room.name for room in loaded_rooms() if room.has_state()} | {DEFAULT_ROOM}
+    if picture_pack is not None:
+        names.update(picture_pack.rooms())
+    if os.path.isdir(ROOMS_DIR):
+        names.update(entry.name for entry in os.scandir(ROOMS_DIR)
+                     if entry.is_dir() and ROOM_NAME_PATTERN.match(entry.name) and room_has_files(entry.name))
+    return sorted(names)
+
+def load_timetabled_rooms():
+    """Load every room that has a timetable, so its countdown advances before anyone asks for it"""
+    for name in room_names():
+        if (room_directory(name) / 'timetable.json').exists():
+            get_room(name)
+
+def apply_change(change):
+    """Handle a message from another worker process, given to the prefork.ChangeBus"""
+    if change['kind'] == 'hello':
+        # A worker that just started, perhaps replacing one that died, needs
+        # to catch up with everything changed since the files were written
+        for room in loaded_rooms():
+            room.send_state()
+        if request_profiler.enabled:
+            change_bus.publish({'kind': 'profile', 'settings': request_profiler.settings()})
+        return
+    if change['kind'] == 'profile':
+        request_profiler.configure(**change['settings'])
+        return
+    room = get_room(change['room'], create=True)
+    if room is not None:
+        room.apply_change(change)
+
+def close_rooms():
+    """End every room's event streams and write out pending changes, on shutdown"""
+    for room in loaded_rooms():
+        room.close()
+
+def make_etag(*parts):
+    """Build a strong ETag that is unique to this run of the server"""
+    return '"' + '-'.join(str(part) for part in (BOOT_ID,) + parts) + '"'
+
+def encoded_etag(etag, encoding):
+    """ETag of a compressed representation; each encoding needs its own tag"""
+    return f'{etag[:-1]}-{encoding}"' if encoding else etag
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header value matches the given ETag.
+    
+    A tag for any compressed representation of the same content also matches.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # If-None-Match uses weak comparison, so ignore any W/ prefix
+    candidates = {tag.strip()[2:] if tag.strip().startswith('W/') else tag.strip()
+                  for tag in if_none_match.split(',')}
+    return any(encoded_etag(etag, encoding) in candidates for encoding in (None, 'gzip', 'br'))
+
+def cached_json_body(key, etag, build_payload):
+    """Return the EncodedBody for a JSON endpoint, rebuilding it only when the ETag changes.
+    
+    build_payload returns the payload, or its JSON already encoded as bytes. When
+    several requests miss the cache at once, one of them builds the body and the
+    others wait for it.
+    """
+    while True:
+        with json_body_cache_lock:
+            cached = json_body_cache.get(key)
+            if cached and cached[0] == etag:
+                return cached[1]
+            build = json_body_builds.get(key)
+            if build is None or build[0] != etag:
+                build = json_body_builds[key] = (etag, threading.Event())
+                break
+        # Someone else is building this body; if their build fails, try again
+        build[1].wait()
+    
+    try:
+        payload = build_payload()
+        if not isinstance(payload, bytes):
+            payload = json.dumps(payload).encode()
+        content = EncodedBody(payload)
+        with json_body_cache_lock:
+            json_body_cache[key] = (etag, content)
+        return content
+    finally:
+        with json_body_cache_lock:
+            if json_body_builds.get(key) is build:
+                del json_body_builds[key]
+        build[1].set()
+
+def metric_route(path):
+    """Map a request path to a route label for the metrics; rooms share their labels"""
+    route = path.partition('?')[0]
+    match = ROOM_PATH_PATTERN.match(route)
+    if match:
+        route = match.group(2) or '/'
+    if route in METRIC_ROUTES:
+        return route
+    if route.startswith('/api/delete/'):
+        return '/api/delete/<name>'
+    if route.startswith('/pictures/'):
+        return '/pictures/*'
+    return '/api/*' if route.startswith('/api/') else 'other'
+
+class RequestBody:
+    """A request's body as handlers read it: reading stops at its Content-Length,
+    so the next request on a kept-alive connection is never taken for part of it"""
+    
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+    
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+    
+    def discard(self, limit):
+        """Read and drop whatever the handler left; returns whether the whole body is now read"""
+        if self.remaining > limit:
+            return False
+        try:
+            while self.remaining:
+                if not self.read(min(self.remaining, 65536)):
+                    return False  # The client sent less than it said
+        except OSError:
+            return False
+        return True
 
 class PictureHandler(http.server.SimpleHTTPRequestHandler):
+    # Persistent connections, so a display's polls don't each pay for a new
+    # connection; every response therefore needs a Content-Length
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; with Nagle's algorithm the body
+    # would wait for the client's delayed ACK of the headers on a reused connection
+    disable_nagle_algorithm = True
+    
     def log_message(self, format, *args):
+        # An idle keep-alive connection timing out is routine
+        if format.startswith('Request timed out'):
+            return
         # Suppress logging for API requests and picture requests
         if args and len(args) > 0 and isinstance(args[0], str):
             request_path = args[0]
@@ -73,153 +885,602 @@ class PictureHandler(http.server.SimpleHTTPRequestHandler):
                 return
         super().log_message(format, *args)
     
+    def setup(self):
+        super().setup()
+        # Counts response bytes for the metrics
+        self.wfile = CountingWriter(self.wfile)
+        # While a request with a body is handled, rfile is its RequestBody
+        self.connection_rfile = self.rfile
+    
+    def handle_one_request(self):
+        """Handle a request and record it in the metrics"""
+        self.command = None
+        self.status = None
+        self.request_started = None
+        self.connection_header_sent = False
+        self.profile_sample = None
+        bytes_before = self.wfile.bytes_written
+        # Waiting for the next request on a kept-alive connection times out
+        self.connection.settimeout(KEEP_ALIVE_TIMEOUT_SECONDS)
+        try:
+            super().handle_one_request()
+        finally:
+            if self.rfile is not self.connection_rfile:
+                body, self.rfile = self.rfile, self.connection_rfile
+                # Whatever the handler did not read would be taken for the next request
+                if not self.close_connection:
+                    self.connection.settimeout(KEEP_ALIVE_TIMEOUT_SECONDS)
+                    if not body.discard(MAX_DISCARD_BYTES):
+                        self.close_connection = True
+            if self.profile_sample:
+                request_profiler.finish(self.profile_sample)
+            self.server.end_request()
+        if self.command and self.status and self.request_started:
+            request_metrics.observe_request(self.command, metric_route(self.path), self.status,
+                                            time.perf_counter() - self.request_started,
+                                            self.wfile.bytes_written - bytes_before)
+    
+    def parse_request(self):
+        # Timed from here so waiting for the request to arrive is not counted
+        self.request_started = time.perf_counter()
+        # An idle connection holds no worker; the request waits for one here
+        self.server.start_request()
+        if not super().parse_request():
+            return False
+        # Uploads and downloads to slow clients may take a while
+        self.connection.settimeout(None)
+        
+        # Handlers read the body through a RequestBody, so the rest of it can
+        # be skipped afterwards; a body of unknown length ends the connection
+        length = self.headers.get('Content-Length')
+        if 'Transfer-Encoding' in self.headers or not self.server.keep_alive_allowed():
+            self.close_connection = True
+        elif length is not None:
+            try:
+                length = int(length)
+                if length < 0:
+                    raise ValueError(length)
+            except ValueError:
+                self.close_connection = True
+            else:
+                self.rfile = RequestBody(self.connection_rfile, length)
+        
+        if request_profiler.enabled:
+            self.profile_sample = request_profiler.start(f'{self.command} {metric_route(self.path)}')
+        return True
+    
+    def send_response(self, code, message=None):
+        self.status = code
+        super().send_response(code, message)
+    
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'connection':
+            self.connection_header_sent = True
+        super().send_header(keyword, value)
+    
+    def end_headers(self):
+        # HTTP/1.1 clients keep the connection open unless told otherwise, and
+        # HTTP/1.0 clients that asked for keep-alive need to hear it was granted
+        if not self.connection_header_sent:
+            if self.close_connection and self.request_version == 'HTTP/1.1':
+                self.send_header('Connection', 'close')
+            elif not self.close_connection and self.request_version == 'HTTP/1.0':
+                self.send_header('Connection', 'keep-alive')
+        super().end_headers()
+    
+    def parse_route(self):
+        """Split the request path into its route, query parameters and room name.
+
+        /rooms/<name>/ followed by a page or an /api/ route, or a ?room=<name>
+        parameter, picks the room; anything else is for the default room.
+        """
+        path, _, query = self.path.partition('?')
+        self.query = urllib.parse.parse_qs(query)
+        self.route = path
+        self.room_name = self.query.get('room', [DEFAULT_ROOM])[0]
+        self.room = None
+        match = ROOM_PATH_PATTERN.match(path)
+        if match:
+            route = match.group(2) or '/'
+            if route in ROOM_PAGES or route.startswith('/api/'):
+                self.room_name, self.route = match.group(1), route
+    
+    def find_room(self, create=False):
+        """Look up the request's room, with create=True creating it on first use; sends a 404 if there is no such room"""
+        self.room = get_room(self.room_name, create)
+        if self.room is None:
+            self.send_error(404, "Unknown room")
+        return self.room
+    
     def do_GET(self):
-        if self.path == '/api/countdown':
-            self.send_countdown_json()
-        elif self.path == '/api/pictures':
-            self.send_pictures_json()
-        elif self.path == '/api/custom-slide':
-            self.send_custom_slide_json()
-        elif self.path == '/admin':
-            self.serve_admin_page()
-        elif self.path == '/favicon.ico':
+        self.parse_route()
+        if self.route in DISPLAY_ROUTES:
+            request_metrics.display_seen(self.client_address[0])
+        
+        room_routes = {
+            '/api/countdown': self.send_countdown_json,
+            '/api/pictures': self.send_pictures_json,
+            '/api/custom-slide': self.send_custom_slide_json,
+            '/api/bootstrap': self.send_bootstrap_json,
+            '/api/changes': self.send_changes_json,
+            '/api/events': self.stream_events,
+            '/api/timetable': self.send_timetable_json,
+        }
+        if self.route in room_routes:
+            # A display waiting for a room's first change keeps the room loaded
+            if self.find_room(create=self.route == '/api/events'):
+                room_routes[self.route]()
+        elif self.route == '/api/rooms':
+            self.send_rooms_json()
+        elif self.route == '/api/metrics':
+            self.send_metrics()
+        elif self.route == '/api/profile':
+            self.send_profile()
+        elif self.route == '/admin':
+            self.serve_page('admin.html')
+        elif self.route.startswith('/api/'):
+            self.send_error(404, "Not Found")
+        elif self.route != self.path.partition('?')[0]:
+            # A room's slideshow, e.g. /rooms/hall-2/; the page finds its room from the URL
+            self.serve_page('index.html')
+        elif self.route == '/favicon.ico':
             self.send_favicon()
         else:
             super().do_GET()
     
     def do_POST(self):
-        if self.path == '/api/countdown':
-            self.update_countdown()
-        elif self.path == '/api/upload':
-            self.handle_file_upload()
-        elif self.path == '/api/upload-background':
-            self.handle_background_upload()
-        elif self.path == '/api/custom-slide':
-            self.save_custom_slide()
-        else:
+        self.parse_route()
+        if self.route == '/api/profile':
+            self.update_profile()
+            return
+        handler = {
+            '/api/countdown': self.update_countdown,
+            '/api/upload': self.handle_file_upload,
+            '/api/upload-background': self.handle_background_upload,
+            '/api/custom-slide': self.save_custom_slide,
+            '/api/delete': self.delete_pictures,
+            '/api/timetable': self.save_timetable,
+        }.get(self.route)
+        if handler is None:
             self.send_error(404, "Not Found")
+        elif self.find_room(create=True):
+            handler()
     
     def do_DELETE(self):
-        if self.path.startswith('/api/delete/'):
-            filename = urllib.parse.unquote(self.path[12:])  # Remove '/api/delete/'
-            self.delete_picture(filename)
-        elif self.path == '/api/custom-slide':
-            self.delete_custom_slide()
+        self.parse_route()
+        if self.route.startswith('/api/delete/'):
+            if self.find_room(create=True):
+                filename = urllib.parse.unquote(self.route[12:])  # Remove '/api/delete/'
+                self.delete_picture(filename)
+        elif self.route == '/api/custom-slide':
+            if self.find_room(create=True):
+                self.delete_custom_slide()
+        elif self.route == '/api/timetable':
+            if self.find_room(create=True):
+                self.delete_timetable()
         else:
             self.send_error(404, "Not Found")
     
-    def send_favicon(self):
-        """Send empty favicon to prevent 404 errors"""
-        self.send_response(204)  # No Content
-        self.end_headers()
-    
-    def serve_admin_page(self):
-        """Serve the admin HTML page"""
+    def send_head(self):
+        """Serve static files with an ETag so displays can revalidate cheaply"""
+        if picture_pack is not None:
+            packed = self.packed_picture()
+            if packed:
+                return self.send_packed_picture(*packed)
+        
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) and urllib.parse.urlsplit(self.path).path.endswith('/'):
+            path = os.path.join(path, 'index.html')
+        
+        # Pages and other text files come precompressed from memory
+        content_type = self.guess_type(path)
+        if content_type in COMPRESSIBLE_TYPES:
+            cached = static_cache.get(path, content_type)
+            if cached:
+                return self.send_cached_file(cached)
+        
         try:
-            admin_file = Path('admin.html')
-            if admin_file.exists():
-                with open(admin_file, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                
-                self.send_response(200)
-                self.send_header('Content-type', 'text/html; charset=utf-8')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(content.encode('utf-8'))
-            else:
-                self.send_error(404, "Admin page not found")
-        except Exception as e:
-            self.send_error(500, f"Error serving admin page: {e}")
+            file_stat = os.stat(path)
+        except OSError:
+            return super().send_head()
+        if not stat.S_ISREG(file_stat.st_mode):
+            return super().send_head()
+        
+        etag = f'"{file_stat.st_mtime_ns:x}-{file_stat.st_size:x}"'
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_not_modified(etag)
+            return None
+        return self.send_file(path, file_stat, content_type, etag,
+                              self.static_cache_control(path, file_stat))
     
-    def send_pictures_json(self):
-        """Send list of available pictures as JSON"""
-        pictures_dir = Path('pictures')
+    def static_cache_control(self, path, file_stat):
+        """Let clients keep fingerprinted pictures and renditions forever"""
+        # Renditions are named after their source's content
+        if os.path.basename(os.path.dirname(path)) == RENDITIONS_DIR_NAME:
+            return IMMUTABLE_CACHE_CONTROL
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        fingerprint = query.get('v', [''])[0]
+        if fingerprint:
+            # Only when the URL names the current content, never a replaced file
+            digest = picture_digests.known(path, file_stat)
+            if digest and digest[:FINGERPRINT_LENGTH] == fingerprint:
+                return IMMUTABLE_CACHE_CONTROL
+        return 'no-cache'
+    
+    def packed_picture(self):
+        """Return the room and name of the packed picture the URL asks for, or None"""
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        match = ROOM_PATH_PATTERN.match(path)
+        room_name, path = (match.group(1), match.group(2) or '') if match else (DEFAULT_ROOM, path)
+        if not path.startswith('/pictures/'):
+            return None
+        name = path[len('/pictures/'):]
+        # Renditions stay files on disk
+        if name.startswith(RENDITIONS_DIR_NAME + '/'):
+            return None
+        room = get_room(room_name)
+        if room is None or room.store.entry(name) is None:
+            return None
+        return room, name
+    
+    def send_packed_picture(self, room, name):
+        """Send a picture from the pack, like send_file does for one on disk"""
+        entry = room.store.entry(name)
+        etag = f'"{entry.sha256[:FINGERPRINT_LENGTH]}-{entry.size:x}"'
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_not_modified(etag)
+            return None
         
-        if not pictures_dir.exists():
-            pictures_dir.mkdir()
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        fingerprint = query.get('v', [''])[0]
+        # The digest is stored with the picture, so no fingerprint is ever stale here
+        cache_control = (IMMUTABLE_CACHE_CONTROL if fingerprint and entry.sha256[:FINGERPRINT_LENGTH] == fingerprint
+                         else 'no-cache')
+        body_range = self.send_body_headers(entry.size, entry.mtime, self.guess_type(name), etag, cache_control)
+        if body_range is None:
+            return None
+        return room.store.open(name, *body_range)
+    
+    def send_file(self, path, file_stat, content_type, etag, cache_control='no-cache'):
+        """Send headers for a file on disk, or for the byte range the client asked for.
+
+        Returns a FileSlice for the body, which copyfile hands to sendfile.
+        """
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(404, "File not found")
+            return None
         
-        # Get all image files, excluding background images and main_slide_bg directory
-        image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp'}
-        pictures = []
+        body_range = self.send_body_headers(file_stat.st_size, file_stat.st_mtime, content_type, etag, cache_control)
+        if body_range is None:
+            f.close()
+            return None
+        return FileSlice(f, *body_range)
+    
+    def send_body_headers(self, size, mtime, content_type, etag, cache_control):
+        """Send headers for a whole body of size bytes, or the byte range the client asked for.
+
+        Returns (offset, length) of the part to send, or None if the range could
+        not be satisfied and the response is already complete.
+        """
+        last_modified = self.date_time_string(mtime)
+        byte_range = None
+        # With If-Range, only resume if the client's partial copy is of this version
+        if_range = self.headers.get('If-Range')
+        if if_range is None or if_range.strip() in (etag, last_modified):
+            try:
+                byte_range = parse_range(self.headers.get('Range'), size)
+            except RangeNotSatisfiable:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+                return None
         
-        for file_path in pictures_dir.iterdir():
-            if (file_path.is_file() and 
-                file_path.suffix.lower() in image_extensions and
-                not file_path.name.startswith('background_main_slide')):
-                pictures.append(file_path.name)
+        if byte_range:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            start, end = 0, size - 1
+            self.send_response(200)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('ETag', etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Cache-Control', cache_control)
+        self.end_headers()
+        return start, end - start + 1
+    
+    def copyfile(self, source, outputfile):
+        """Copy a response body to the client; files on disk skip Python's buffers"""
+        if isinstance(source, (FileSlice, BlobSlice)):
+            # sendfile bypasses wfile, so its bytes are counted here
+            self.wfile.bytes_written += source.send_to(self.connection)
+        else:
+            super().copyfile(source, outputfile)
+    
+    def send_not_modified(self, etag):
+        """Tell the client its cached copy is still current"""
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+    
+    def send_json(self, payload, status=200, cache_control=None):
+        """Send a JSON payload as a complete response"""
+        body = json.dumps(payload).encode()
         
-        pictures.sort()  # Sort alphabetically
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if cache_control:
+            self.send_header('Cache-Control', cache_control)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def send_encoded(self, content, content_type, etag):
+        """Send headers for an EncodedBody in the best encoding the client accepts.
+
+        Returns the bytes to write as the response body.
+        """
+        body, encoding = content.encoded(choose_encoding(self.headers.get('Accept-Encoding')))
         
         self.send_response(200)
-        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('ETag', encoded_etag(etag, encoding))
+        self.send_header('Cache-Control', 'no-cache')
         self.send_header('Access-Control-Allow-Origin', '*')
         self.end_headers()
+        return body
+    
+    def send_cached_file(self, cached):
+        """Send a file from the static cache; returns a file object for the body, like send_head"""
+        if etag_matches(self.headers.get('If-None-Match'), cached.etag):
+            self.send_not_modified(cached.etag)
+            return None
         
-        response = json.dumps({
-            'pictures': [f'./pictures/{pic}' for pic in pictures],
-            'count': len(pictures)
-        })
-        self.wfile.write(response.encode())
+        content_type = cached.content_type
+        if content_type.startswith('text/'):
+            content_type += '; charset=utf-8'
+        return io.BytesIO(self.send_encoded(cached.content, content_type, cached.etag))
     
-    def send_countdown_json(self):
-        """Send current countdown settings"""
-        global countdown_text, countdown_duration, countdown_target_time
+    def send_favicon(self):
+        """Send empty favicon to prevent 404 errors"""
+        self.send_response(204)  # No Content
+        self.end_headers()
+    
+    def stream_events(self):
+        """Push state changes to a display as Server-Sent Events"""
+        events = self.room.events
+        if not events.open_stream():
+            self.send_error(503, "Too many event streams")
+            return
         
-        # If we have a target time, calculate remaining duration
-        if countdown_target_time:
-            now = datetime.now()
-            remaining_seconds = int((countdown_target_time - now).total_seconds())
+        try:
+            # Resume after the last event the browser saw when it reconnects
+            try:
+                last_id = int(self.headers.get('Last-Event-ID', ''))
+            except ValueError:
+                last_id = events.last_id
+            # Event ids from before a server restart mean nothing now
+            last_id = min(last_id, events.last_id)
             
-            # If target time has passed, show 0 instead of setting for next day
-            if remaining_seconds <= 0:
-                countdown_duration = 0
-            else:
-                countdown_duration = remaining_seconds
+            # An event stream lives as long as the display is connected, so it
+            # must not hold on to one of the server's request workers
+            self.server.detach_current_request()
+            self.close_connection = True
+            
+            self.send_response(200)
+            self.send_header('Content-type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(b'retry: 3000\n\n')
+            self.wfile.flush()
+            
+            while True:
+                new_events = events.events_after(last_id, HEARTBEAT_SECONDS)
+                if new_events is None:
+                    break  # Server is shutting down
+                if new_events:
+                    for event in new_events:
+                        self.wfile.write(format_event(*event))
+                    last_id = new_events[-1][0]
+                else:
+                    self.wfile.write(b': keep-alive\n\n')
+                self.wfile.flush()
+                # A display on an event stream makes no other requests, so it is
+                # counted as connected at least every heartbeat
+                request_metrics.display_seen(self.client_address[0])
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # Display went away
+        finally:
+            events.close_stream()
+    
+    def send_metrics(self):
+        """Send request metrics in the Prometheus text format"""
+        loaded = loaded_rooms()
+        body = request_metrics.render([
+            ('http_requests_in_flight', 'Requests being handled, not counting event streams',
+             self.server.active_requests),
+            ('http_workers', 'Requests that can be handled at once', self.server.max_workers),
+            ('http_connections_open', 'Open client connections, idle keep-alive ones included',
+             self.server.open_connections),
+            ('event_streams', 'Open /api/events streams', sum(room.events.open_streams for room in loaded)),
+            ('rooms', 'Rooms in use', len(loaded)),
+            ('pictures', 'Pictures in the slideshows of all rooms',
+             sum(len(room.store.pictures()) for room in loaded)),
+        ]).encode()
         
         self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Content-type', METRICS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
         self.end_headers()
+        self.wfile.write(body)
+    
+    def local_client(self):
+        """Whether the request comes from the server's own machine; sends a 403 if not"""
+        try:
+            local = ipaddress.ip_address(self.client_address[0]).is_loopback
+        except ValueError:
+            local = False
+        if not local:
+            self.send_error(403, "Only available on the server itself")
+        return local
+    
+    def send_profile(self):
+        """Send the profiling settings and each route's hot spots and allocation sites"""
+        if not self.local_client():
+            return
+        try:
+            limit = int(self.query.get('limit', ['20'])[0])
+        except ValueError:
+            limit = 20
+        self.send_json(request_profiler.report(limit), cache_control='no-store')
+    
+    def update_profile(self):
+        """Switch profiling on or off: {"enabled": true, "sample_every": 10, "trace_memory": true, "reset": true}"""
+        if not self.local_client():
+            return
+        try:
+            content_length = int(self.headers['Content-Length'])
+            data = json.loads(self.rfile.read(content_length).decode('utf-8'))
+            if not isinstance(data, dict):
+                raise ValueError("Expected a JSON object")
+            settings = request_profiler.configure(
+                enabled=data.get('enabled'), sample_every=data.get('sample_every'),
+                trace_memory=data.get('trace_memory'), reset=bool(data.get('reset')))
+            if change_bus:
+                # Every worker process profiles its own requests
+                change_bus.publish({'kind': 'profile', 'settings': {**settings, 'reset': bool(data.get('reset'))}})
+            self.send_json({'success': True, **settings})
+        except Exception as e:
+            self.send_json({
+                'success': False,
+                'error': str(e)
+            }, status=400)
+    
+    def send_rooms_json(self):
+        """Send the names of the rooms, so displays and the admin page can offer a choice"""
+        self.send_json({'rooms': room_names(), 'default': DEFAULT_ROOM}, cache_control='no-store')
+    
+    def serve_page(self, filename):
+        """Serve the admin or slideshow HTML page"""
+        try:
+            cached = static_cache.get(filename, 'text/html')
+            if cached:
+                body = self.send_cached_file(cached)
+                if body:
+                    self.wfile.write(body.getvalue())
+            else:
+                self.send_error(404, f"{filename} not found")
+        except Exception as e:
+            self.send_error(500, f"Error serving {filename}: {e}")
+    
+    def send_json_with_etag(self, etag, build_payload):
+        """Send a JSON payload, or 304 Not Modified if the display already has it.
+
+        build_payload is only called when the body is actually needed.
+        """
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_not_modified(etag)
+            return
         
-        response = json.dumps({
-            'text': countdown_text,
-            'duration': countdown_duration,
-            'target_time': countdown_target_time.strftime('%H:%M') if countdown_target_time else None
-        })
-        self.wfile.write(response.encode())
+        content = cached_json_body((self.room.name, self.route), etag, build_payload)
+        self.wfile.write(self.send_encoded(content, 'application/json', etag))
+    
+    def pictures_json(self):
+        """Return the ETag of the room's picture listing and a function that builds it"""
+        room = self.room
+        version, pictures = room.picture_snapshot()
+        return make_etag(room.name, 'p', version), lambda: room.list_pictures(pictures)
+    
+    def custom_slide_json(self):
+        """Return the ETag of the room's custom slide and a function that builds it"""
+        room = self.room
+        return make_etag(room.name, 's', room.custom_slide_version), room.custom_slide_state
+    
+    def send_pictures_json(self):
+        """Send list of available pictures as JSON"""
+        if 'since' in self.query:
+            self.send_picture_changes()
+            return
+        self.send_json_with_etag(*self.pictures_json())
+    
+    def send_picture_changes(self):
+        """Send the pictures added, changed and removed since the listing a display has.
+        
+        The display passes the version and boot id it got with that listing. If
+        its listing is too old, or from before a restart, it is told to reset
+        and load the whole listing again.
+        """
+        since = self.query.get('since', [''])[0]
+        boot_id = self.query.get('boot', [''])[0]
+        changes = None
+        if boot_id == BOOT_ID and since.isdigit():
+            changes = self.room.picture_changes(int(since))
+        
+        if changes is None:
+            payload = {'reset': True, 'boot_id': BOOT_ID}
+        else:
+            payload = picture_changes_payload(changes)
+        self.send_json(payload, cache_control='no-store')
+    
+    def send_countdown_json(self):
+        """Send current countdown settings"""
+        room = self.room
+        with room.countdown_lock:
+            state = room.countdown_state()
+            version = room.countdown_version
+        # Time-based countdowns tick down, so the remaining seconds are part of the tag
+        etag = make_etag(room.name, 'c', version, state['duration'])
+        self.send_json_with_etag(etag, lambda: room.countdown_json(state))
     
     def update_countdown(self):
         """Update countdown settings"""
-        global countdown_text, countdown_duration, countdown_target_time
+        room = self.room
         
         try:
             content_length = int(self.headers['Content-Length'])
             post_data = self.rfile.read(content_length)
             data = json.loads(post_data.decode('utf-8'))
             
-            if 'text' in data:
-                countdown_text = data['text']
+            # Everything is checked before anything changes, so a bad request
+            # leaves the countdown as it was
+            text = data.get('text')
+            if 'text' in data and not isinstance(text, str):
+                raise ValueError("text must be a string")
+            target = duration = None
             
             # Handle both duration and target_time
             if 'target_time' in data:
                 # Parse time format like "12:05" or "23:30"
                 time_str = data['target_time']
-                time_match = re.match(r'^(\d{1,2}):(\d{2})$', time_str)
+                time_match = re.match(r'^(\d{1,2}):(\d{2})$', time_str) if isinstance(time_str, str) else None
                 if time_match:
                     hours = int(time_match.group(1))
                     minutes = int(time_match.group(2))
-                    
+                
                     if 0 <= hours <= 23 and 0 <= minutes <= 59:
                         # Create target datetime for today
                         now = datetime.now()
                         target = now.replace(hour=hours, minute=minutes, second=0, microsecond=0)
-                        
+                    
                         # If target time has already passed today, set for tomorrow
                         if target <= now:
                             target = target + timedelta(days=1)
-                        
-                        countdown_target_time = target
-                        countdown_duration = int((target - now).total_seconds())
+                        duration = int((target - now).total_seconds())
                     else:
                         raise ValueError("Invalid time format: hours must be 0-23, minutes 0-59")
                 else:
@@ -227,280 +1488,261 @@ class PictureHandler(http.server.SimpleHTTPRequestHandler):
             
             elif 'duration' in data:
                 # Traditional duration-based countdown
-                countdown_duration = int(data['duration'])
-                countdown_target_time = None
+                if isinstance(data['duration'], bool):
+                    raise ValueError("duration must be a number of seconds")
+                duration = int(data['duration'])
             
-            # Save settings to file after updating
-            save_countdown_settings()
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
+            with room.countdown_lock:
+                if text is not None:
+                    room.countdown_text = text
+                if duration is not None:
+                    room.countdown_target_time = target
+                    room.countdown_duration = duration
+                
+                # Save settings to file after updating
+                state = room.countdown_changed()
             
-            response = json.dumps({
-                'success': True,
-                'text': countdown_text,
-                'duration': countdown_duration,
-                'target_time': countdown_target_time.strftime('%H:%M') if countdown_target_time else None
-            })
-            self.wfile.write(response.encode())
+            self.send_json({'success': True, **state})
             
         except Exception as e:
-            self.send_response(400)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            response = json.dumps({
+            self.send_json({
                 'success': False,
                 'error': str(e)
-            })
-            self.wfile.write(response.encode())
+            }, status=400)
     
-    def handle_file_upload(self):
-        """Handle file upload for pictures"""
+    def send_timetable_json(self):
+        """Send the room's timetable and which slot is running"""
+        self.send_json(self.room.timetable_state(), cache_control='no-store')
+    
+    def save_timetable(self):
+        """Replace the room's timetable and set the countdown to its current slot"""
         try:
-            # Ensure pictures directory exists
-            pictures_dir = Path('pictures')
-            pictures_dir.mkdir(exist_ok=True)
-            
-            # Parse the multipart form data
-            content_type = self.headers.get('Content-Type', '')
-            if not content_type.startswith('multipart/form-data'):
-                raise ValueError("Invalid content type")
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+            timetable = parse_timetable(json.loads(post_data.decode('utf-8')))
             
-            # Get boundary
-            boundary = content_type.split('boundary=')[1]
-            if boundary.startswith('"') and boundary.endswith('"'):
-                boundary = boundary[1:-1]
+            self.room.timetable_changed(timetable)
             
-            # Read the content
-            content_length = int(self.headers.get('Content-Length', 0))
-            data = self.rfile.read(content_length)
+            self.send_json({'success': True, **self.room.timetable_state()})
             
-            # Simple multipart parsing
-            parts = data.split(f'--{boundary}'.encode())
+        except Exception as e:
+            self.send_json({
+                'success': False,
+                'error': str(e)
+            }, status=400)
+    
+    def delete_timetable(self):
+        """Stop the room's timetable; the countdown keeps its current setting"""
+        self.room.timetable_changed(None)
+        
+        self.send_json({
+            'success': True,
+            'message': 'Timetable deleted successfully'
+        })
+    
+    def read_uploads(self, target_dir):
+        """Stream the multipart request body into temporary files in target_dir"""
+        content_length = int(self.headers.get('Content-Length', 0))
+        started = time.perf_counter()
+        try:
+            files, _ = parse_multipart(self.rfile, self.headers.get('Content-Type', ''),
+                                       content_length, target_dir, max_upload_bytes)
+        except Exception:
+            request_metrics.observe_upload(content_length, time.perf_counter() - started, ok=False)
+            raise
+        request_metrics.observe_upload(content_length, time.perf_counter() - started)
+        return files
+    
+    def send_upload_error(self, error):
+        """Report a failed upload, closing the connection if the body was not read"""
+        if isinstance(error, UploadTooLarge):
+            status = 413
+            self.close_connection = True
+        else:
+            status = 400
+        
+        self.send_json({
+            'success': False,
+            'error': str(error)
+        }, status=status)
+    
+    def handle_file_upload(self):
+        """Handle file upload for pictures, any number of files per request.
+
+        A picture whose content is already in the slideshow is not saved again.
+        """
+        try:
+            room = self.room
+            uploads = self.read_uploads(room.store.upload_dir)
             
             uploaded_files = []
-            for part in parts:
-                if b'filename=' in part and b'Content-Type: image/' in part:
-                    # Extract filename
-                    lines = part.split(b'\r\n')
-                    filename = None
-                    file_data = None
-                    
-                    for i, line in enumerate(lines):
-                        if b'filename=' in line:
-                            # Extract filename from Content-Disposition header
-                            line_str = line.decode('utf-8')
-                            filename_start = line_str.find('filename="') + 10
-                            filename_end = line_str.find('"', filename_start)
-                            filename = line_str[filename_start:filename_end]
-                            
-                            # Find the empty line that separates headers from data
-                            for j in range(i + 1, len(lines)):
-                                if lines[j] == b'':
-                                    # File data starts after the empty line
-                                    file_data = b'\r\n'.join(lines[j + 1:])
-                                    # Remove trailing boundary data
-                                    if file_data.endswith(b'\r\n'):
-                                        file_data = file_data[:-2]
-                                    break
-                            break
-                    
-                    if filename and file_data:
-                        # Save the file
-                        file_path = pictures_dir / filename
-                        with open(file_path, 'wb') as f:
-                            f.write(file_data)
-                        uploaded_files.append(filename)
-            
-            if uploaded_files:
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
+            duplicates = []
+            try:
+                saved_digests = {}
+                for upload in uploads:
+                    if not upload.content_type.startswith('image/'):
+                        continue
+                    existing = (saved_digests.get(upload.sha256) or
+                                room.store.find_content(upload.size, upload.sha256))
+                    if existing:
+                        duplicates.append({'filename': upload.filename, 'existing': existing})
+                        continue
+                    room.store.save(upload, upload.filename)
+                    if is_slide_picture(upload.filename):
+                        rendition_pipeline.refresh(room.picture_path(upload.filename))
+                    uploaded_files.append(upload.filename)
+                    saved_digests[upload.sha256] = upload.filename
+            finally:
+                for upload in uploads:
+                    upload.discard()
+            
+            if uploaded_files or duplicates:
+                # One update for the whole batch
+                if uploaded_files:
+                    room.pictures_changed(uploaded_files)
                 
-                response = json.dumps({
+                self.send_json({
                     'success': True,
                     'uploaded_files': uploaded_files,
+                    'duplicates': duplicates,
                     'count': len(uploaded_files)
                 })
-                self.wfile.write(response.encode())
             else:
                 raise ValueError("No valid image files found")
                 
         except Exception as e:
-            self.send_response(400)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            response = json.dumps({
-                'success': False,
-                'error': str(e)
-            })
-            self.wfile.write(response.encode())
+            self.send_upload_error(e)
     
     def delete_picture(self, filename):
         """Delete a picture file"""
         try:
-            # Security check: ensure filename doesn't contain path traversal
-            if '..' in filename or '/' in filename or '\\' in filename:
-                raise ValueError("Invalid filename")
-            
-            file_path = Path('pictures') / filename
-            
-            if not file_path.exists():
-                raise ValueError("File not found")
+            self.room.remove_picture(filename)
+            self.room.pictures_changed([filename])
             
-            if not file_path.is_file():
-                raise ValueError("Not a file")
-            
-            # Delete the file
-            file_path.unlink()
-            
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            response = json.dumps({
+            self.send_json({
                 'success': True,
                 'message': f'File {filename} deleted successfully'
             })
-            self.wfile.write(response.encode())
             
         except Exception as e:
-            self.send_response(400)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            response = json.dumps({
+            self.send_json({
                 'success': False,
                 'error': str(e)
-            })
-            self.wfile.write(response.encode())
+            }, status=400)
     
-    def handle_background_upload(self):
-        """Handle background image upload for custom slide"""
+    def delete_pictures(self):
+        """Delete several pictures named in a JSON body: {"filenames": [...]}"""
         try:
-            # Parse the multipart form data
-            content_type = self.headers['Content-Type']
-            if not content_type.startswith('multipart/form-data'):
-                raise ValueError("Expected multipart/form-data")
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+            filenames = json.loads(post_data.decode('utf-8')).get('filenames')
+            if not isinstance(filenames, list) or not all(isinstance(name, str) for name in filenames):
+                raise ValueError("Expected a list of filenames")
             
-            # Create directories if they don't exist
-            pictures_dir = Path('pictures')
-            bg_dir = pictures_dir / 'main_slide_bg'
-            pictures_dir.mkdir(exist_ok=True)
-            bg_dir.mkdir(exist_ok=True)
+            deleted = []
+            errors = {}
+            for filename in filenames:
+                try:
+                    self.room.remove_picture(filename)
+                    deleted.append(filename)
+                except (ValueError, OSError) as e:
+                    errors[filename] = str(e)
             
-            # Parse the boundary
-            boundary = content_type.split('boundary=')[1].encode()
+            # One update for the whole batch
+            if deleted:
+                self.room.pictures_changed(deleted)
             
-            # Read the content
-            content_length = int(self.headers['Content-Length'])
-            data = self.rfile.read(content_length)
-            
-            # Parse multipart data manually (simple version)
-            parts = data.split(b'--' + boundary)
-            
-            for part in parts:
-                if b'Content-Disposition: form-data' in part and b'filename=' in part:
-                    # Extract filename
-                    lines = part.split(b'\r\n')
-                    for line in lines:
-                        if b'Content-Disposition' in line:
-                            filename_match = re.search(b'filename="([^"]*)"', line)
-                            if filename_match:
-                                original_filename = filename_match.group(1).decode('utf-8')
-                                
-                                # Get file extension
-                                file_ext = Path(original_filename).suffix.lower()
-                                
-                                # Create new filename
-                                new_filename = f'background_main_slide{file_ext}'
-                                
-                                # Find the file content (after double CRLF)
-                                content_start = part.find(b'\r\n\r\n') + 4
-                                if content_start > 3:
-                                    file_content = part[content_start:]
-                                    
-                                    # Remove any trailing boundary markers
-                                    if file_content.endswith(b'\r\n'):
-                                        file_content = file_content[:-2]
-                                    
-                                    # Save file in main_slide_bg subdirectory
-                                    file_path = bg_dir / new_filename
-                                    with open(file_path, 'wb') as f:
-                                        f.write(file_content)
-                                    
-                                    self.send_response(200)
-                                    self.send_header('Content-type', 'application/json')
-                                    self.send_header('Access-Control-Allow-Origin', '*')
-                                    self.end_headers()
-                                    
-                                    response = json.dumps({
-                                        'success': True,
-                                        'filename': new_filename,
-                                        'message': f'Background image uploaded successfully as {new_filename}'
-                                    })
-                                    self.wfile.write(response.encode())
-                                    return
-            
-            raise ValueError("No valid file found in upload")
+            self.send_json({
+                'success': not errors,
+                'deleted': deleted,
+                'errors': errors
+            })
             
         except Exception as e:
-            self.send_response(400)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            response = json.dumps({
+            self.send_json({
                 'success': False,
                 'error': str(e)
+            }, status=400)
+    
+    def handle_background_upload(self):
+        """Handle background image upload for custom slide"""
+        try:
+            store = self.room.store
+            uploads = self.read_uploads(store.upload_dir)
+            try:
+                if not uploads:
+                    raise ValueError("No valid file found in upload")
+                
+                # Get file extension and create new filename
+                file_ext = Path(uploads[0].filename).suffix.lower()
+                new_filename = f'{BACKGROUND_NAME}{file_ext}'
+                
+                # Save file in main_slide_bg subdirectory, replacing a background
+                # that had a different extension
+                previous = store.background()
+                store.save(uploads[0], f'{BACKGROUND_DIR}/{new_filename}')
+                if previous and previous != f'{BACKGROUND_DIR}/{new_filename}':
+                    store.remove(previous)
+            finally:
+                for upload in uploads:
+                    upload.discard()
+            
+            self.room.custom_slide_changed()
+            
+            self.send_json({
+                'success': True,
+                'filename': new_filename,
+                'message': f'Background image uploaded successfully as {new_filename}'
             })
-            self.wfile.write(response.encode())
+            
+        except Exception as e:
+            self.send_upload_error(e)
     
     def send_custom_slide_json(self):
         """Send custom slide data"""
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
+        self.send_json_with_etag(*self.custom_slide_json())
+    
+    def send_bootstrap_json(self):
+        """Send everything a display needs to start up in a single response"""
+        room = self.room
+        # Looking for changed pictures may rescan the folder and hash new ones,
+        # so countdown updates are not kept waiting for it under the lock
+        room.picture_snapshot()
+        with room.countdown_lock:
+            version = room.state_version(refresh=False)
+            countdown = room.countdown_state()
+        etag = make_etag(room.name, 'b', version, countdown['duration'])
+        # Put together from the bodies the other endpoints have already encoded
+        self.send_json_with_etag(etag, lambda: b''.join([
+            b'{"version": %d, ' % version,
+            b'"boot_id": %s, ' % json.dumps(BOOT_ID).encode(),
+            b'"room": %s, ' % json.dumps(room.name).encode(),
+            b'"countdown": %s, ' % room.countdown_json(countdown),
+            b'"pictures": %s, ' % cached_json_body((room.name, '/api/pictures'), *self.pictures_json()).body,
+            b'"custom_slide": %s}' % cached_json_body((room.name, '/api/custom-slide'), *self.custom_slide_json()).body
+        ]))
+    
+    def send_changes_json(self):
+        """Tell a display whether anything changed since the version it last saw"""
+        room = self.room
+        since = self.query.get('since', [''])[0]
+        boot_id = self.query.get('boot', [''])[0]
+        version = room.state_version()
         
-        # Check for background image in main_slide_bg directory
-        pictures_dir = Path('pictures')
-        bg_dir = pictures_dir / 'main_slide_bg'
-        background_image = None
-        if bg_dir.exists():
-            for ext in ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp']:
-                bg_file = bg_dir / f'background_main_slide{ext}'
-                if bg_file.exists():
-                    background_image = f'./pictures/main_slide_bg/{bg_file.name}'
-                    break
-        
-        custom_slide_file = Path('custom_slide.json')
-        if custom_slide_file.exists():
-            try:
-                with open(custom_slide_file, 'r') as f:
-                    slide_data = json.load(f)
-                slide_data['backgroundImage'] = background_image
-                self.wfile.write(json.dumps(slide_data).encode())
-                return
-            except Exception as e:
-                print(f"Error reading custom slide: {e}")
+        # Which parts changed, so the display only fetches those
+        seen = int(since) if since.isdigit() and boot_id == BOOT_ID else -1
+        changes = [kind for kind, changed in (('countdown', room.countdown_version),
+                                              ('pictures', room.pictures_version),
+                                              ('custom-slide', room.custom_slide_version))
+                   if changed > seen]
         
-        # Return empty slide data if file doesn't exist or has errors
-        empty_data = {
-            'elements': [], 
-            'backgroundColor': '#f9f9f9',
-            'backgroundImage': background_image
-        }
-        self.wfile.write(json.dumps(empty_data).encode())
+        self.send_json({
+            # Versions restart with the server, so a different boot id always counts as changed
+            'changed': boot_id != BOOT_ID or since != str(version),
+            'version': version,
+            'boot_id': BOOT_ID,
+            'changes': changes
+        }, cache_control='no-store')
     
     def save_custom_slide(self):
         """Save custom slide data"""
@@ -509,96 +1751,304 @@ class PictureHandler(http.server.SimpleHTTPRequestHandler):
             post_data = self.rfile.read(content_length)
             slide_data = json.loads(post_data.decode('utf-8'))
             
-            # Save to file
-            with open('custom_slide.json', 'w') as f:
-                json.dump(slide_data, f, indent=2)
+            if not isinstance(slide_data, dict):
+                raise ValueError("Custom slide must be a JSON object")
             
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
+            # Written to custom_slide.json in the background
+            self.room.custom_slide_store.set(slide_data)
+            self.room.custom_slide_changed()
             
-            response = json.dumps({
+            self.send_json({
                 'success': True,
                 'message': 'Custom slide saved successfully'
             })
-            self.wfile.write(response.encode())
             
         except Exception as e:
-            self.send_response(400)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            response = json.dumps({
+            self.send_json({
                 'success': False,
                 'error': str(e)
-            })
-            self.wfile.write(response.encode())
+            }, status=400)
     
     def delete_custom_slide(self):
         """Delete custom slide data and background image"""
         try:
-            # Delete custom slide JSON file
-            custom_slide_file = Path('custom_slide.json')
-            if custom_slide_file.exists():
-                custom_slide_file.unlink()
-            
-            # Delete background image if it exists in main_slide_bg directory
-            pictures_dir = Path('pictures')
-            bg_dir = pictures_dir / 'main_slide_bg'
-            if bg_dir.exists():
-                for ext in ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp']:
-                    bg_file = bg_dir / f'background_main_slide{ext}'
-                    if bg_file.exists():
-                        bg_file.unlink()
-                        break
-                
-                # Remove the directory if it's empty
-                try:
-                    bg_dir.rmdir()
-                except OSError:
-                    pass  # Directory not empty or doesn't exist
+            # Removes custom_slide.json in the background
+            room = self.room
+            room.custom_slide_store.delete()
             
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
+            # Delete background image if there is one
+            room.store.delete_background()
+            
+            room.custom_slide_changed()
             
-            response = json.dumps({
+            self.send_json({
                 'success': True,
                 'message': 'Custom slide deleted successfully'
             })
-            self.wfile.write(response.encode())
             
         except Exception as e:
-            self.send_response(400)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            response = json.dumps({
+            self.send_json({
                 'success': False,
                 'error': str(e)
-            })
-            self.wfile.write(response.encode())
+            }, status=400)
+
+class PictureServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Threaded HTTP server that handles at most max_workers requests at once.
+
+    A slow upload or a slow display only ties up its own worker thread, so the
+    other screens keep getting countdown updates. A worker is only held while a
+    request is being handled, not while a kept-alive connection waits for its
+    next one; when every worker is busy, new requests wait for a slot.
+    
+    At most max_connections connections stay open. Beyond that, a connection
+    waits for a worker as soon as it is accepted and is closed after one
+    request, so idle displays cannot lock anyone else out.
+    """
+    daemon_threads = True
+    # socketserver's default backlog of 5 drops connections when a room full of
+    # displays polls at the same moment, and each dropped one waits a second to retry
+    request_queue_size = 128
+    
+    def __init__(self, server_address, handler_class, max_workers=DEFAULT_MAX_WORKERS,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, reuse_port=False):
+        self.max_workers = max_workers
+        self.max_connections = max_connections
+        # Lets the worker processes of --processes each listen on the same port
+        self.reuse_port = reuse_port
+        self._worker_slots = threading.BoundedSemaphore(max_workers)
+        self._connection_slots = threading.BoundedSemaphore(max_connections)
+        self._active_requests = 0
+        self._open_connections = 0
+        self._requests_done = threading.Condition()
+        # Whether each new connection may be kept alive, until its thread starts
+        self._keep_alive = {}
+        self._closing = False
+        # Per connection thread: whether it holds a worker and may be kept alive
+        self._connection = threading.local()
+        super().__init__(server_address, handler_class)
+    
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+    
+    def process_request(self, request, client_address):
+        """Handle the connection on its own thread, waiting for a worker if there are too many"""
+        keep_alive = self._connection_slots.acquire(blocking=False)
+        if not keep_alive:
+            self._acquire_worker()
+        with self._requests_done:
+            self._keep_alive[request] = keep_alive
+            self._open_connections += 1
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self._connection_done(request, keep_alive, holding=not keep_alive)
+            raise
+    
+    def process_request_thread(self, request, client_address):
+        with self._requests_done:
+            keep_alive = self._keep_alive.get(request)
+        self._connection.keep_alive = keep_alive
+        # A connection over the limit already holds its worker
+        self._connection.holding = not keep_alive
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._connection_done(request, keep_alive, self._connection.holding)
+    
+    def _connection_done(self, request, keep_alive, holding):
+        with self._requests_done:
+            self._keep_alive.pop(request, None)
+            self._open_connections -= 1
+        if holding:
+            self._release_worker()
+        if keep_alive:
+            self._connection_slots.release()
+    
+    def start_request(self):
+        """Wait for a worker slot for the request the current connection has just received"""
+        if not self._connection.holding:
+            self._acquire_worker()
+            self._connection.holding = True
+    
+    def end_request(self):
+        """Hand back the current connection's worker slot, if it holds one"""
+        if getattr(self._connection, 'holding', False):
+            self._connection.holding = False
+            self._release_worker()
+    
+    def keep_alive_allowed(self):
+        """Whether the current connection may stay open for another request"""
+        return self._connection.keep_alive and not self._closing
+    
+    @property
+    def active_requests(self):
+        """Requests currently holding a worker slot"""
+        with self._requests_done:
+            return self._active_requests
+    
+    @property
+    def open_connections(self):
+        """Client connections currently open, idle ones included"""
+        with self._requests_done:
+            return self._open_connections
+    
+    def detach_current_request(self):
+        """Hand the current request's worker slot back for a long-lived stream"""
+        self.end_request()
+    
+    def _acquire_worker(self):
+        self._worker_slots.acquire()
+        with self._requests_done:
+            self._active_requests += 1
+    
+    def _release_worker(self):
+        with self._requests_done:
+            self._active_requests -= 1
+            self._requests_done.notify_all()
+        self._worker_slots.release()
+    
+    def server_close(self):
+        """Stop listening and give in-flight requests a chance to finish"""
+        # Kept-alive connections are closed after the request they are handling
+        self._closing = True
+        super().server_close()
+        with self._requests_done:
+            finished = self._requests_done.wait_for(
+                lambda: self._active_requests == 0, timeout=SHUTDOWN_GRACE_SECONDS)
+            if not finished:
+                print(f"Shutting down with {self._active_requests} request(s) still running")
+
+def parse_size(value):
+    """Parse a WIDTHxHEIGHT command line value"""
+    match = re.match(r'^(\d+)x(\d+)$', value)
+    if not match:
+        raise argparse.ArgumentTypeError("expected WIDTHxHEIGHT, e.g. 1920x1080")
+    return int(match.group(1)), int(match.group(2))
+
+def parse_args():
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description="Tournament slideshow server")
+    parser.add_argument('--port', type=int, default=None,
+                        help="port to listen on (default: first free port between 8000 and 8009)")
+    parser.add_argument('--bind', default='',
+                        help="address to bind to (default: all interfaces)")
+    parser.add_argument('--workers', type=int, default=DEFAULT_MAX_WORKERS,
+                        help=f"maximum number of requests handled at once (default: {DEFAULT_MAX_WORKERS})")
+    parser.add_argument('--max-connections', type=int, default=DEFAULT_MAX_CONNECTIONS,
+                        help=f"maximum number of open client connections (default: {DEFAULT_MAX_CONNECTIONS})")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="worker processes sharing the port, to use several CPU cores (Linux only, default: 1); "
+                             "--workers applies to each")
+    parser.add_argument('--screen-size', type=parse_size, default=DEFAULT_SCREEN_SIZE,
+                        help="size of the pre-scaled display renditions, WIDTHxHEIGHT (default: 1920x1080)")
+    parser.add_argument('--webp', action='store_true',
+                        help="also create WebP renditions for displays that support them")
+    parser.add_argument('--rendition-workers', type=int, default=None,
+                        help="processes used to create renditions (default: half the CPU cores)")
+    parser.add_argument('--max-upload-mb', type=int, default=DEFAULT_MAX_UPLOAD_BYTES // (1024 * 1024),
+                        help="largest upload request accepted, in megabytes (default: %(default)s)")
+    parser.add_argument('--pack', metavar='FILE',
+                        help="keep every room's pictures in this SQLite pack instead of the pictures "
+                             "folders (see picture_pack.py)")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.max_connections < 1:
+        parser.error("--max-connections must be at least 1")
+    if args.processes < 1:
+        parser.error("--processes must be at least 1")
+    if args.processes > 1 and not prefork.supported():
+        parser.error("--processes needs Linux (SO_REUSEPORT and fork)")
+    return args
+
+def handle_sigterm(signum, frame):
+    """Treat SIGTERM like Ctrl+C so the server shuts down cleanly"""
+    raise KeyboardInterrupt
 
 if __name__ == "__main__":
-    # Load countdown settings from file on startup
-    load_countdown_settings()
+    args = parse_args()
+    max_upload_bytes = args.max_upload_mb * 1024 * 1024
+    signal.signal(signal.SIGTERM, handle_sigterm)
     
     # Try multiple ports to find one that's available
-    for PORT in range(8000, 8010):
+    ports = [args.port] if args.port else range(8000, 8010)
+    if args.processes > 1:
+        # The port is chosen once and held, so every worker listens on the same one
+        for PORT in ports:
+            try:
+                reserved_port = prefork.reserve_port(args.bind, PORT)
+            except OSError as e:
+                if e.errno == errno.EADDRINUSE and not args.port:
+                    print(f"Port {PORT} is in use, trying next port...")
+                    continue
+                raise
+            break
+        else:
+            print("Could not find an available port between 8000-8009")
+            raise SystemExit(1)
+        ports = [PORT]
+        # Forked before any thread, database connection or room exists; from
+        # here on this is one of the worker processes
+        versions = prefork.SharedCounter()
+        change_bus = prefork.fork_workers(args.processes)
+        primary_worker = change_bus.index == 0
+    
+    if args.pack:
+        picture_pack = PicturePack(args.pack)
+        if primary_worker:
+            print(f"Serving pictures from the pack {args.pack}")
+    rendition_pipeline = RenditionPipeline(Path('pictures') / RENDITIONS_DIR_NAME, screen_size=args.screen_size, webp=args.webp,
+                                           workers=args.rendition_workers, on_change=renditions_ready,
+                                           source_for=packed_source if picture_pack else None,
+                                           digest_for=picture_digest,
+                                           render=primary_worker)
+    if not rendition_pipeline.enabled and primary_worker:
+        print("Pillow is not installed, so pictures are served without pre-scaled renditions")
+    
+    # Load the default room and any room with a timetable on startup; other
+    # rooms are loaded when a display or the admin page first asks for them
+    get_room(DEFAULT_ROOM)
+    load_timetabled_rooms()
+    if change_bus:
+        # Without the supervisor the worker cannot hear about changes, so it stops
+        change_bus.start(apply_change, on_close=lambda: os.kill(os.getpid(), signal.SIGTERM))
+        change_bus.publish({'kind': 'hello'})
+    
+    for PORT in ports:
         try:
-            with socketserver.TCPServer(("", PORT), PictureHandler) as httpd:
-                print(f"Starting server at http://localhost:{PORT}")
-                print(f"📺 Slideshow: http://localhost:{PORT}")
-                print(f"⚙️  Admin Panel: http://localhost:{PORT}/admin")
-                print("Add pictures to the 'pictures' folder and they will appear automatically!")
-                print("Press Ctrl+C to stop the server")
-                httpd.serve_forever()
+            with PictureServer((args.bind, PORT), PictureHandler, max_workers=args.workers,
+                               max_connections=args.max_connections,
+                               reuse_port=change_bus is not None) as httpd:
+                if primary_worker:
+                    processes = f", {args.processes} processes" if change_bus else ""
+                    print(f"Starting server at http://localhost:{PORT} ({args.workers} workers{processes})")
+                    print(f"📺 Slideshow: http://localhost:{PORT}")
+                    print(f"⚙️  Admin Panel: http://localhost:{PORT}/admin")
+                    print(f"🏠 Other rooms: http://localhost:{PORT}/rooms/<name>/ and /rooms/<name>/admin")
+                    print("Add pictures to the 'pictures' folder and they will appear automatically!")
+                    print("Press Ctrl+C to stop the server")
+                try:
+                    httpd.serve_forever()
+                except KeyboardInterrupt:
+                    if change_bus:
+                        # Ctrl+C reaches the supervisor too, which then sends SIGTERM;
+                        # that must not cut this shutdown short
+                        signal.signal(signal.SIGINT, signal.SIG_IGN)
+                        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                    if primary_worker:
+                        print("\nShutting down...")
+                    rendition_pipeline.close()
+                    timetable_scheduler.close()
+                    # Ends event streams and writes out any change still waiting
+                    close_rooms()
+                    if picture_pack:
+                        picture_pack.close()
+                    if change_bus:
+                        change_bus.close()
         except OSError as e:
-            if e.errno == 48:  # Address already in use
+            if e.errno == errno.EADDRINUSE and not args.port:
                 print(f"Port {PORT} is in use, trying next port...")
                 continue
             else:
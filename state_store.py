@@ -0,0 +1,203 @@
+"""
+Crash-safe, write-behind persistence for small JSON state files.
+
+The countdown (times) and the custom slide (custom_slide.json) live in memory
+and are answered from there. Changes are written to disk shortly afterwards by
+a single background thread shared by every store, so a burst of updates costs
+one write. Each write goes to a temporary file that is fsynced and renamed
+over the old one, so a power cut leaves either the old or the new file, never
+a truncated one.
+"""
+
+import heapq
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+# How long to wait for more changes before writing, so bursts are coalesced
+DEFAULT_WRITE_DELAY = 0.25
+
+# Temporary files are private; written files get the usual permissions
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def atomic_write_json(path, data):
+    """Write data as JSON to path without ever leaving a partial file behind"""
+    path = Path(path)
+    directory = path.parent
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f'.{path.name}.', suffix='.tmp')
+    try:
+        # A replaced file keeps its mode; a new one is readable like any other
+        try:
+            mode = os.stat(path).st_mode & 0o7777
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        os.chmod(temp_path, mode)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    _fsync_directory(directory)
+
+
+def _fsync_directory(directory):
+    # Makes the rename itself durable; not every platform allows it
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class _Writer:
+    """The one background thread that writes out every store's changes.
+
+    Stores queue themselves with the time their write is due, so any number of
+    stores (one pair per room) costs a single thread.
+    """
+
+    def __init__(self):
+        self._changed = threading.Condition()
+        self._due = []  # heap of (due time, sequence, store)
+        self._sequence = itertools.count()
+        self._thread = None
+
+    def schedule(self, store, delay):
+        with self._changed:
+            heapq.heappush(self._due, (time.monotonic() + delay, next(self._sequence), store))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='state-writer', daemon=True)
+                self._thread.start()
+            self._changed.notify()
+
+    def _run(self):
+        while True:
+            with self._changed:
+                while True:
+                    if not self._due:
+                        self._changed.wait()
+                        continue
+                    delay = self._due[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self._changed.wait(delay)
+                _, _, store = heapq.heappop(self._due)
+            store._flush()
+
+
+_writer = _Writer()
+
+
+class WriteBehindStore:
+    """A JSON document held in memory and persisted in the background.
+
+    A value of None means the document does not exist and its file is removed.
+    """
+
+    def __init__(self, path, write_delay=DEFAULT_WRITE_DELAY):
+        self.path = Path(path)
+        self.write_delay = write_delay
+        self._value = None
+        self._dirty = False
+        self._scheduled = False
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def load(self, validate=None):
+        """Read the file from disk, recovering from leftovers of an interrupted write.
+
+        validate, if given, is called with the value read and returns the value
+        to keep; a ValueError from it is handled like a damaged file.
+        """
+        # Temporary files from a write that never finished are useless
+        for leftover in self.path.parent.glob(f'.{self.path.name}.*.tmp'):
+            try:
+                leftover.unlink()
+            except OSError:
+                pass
+
+        value = None
+        if self.path.exists():
+            try:
+                with open(self.path, 'r') as f:
+                    value = json.load(f)
+                if validate:
+                    value = validate(value)
+            except (OSError, ValueError) as e:
+                value = None
+                # Keep the damaged file for inspection and start from defaults
+                corrupt = self.path.with_name(f'{self.path.name}.corrupt-{int(time.time())}')
+                print(f"Could not read {self.path} ({e}), moved it to {corrupt.name}")
+                try:
+                    os.replace(self.path, corrupt)
+                except OSError:
+                    pass
+        with self._lock:
+            self._value = value
+            self._dirty = False
+        return value
+
+    def get(self):
+        """Return the current value; callers must not modify it"""
+        with self._lock:
+            return self._value
+
+    def set(self, value):
+        """Replace the value; it is written to disk shortly afterwards"""
+        with self._lock:
+            self._value = value
+            self._dirty = True
+            # Changes made before the write is due all end up in that one write
+            schedule = not self._scheduled and not self._closed
+            self._scheduled = self._scheduled or schedule
+        if schedule:
+            _writer.schedule(self, self.write_delay)
+
+    def delete(self):
+        self.set(None)
+
+    def close(self):
+        """Write any pending change now; later changes are only kept in memory"""
+        with self._lock:
+            self._closed = True
+        self._flush()
+
+    def _flush(self):
+        with self._lock:
+            self._scheduled = False
+            if not self._dirty:
+                return
+            value = self._value
+            self._dirty = False
+        try:
+            if value is None:
+                try:
+                    self.path.unlink()
+                except FileNotFoundError:
+                    pass
+            else:
+                # A new room's folder is only created once it has something to keep
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                atomic_write_json(self.path, value)
+        except OSError as e:
+            print(f"Error saving {self.path}: {e}")
+            with self._lock:
+                # Try again with the next change rather than losing this one
+                self._dirty = True
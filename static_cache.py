@@ -0,0 +1,113 @@
+"""
+In-memory, precompressed copies of the slideshow's text files and large JSON.
+
+index.html and admin.html are read once, compressed once with gzip (and brotli
+when the brotli module is installed) and served from memory until the file
+changes on disk. Clients get whichever encoding they accept.
+"""
+
+import gzip
+import os
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this are not worth compressing
+MIN_COMPRESS_BYTES = 1024
+# Text files larger than this are streamed from disk instead of cached
+MAX_CACHED_FILE_BYTES = 4 * 1024 * 1024
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/javascript',
+    'application/javascript', 'application/json', 'image/svg+xml',
+}
+
+
+def choose_encoding(accept_encoding):
+    """Pick the best content coding the client accepts: 'br', 'gzip' or None"""
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            accepted[coding.lower()] = quality
+    if brotli and accepted.get('br', accepted.get('*', 0)) > 0:
+        return 'br'
+    if accepted.get('gzip', accepted.get('*', 0)) > 0:
+        return 'gzip'
+    return None
+
+
+class EncodedBody:
+    """A response body plus its compressed variants, built on first use"""
+
+    def __init__(self, body):
+        self.body = body
+        self._variants = {}
+        self._lock = threading.Lock()
+
+    def encoded(self, encoding):
+        """Return (body, encoding) for the requested coding, or the plain body
+        when compression is not requested or would not help"""
+        if encoding is None or len(self.body) < MIN_COMPRESS_BYTES:
+            return self.body, None
+        with self._lock:
+            if encoding not in self._variants:
+                if encoding == 'br':
+                    self._variants[encoding] = brotli.compress(self.body)
+                else:
+                    self._variants[encoding] = gzip.compress(self.body, compresslevel=9, mtime=0)
+        return self._variants[encoding], encoding
+
+    def precompress(self):
+        """Build every variant up front so no request pays for compression"""
+        for encoding in ('gzip', 'br') if brotli else ('gzip',):
+            self.encoded(encoding)
+
+
+class CachedFile:
+    def __init__(self, body, content_type, mtime_ns, size):
+        self.content = EncodedBody(body)
+        self.content_type = content_type
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.etag = f'"{mtime_ns:x}-{size:x}"'
+
+
+class StaticCache:
+    """Files kept in memory and reloaded when their mtime or size changes"""
+
+    def __init__(self):
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def get(self, path, content_type):
+        """Return the CachedFile for path, or None if it is missing or too big"""
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if stat.st_size > MAX_CACHED_FILE_BYTES:
+            return None
+
+        with self._lock:
+            cached = self._files.get(path)
+            if cached and cached.mtime_ns == stat.st_mtime_ns and cached.size == stat.st_size:
+                return cached
+
+        with open(path, 'rb') as f:
+            body = f.read()
+        cached = CachedFile(body, content_type, stat.st_mtime_ns, stat.st_size)
+        cached.content.precompress()
+        with self._lock:
+            self._files[path] = cached
+        return cached
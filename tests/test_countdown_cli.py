@@ -0,0 +1,77 @@
+"""
+Runs countdown_cli.py against the server, started in-process in a scratch
+directory.
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import countdown_cli  # noqa: E402
+import server  # noqa: E402
+
+
+class CountingServer(server.PictureServer):
+    """Counts the connections it accepts"""
+
+    connections = 0
+
+    def get_request(self):
+        request = super().get_request()
+        self.connections += 1
+        return request
+
+
+class CountdownCliTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.scratch = tempfile.TemporaryDirectory()
+        os.chdir(self.scratch.name)
+        server.rendition_pipeline.enabled = False
+        self.httpd = CountingServer(('127.0.0.1', 0), server.PictureHandler, max_workers=4)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        server.close_rooms()
+        server.rooms.clear()
+        os.chdir(self.cwd)
+        self.scratch.cleanup()
+
+    def run_cli(self, *argv):
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            return countdown_cli.main(['--url', self.url, *argv])
+
+    def test_batch_reuses_one_connection(self):
+        Path('day.txt').write_text('set "Round 1 finishes in" 10m\n'
+                                   'show\n'
+                                   'set "Round over" 0\n'
+                                   'room hall-2\n'
+                                   'set "Hall 2 finishes in" 90s\n'
+                                   'show\n')
+        self.assertEqual(self.run_cli('batch', 'day.txt'), 0)
+        self.assertEqual(self.httpd.connections, 1)
+
+        default = server.get_room(server.DEFAULT_ROOM)
+        self.assertEqual((default.countdown_text, default.countdown_duration), ('Round over', 0))
+        hall = server.get_room('hall-2')
+        self.assertEqual((hall.countdown_text, hall.countdown_duration), ('Hall 2 finishes in', 90))
+
+    def test_failed_command_keeps_the_connection(self):
+        Path('day.txt').write_text('set "Round 1" 10m\n'
+                                   'at 25:99 "Not a time"\n'
+                                   'show\n')
+        self.assertEqual(self.run_cli('batch', 'day.txt'), 1)
+        self.assertEqual(self.httpd.connections, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
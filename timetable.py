@@ -0,0 +1,150 @@
+"""
+Timetable of rounds and breaks that drives a room's countdown.
+
+A timetable is a start time and a sequence of slots, each with the countdown
+text and how long it lasts. Which slot is running is always worked out from
+the wall clock, so a restarted server picks up exactly where the timetable
+says it should be. One Scheduler thread sleeps until the next boundary of any
+room's timetable, so there is no per-second polling and no thread per room.
+"""
+
+import heapq
+import itertools
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+# The clock is read again at least this often while waiting, so an adjustment
+# of the system clock cannot delay a boundary by much
+MAX_WAIT_SECONDS = 60
+
+
+def parse_timetable(data):
+    """Check a timetable sent as JSON and return it normalised; raises ValueError.
+
+    data is {"start": "HH:MM" or an ISO date and time,
+             "slots": [{"text": ..., "duration": seconds}, ...]}.
+    A start given as HH:MM means today.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Timetable must be a JSON object")
+
+    start = data.get('start')
+    if not isinstance(start, str):
+        raise ValueError("Timetable needs a start time")
+    time_match = re.match(r'^(\d{1,2}):(\d{2})$', start)
+    if time_match:
+        hours, minutes = int(time_match.group(1)), int(time_match.group(2))
+        if not (0 <= hours <= 23 and 0 <= minutes <= 59):
+            raise ValueError("Invalid start time: hours must be 0-23, minutes 0-59")
+        start_time = datetime.now().replace(hour=hours, minute=minutes, second=0, microsecond=0)
+    else:
+        try:
+            start_time = datetime.fromisoformat(start)
+        except ValueError:
+            raise ValueError("Invalid start time. Use HH:MM or an ISO date and time") from None
+        if start_time.tzinfo:
+            # Everything else works in local time
+            start_time = start_time.astimezone().replace(tzinfo=None)
+
+    slots = data.get('slots')
+    if not isinstance(slots, list) or not slots:
+        raise ValueError("Timetable needs at least one slot")
+    normalised = []
+    for slot in slots:
+        if not isinstance(slot, dict) or not isinstance(slot.get('text'), str):
+            raise ValueError("Every slot needs a text")
+        try:
+            if isinstance(slot.get('duration'), bool):
+                raise TypeError  # int(True) would be a one-second slot
+            duration = int(slot.get('duration'))
+        except (TypeError, ValueError):
+            raise ValueError("Every slot needs a duration in seconds") from None
+        if duration <= 0:
+            raise ValueError("Slot durations must be positive")
+        normalised.append({'text': slot['text'], 'duration': duration})
+
+    return {'start': start_time.isoformat(), 'slots': normalised}
+
+
+def slot_at(timetable, now):
+    """Return (index, ends) for the slot running at now.
+
+    index is -1 before the timetable starts, with ends being the start time,
+    and len(slots) once it is over, with ends None.
+    """
+    boundary = datetime.fromisoformat(timetable['start'])
+    if now < boundary:
+        return -1, boundary
+    for index, slot in enumerate(timetable['slots']):
+        boundary += timedelta(seconds=slot['duration'])
+        if now < boundary:
+            return index, boundary
+    return len(timetable['slots']), None
+
+
+class Timer:
+    """A callback waiting in a Scheduler; cancel() stops it from running"""
+
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    """Runs callbacks at wall-clock times, all on one background thread"""
+
+    def __init__(self):
+        self._changed = threading.Condition()
+        self._timers = []  # heap of (when, sequence, timer)
+        self._sequence = itertools.count()
+        self._thread = None
+        self._closed = False
+
+    def call_at(self, when, callback):
+        """Run callback at when, a datetime in local time; returns a Timer"""
+        timer = Timer(when.timestamp(), callback)
+        with self._changed:
+            if self._closed:
+                return timer
+            heapq.heappush(self._timers, (timer.when, next(self._sequence), timer))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='timetable', daemon=True)
+                self._thread.start()
+            self._changed.notify()
+        return timer
+
+    def close(self):
+        """Stop running callbacks, used on server shutdown"""
+        with self._changed:
+            self._closed = True
+            self._changed.notify()
+
+    def _run(self):
+        while True:
+            with self._changed:
+                while True:
+                    if self._closed:
+                        return
+                    # Cancelled timers are dropped once they reach the front
+                    while self._timers and self._timers[0][2].cancelled:
+                        heapq.heappop(self._timers)
+                    if not self._timers:
+                        self._changed.wait()
+                        continue
+                    delay = self._timers[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self._changed.wait(min(delay, MAX_WAIT_SECONDS))
+                _, _, timer = heapq.heappop(self._timers)
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback()
+            except Exception as e:
+                print(f"Error running timetable: {e}")